@@ -0,0 +1,170 @@
+import numpy as np
+
+
+def stack_runs(runs):
+    """Stacks the arrays of several runs, padding the shorter runs with NaN at the end.
+
+    Inputs:
+      - runs(list): The array of each run [n_steps_i x n_values]
+    Returns:
+      - stacked(np.ndarray): The stacked arrays [n_runs x max(n_steps_i) x n_values]
+    """
+    n_steps = max(len(run) for run in runs)
+    stacked = np.full((len(runs), n_steps, np.shape(runs[0])[1]), np.nan)
+    for i, run in enumerate(runs):
+        stacked[i, :len(run)] = run
+    return stacked
+
+
+def get_obstacle_positions(times, obs=(), moving_obs=()):
+    """Computes the positions and radii of all obstacles at the given times.
+
+    Inputs:
+      - times(np.ndarray): The times [s], shared [n_steps] or per run [n_runs x n_steps]
+      - obs(list):         Static obstacles as list of tuples (x,y,radius)
+      - moving_obs(list):  Moving obstacles as list of tuples (ax,bx,ay,by,radius)
+    Returns:
+      - obstacles(np.ndarray): The [x, y, radius] of the static obstacles followed by the moving
+                               obstacles [(n_runs x) n_steps x n_obs x 3]
+    """
+    times = np.asarray(times, dtype=float)
+    obstacles = np.zeros(times.shape + (len(obs) + len(moving_obs), 3))
+    if len(obs) > 0:
+        obstacles[..., :len(obs), :] = np.array(obs)
+    if len(moving_obs) > 0:
+        ax, bx, ay, by, r_obs = np.array(moving_obs).T
+        t = times[..., np.newaxis]
+        obstacles[..., len(obs):, 0] = ax*t + bx
+        obstacles[..., len(obs):, 1] = ay*t + by
+        obstacles[..., len(obs):, 2] = r_obs
+    return obstacles
+
+
+def get_distances(X, obstacles):
+    """Computes the distance between the robot and each obstacle center.
+
+    Inputs:
+      - X(np.ndarray):         The states [n_runs x n_steps x 3]
+      - obstacles(np.ndarray): The obstacles as returned by get_obstacle_positions
+    Returns:
+      - distances(np.ndarray): The distances [n_runs x n_steps x n_obs]
+    """
+    return np.hypot(X[..., np.newaxis, 0] - obstacles[..., 0], X[..., np.newaxis, 1] - obstacles[..., 1])
+
+
+def get_robot_distances(X):
+    """Computes the distance between the centers of each pair of robots of a fleet.
+
+    Inputs:
+      - X(np.ndarray): The states of the robots [n_robots x n_steps x 3]
+    Returns:
+      - distances(np.ndarray): The distances [n_steps x n_robots x n_robots] (inf on the diagonal)
+    """
+    positions = np.asarray(X, dtype=float)[..., :2].transpose(1, 0, 2)
+    distances = np.linalg.norm(positions[:, :, np.newaxis] - positions[:, np.newaxis], axis=-1)
+    distances[:, np.arange(len(X)), np.arange(len(X))] = np.inf
+    return distances
+
+
+def get_cbf_values(distances, obstacles, r, safety_dist):
+    """Computes the Control Barrier Function of each obstacle, as MPC.h.
+
+    Inputs:
+      - distances(np.ndarray): The distances from the obstacle centers [n_runs x n_steps x n_obs]
+      - obstacles(np.ndarray): The obstacles as returned by get_obstacle_positions
+      - r(float):              The robot radius
+      - safety_dist(float):    The safety distance
+    Returns:
+      - h(np.ndarray): The CBF values [n_runs x n_steps x n_obs]
+    """
+    return distances**2 - (r + obstacles[..., 2] + safety_dist)**2
+
+
+def get_time_to_goal(X, times, goal, goal_tol):
+    """Finds the first time that each run is within goal_tol of the goal position (NaN if never).
+
+    Inputs:
+      - X(np.ndarray):     The states [n_runs x n_steps x 3]
+      - times(np.ndarray): The times [s], shared [n_steps] or per run [n_runs x n_steps]
+      - goal(list):        The goal pose
+      - goal_tol(float):   The distance from the goal that counts as reached [m]
+    Returns:
+      - time_to_goal(np.ndarray): The time the goal is reached [s] [n_runs]
+    """
+    reached = np.hypot(X[..., 0] - goal[0], X[..., 1] - goal[1]) < goal_tol
+    times = np.broadcast_to(times, reached.shape)
+    first = np.argmax(reached, axis=1)
+    return np.where(np.any(reached, axis=1), times[np.arange(len(X)), first], np.nan)
+
+
+def analyze_runs(X, times, obs=(), moving_obs=(), r=0.0, safety_dist=0.0, aux=None, goal=None, goal_tol=0.05):
+    """Computes the metrics of a batch of closed-loop runs in one vectorized pass.
+
+    The runs may be padded with NaN at the end (see stack_runs), which the metrics ignore.
+
+    Inputs:
+      - X(np.ndarray):       The states [n_runs x n_steps x 3]
+      - times(np.ndarray):   The times [s], shared [n_steps] or per run [n_runs x n_steps]
+      - obs(list):           Static obstacles as list of tuples (x,y,radius)
+      - moving_obs(list):    Moving obstacles as list of tuples (ax,bx,ay,by,radius)
+      - r(float):            The robot radius
+      - safety_dist(float):  The safety distance
+      - aux(np.ndarray):     The auxiliary expressions of the runs, with the state cost in column 1
+                             [n_runs x n_steps x n_aux] (optional)
+      - goal(list):          The goal pose, for the time to goal (optional)
+      - goal_tol(float):     The distance from the goal that counts as reached [m]
+    Returns:
+      - metrics(dict): With the keys
+          - total_cost [n_runs]:                Sum of the state cost (only with aux)
+          - distances [n_runs x n_steps x n_obs]: Distance from each obstacle center
+          - clearance [n_runs x n_steps x n_obs]: Distance between the robot and each obstacle boundary
+          - h [n_runs x n_steps x n_obs]:       CBF values
+          - min_clearance [n_runs]:             Smallest clearance from any obstacle (NaN without obstacles)
+          - min_h [n_runs]:                     Smallest CBF value (NaN without obstacles)
+          - violations [n_runs]:                Number of steps where the CBF of some obstacle is negative
+          - max_violation [n_runs]:             Largest depth into the safety distance of an obstacle [m]
+          - collisions [n_runs]:                Number of steps where the robot overlaps an obstacle
+          - time_to_goal [n_runs]:              First time within goal_tol of the goal [s] (only with goal)
+    """
+    X = np.asarray(X, dtype=float)
+    n_runs = len(X)
+    obstacles = get_obstacle_positions(times, obs, moving_obs)
+    distances = get_distances(X, obstacles)
+    clearance = distances - obstacles[..., 2] - r
+    h = get_cbf_values(distances, obstacles, r, safety_dist)
+
+    metrics = {'distances': distances, 'clearance': clearance, 'h': h}
+    if distances.shape[-1] > 0:
+        with np.errstate(invalid='ignore'):  # Padded steps are NaN
+            metrics['min_clearance'] = np.nanmin(clearance.reshape(n_runs, -1), axis=1)
+            metrics['min_h'] = np.nanmin(h.reshape(n_runs, -1), axis=1)
+            metrics['violations'] = np.sum(np.any(h < 0, axis=2), axis=1)
+            metrics['max_violation'] = np.maximum(0, -np.nanmin((clearance - safety_dist).reshape(n_runs, -1), axis=1))
+            metrics['collisions'] = np.sum(np.any(clearance < 0, axis=2), axis=1)
+    else:
+        metrics['min_clearance'] = np.full(n_runs, np.nan)
+        metrics['min_h'] = np.full(n_runs, np.nan)
+        metrics['violations'] = np.zeros(n_runs, dtype=int)
+        metrics['max_violation'] = np.zeros(n_runs)
+        metrics['collisions'] = np.zeros(n_runs, dtype=int)
+    if aux is not None:
+        metrics['total_cost'] = np.nansum(np.asarray(aux, dtype=float)[..., 1], axis=1)
+    if goal is not None:
+        metrics['time_to_goal'] = get_time_to_goal(X, times, goal, goal_tol)
+    return metrics
+
+
+def analyze_controller(controller, goal_tol=0.05):
+    """Computes the metrics of the last simulation of a controller (see analyze_runs).
+
+    Inputs:
+      - controller(MPC):  The controller after the simulation
+      - goal_tol(float):  The distance from the goal that counts as reached [m]
+    Returns:
+      - metrics(dict): The metrics, with a first dimension of size 1 (one run)
+    """
+    data = controller.data
+    goal = controller.goal if controller.control_type == "setpoint" else None
+    return analyze_runs(data['_x'][np.newaxis], data['_time'].ravel(), controller.obs, controller.moving_obs,
+                        controller.r, controller.safety_dist, aux=data['_aux'][np.newaxis], goal=goal,
+                        goal_tol=goal_tol)
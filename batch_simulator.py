@@ -0,0 +1,123 @@
+import numpy as np
+
+import config
+
+
+class BatchSimulator:
+    """Simulates a batch of unicycle robots with vectorized NumPy operations.
+
+    The plant is the discrete model of MPC.get_sys_matrix_B:
+
+    x_{k+1} = x_k + B(x_k)*u_k*T_s + w_k
+
+    where w_k is optional additive process noise, drawn from a separate seeded generator
+    for each environment, so that each robot gets the same noise regardless of the batch size.
+    """
+    def __init__(self, n_envs, Ts=None, noise_std=0.0, seed=None):
+        """
+        Inputs:
+          - n_envs(int):                Number of environments (robots)
+          - Ts(float):                  Sampling time [s] (defaults to config.Ts)
+          - noise_std(float/np.ndarray): Standard deviation of the process noise (scalar or per state [3])
+          - seed(int):                  Seed for the noise generators of the environments
+        """
+        self.n_envs = n_envs
+        self.Ts = config.Ts if Ts is None else Ts
+        self.noise_std = np.broadcast_to(np.asarray(noise_std, dtype=float), (3,))
+        self.rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_envs)]
+        self.a = 1e-9                  # Same constant as in MPC.get_sys_matrix_B
+        self.x = np.zeros((n_envs, 3))
+        self.x_history = [self.x.copy()]
+        self.u_history = []
+
+    def get_env_simulator(self, i):
+        """Returns a simulator of the i-th environment alone, which draws the same noise as that environment.
+
+        Inputs:
+          - i(int): The environment
+        Returns:
+          - simulator(BatchSimulator): The simulator with a single environment
+        """
+        simulator = BatchSimulator(1, self.Ts, self.noise_std)
+        simulator.rngs = [self.rngs[i]]
+        return simulator
+
+    def reset(self, x0):
+        """Sets the initial state of all environments and clears the history.
+
+        Inputs:
+          - x0(np.ndarray): The initial state, shared [3] or per environment [n_envs x 3]
+        """
+        self.x = np.array(np.broadcast_to(np.asarray(x0, dtype=float).reshape(-1, 3), (self.n_envs, 3)))
+        self.x_history = [self.x.copy()]
+        self.u_history = []
+
+    def dynamics(self, x, u):
+        """Computes the next states of the batch.
+
+        Inputs:
+          - x(np.ndarray): The states [n_envs x 3]
+          - u(np.ndarray): The controls [n_envs x 2]
+        Returns:
+          - x_next(np.ndarray): The next states [n_envs x 3]
+        """
+        cos_theta = np.cos(x[:, 2])
+        sin_theta = np.sin(x[:, 2])
+        v = u[:, 0]
+        omega = u[:, 1]
+        x_dot = np.stack([v*cos_theta - self.a*omega*sin_theta,
+                          v*sin_theta + self.a*omega*cos_theta,
+                          omega], axis=1)
+        return x + x_dot*self.Ts
+
+    def make_step(self, u):
+        """Simulates one time step for all environments.
+
+        Inputs:
+          - u(np.ndarray): The controls [n_envs x 2]
+        Returns:
+          - x(np.ndarray): The new states [n_envs x 3]
+        """
+        u = np.asarray(u, dtype=float).reshape(self.n_envs, 2)
+        self.x = self.dynamics(self.x, u)
+        if np.any(self.noise_std > 0):
+            self.x += np.stack([rng.standard_normal(3) for rng in self.rngs])*self.noise_std
+        self.x_history.append(self.x.copy())
+        self.u_history.append(u.copy())
+        return self.x
+
+    @property
+    def states(self):
+        """The state history of all environments [n_envs x (steps+1) x 3]."""
+        return np.stack(self.x_history, axis=1)
+
+    @property
+    def controls(self):
+        """The control history of all environments [n_envs x steps x 2]."""
+        return np.stack(self.u_history, axis=1)
+
+
+def run_batch_simulation(controllers, plant, x0=None):
+    """Runs the closed loop of one controller per environment with a batched plant.
+
+    At each step every controller computes the input for its own robot and then
+    all robots are simulated at once.
+
+    Inputs:
+      - controllers(list):       One MPC controller for each environment
+      - plant(BatchSimulator):   The batched plant
+      - x0(np.ndarray):          The initial states [n_envs x 3] (optional, defaults to each controller's x0)
+    Returns:
+      - states(np.ndarray): The state history of all environments [n_envs x (steps+1) x 3]
+    """
+    if x0 is None:
+        x0 = np.stack([np.asarray(c.x0, dtype=float) for c in controllers])
+    plant.reset(x0)
+    for c in controllers:
+        c.telemetry = c.get_empty_telemetry()
+
+    x = plant.x
+    for k in range(controllers[0].sim_time):
+        u = np.hstack([c.make_step(x[i].reshape(-1, 1)) for i, c in enumerate(controllers)]).T
+        x = plant.make_step(u)
+    return plant.states
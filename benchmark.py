@@ -0,0 +1,356 @@
+"""Benchmark of the controllers over the scenarios, prediction horizons, controller types, gamma values and solvers.
+
+Each combination is simulated in closed loop and the build time, solve time percentiles, solver
+iterations, closed-loop cost and clearance from the obstacles are stored in a JSON file, which can be compared against the
+results of a previous version to catch regressions. The multi-robot coordinator is benchmarked separately
+against the fleet size (run_fleet_benchmark).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import time
+
+import numpy as np
+from casadi import CasadiMeta
+
+from analytics import analyze_controller, get_robot_distances
+import config
+from fleet import FleetCoordinator
+from util import get_controller
+
+# Input parameterizations compared by compare_input_parameterizations (for the default horizon of 20 stages)
+input_parameterizations = [{'input': "full"},
+                           {'input': "blocks 1-1-1-1-2-2-4-8", 'input_blocking': [1, 1, 1, 1, 2, 2, 4, 8]},
+                           {'input': "blocks 1-1-2-4-4-8", 'input_blocking': [1, 1, 2, 4, 4, 8]},
+                           {'input': "blocks 2x10", 'input_blocking': [2]*10},
+                           {'input': "spline 7", 'input_spline_knots': 7},
+                           {'input': "spline 4", 'input_spline_knots': 4}]
+
+
+def get_benchmark_cases(scenarios=(1, 2, 3, 4, 5, 6), horizons=(10, 20),
+                        controllers=("MPC-CBF", "MPC-DC", "LTV-MPC"), gammas=(None, 0.3), solvers=("nlp",)):
+    """Creates the list of benchmark cases.
+
+    Inputs:
+      - scenarios(tuple):   Scenarios of config.py
+      - horizons(tuple):    Prediction horizons
+      - controllers(tuple): Controller types
+      - gammas(tuple):      CBF parameters for the MPC-CBF and LTV-MPC (None: the value of the scenario)
+      - solvers(tuple):     Solvers ("nlp" or "rti")
+    Returns:
+      - cases(list): Dictionaries with the settings of each case
+    """
+    cases = []
+    for scenario in scenarios:
+        for T_horizon in horizons:
+            for controller in controllers:
+                for gamma in (gammas if controller != "MPC-DC" else [None]):
+                    for solver in solvers:
+                        cases.append({'scenario': scenario, 'T_horizon': T_horizon, 'controller': controller,
+                                      'gamma': gamma, 'solver': solver})
+    return cases
+
+
+def get_min_clearance(controller):
+    """Computes the smallest distance between the robot and the obstacles along the closed-loop path.
+
+    Inputs:
+      - controller(MPC): The controller after the simulation
+    Returns:
+      - min_clearance(float): Smallest distance between the boundaries [m] (None if there are no obstacles)
+    """
+    if not controller.obs and not controller.moving_obs:
+        return None
+    return float(analyze_controller(controller)['min_clearance'][0])
+
+
+def run_benchmark_case(case, sim_time=None):
+    """Runs the closed-loop simulation of a benchmark case and measures its performance.
+
+    Inputs:
+      - case(dict):     The settings of the case
+      - sim_time(int):  Number of simulation steps (None: the value of the scenario)
+    Returns:
+      - result(dict): The settings and measurements of the case
+    """
+    settings = {'scenario': case['scenario'], 'T_horizon': case['T_horizon'], 'controller': case['controller'],
+                'solver': case.get('solver', "nlp")}
+    if case['gamma'] is not None:
+        settings['gamma'] = case['gamma']
+    for key in ['input_blocking', 'input_spline_knots']:
+        if case.get(key) is not None:
+            settings[key] = case[key]
+    if sim_time is not None:
+        settings['sim_time'] = sim_time
+    cfg = config.get_config(**settings)
+
+    controller = get_controller(cfg)
+    controller.run_simulation()
+
+    summary = controller.get_telemetry_summary()
+    telemetry = controller.get_telemetry()
+    result = dict(case)
+    result.update({'gamma_value': cfg.gamma if case['controller'] != "MPC-DC" else None,
+                   'sim_time': cfg.sim_time,
+                   'build_time': controller.build_time,
+                   'n_variables': controller.n_opt_vars,
+                   'solve_time_p50': summary['p50'],
+                   'solve_time_p95': summary['p95'],
+                   'solve_time_p99': summary['p99'],
+                   'solve_time_max': summary['max'],
+                   'solver_time_p50': float(np.nanpercentile(telemetry['t_solver'], 50)),
+                   'solver_time_max': float(np.nanmax(telemetry['t_solver'])),
+                   'iter_mean': float(np.mean(telemetry['iter_count'])),
+                   'iter_max': int(np.max(telemetry['iter_count'])),
+                   'failures': summary['failures'],
+                   'deadline_misses': summary['deadline_misses'],
+                   'fallbacks': summary['fallbacks'],
+                   'unsafe_fallbacks': summary['unsafe_fallbacks'],
+                   'min_slack': float(np.nanmin(telemetry['min_slack'])) if controller.n_obs_slots > 0 else None,
+                   'min_clearance': get_min_clearance(controller),
+                   'closed_loop_cost': float(np.sum(controller.data['_aux', 'cost']))})
+    return result
+
+
+def run_benchmark(filename='results/benchmark.json', cases=None, sim_time=None, n_workers=None):
+    """Runs all benchmark cases on a pool of worker processes and stores the results.
+
+    The workers share the CPUs, so for solve times comparable across machines use n_workers=1
+    or fewer workers than physical cores.
+
+    Inputs:
+      - filename(str):  The JSON file for the results
+      - cases(list):    The benchmark cases (defaults to get_benchmark_cases())
+      - sim_time(int):  Number of simulation steps (None: the value of each scenario)
+      - n_workers(int): Number of worker processes (defaults to the number of CPUs)
+    Returns:
+      - results(list): The results of each case
+    """
+    import do_mpc
+    if cases is None:
+        cases = get_benchmark_cases()
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(run_benchmark_case, cases, [sim_time]*len(cases)))
+
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'casadi': CasadiMeta.version(),
+            'do_mpc': do_mpc.__version__,
+            'Ts': config.Ts}
+    with open(filename, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+    return results
+
+
+def compare_benchmarks(baseline_filename, filename, tolerance=0.2):
+    """Compares two benchmark files and prints the cases that got worse.
+
+    A case is reported if its p95 solve time or closed-loop cost increased by more than the
+    relative tolerance, or if it has more failed solves.
+
+    Inputs:
+      - baseline_filename(str): The benchmark file of the reference version
+      - filename(str):          The benchmark file of the new version
+      - tolerance(float):       Relative tolerance for the solve time and cost
+    Returns:
+      - regressions(list): (case, metric, baseline value, new value) for each regression
+    """
+    with open(baseline_filename) as f:
+        baseline = json.load(f)['results']
+    with open(filename) as f:
+        results = json.load(f)['results']
+
+    keys = ['scenario', 'T_horizon', 'controller', 'gamma']
+    baseline = {tuple(r[k] for k in keys) + (r.get('solver', "nlp"), r.get('input', "full")): r for r in baseline}
+    regressions = []
+    for r in results:
+        case = tuple(r[k] for k in keys) + (r.get('solver', "nlp"), r.get('input', "full"))
+        if case not in baseline:
+            continue
+        b = baseline[case]
+        for metric in ['solve_time_p95', 'closed_loop_cost']:
+            if r[metric] > (1 + tolerance)*b[metric]:
+                regressions.append((case, metric, b[metric], r[metric]))
+        if r['failures'] > b['failures']:
+            regressions.append((case, 'failures', b['failures'], r['failures']))
+
+    for case, metric, old, new in regressions:
+        print("Scenario {}, N={}, {}, gamma={}, solver={}, input={}: {} {:.4g} -> {:.4g}".format(*case, metric, old, new))
+    return regressions
+
+
+def compare_solvers(filename='results/benchmark_rti.json', scenarios=(1, 2, 3, 4, 5, 6), sim_time=None,
+                    n_workers=None):
+    """Compares the real-time iteration against the full NLP solution on the scenarios.
+
+    Inputs:
+      - filename(str):    The JSON file for the results
+      - scenarios(tuple): Scenarios of config.py
+      - sim_time(int):    Number of simulation steps (None: the value of each scenario)
+      - n_workers(int):   Number of worker processes (defaults to the number of CPUs)
+    Returns:
+      - results(list): The results of each case
+    """
+    cases = get_benchmark_cases(scenarios=scenarios, horizons=(config.T_horizon,), controllers=("MPC-CBF",),
+                                gammas=(None,), solvers=("nlp", "rti"))
+    results = run_benchmark(filename, cases, sim_time, n_workers)
+
+    print("Scenario  Solver  Solver time p50 [ms]  max [ms]  Iterations  Cost      Min clearance [m]")
+    for r in results:
+        clearance = "-" if r['min_clearance'] is None else "{:.4f}".format(r['min_clearance'])
+        print("{:<9} {:<7} {:<21.3f} {:<9.3f} {:<11.2f} {:<9.1f} {}".format(
+            r['scenario'], r['solver'], 1000*r['solver_time_p50'], 1000*r['solver_time_max'], r['iter_mean'],
+            r['closed_loop_cost'], clearance))
+    return results
+
+
+def compare_latency(filename='results/benchmark_latency.json', scenarios=(1, 2, 3, 4, 5, 6),
+                    controllers=("MPC-CBF", "LTV-MPC", "CBF-QP"), sim_time=None, n_workers=None):
+    """Compares the latency of the CBF-QP safety filter against the MPC controllers on the scenarios.
+
+    Inputs:
+      - filename(str):      The JSON file for the results
+      - scenarios(tuple):   Scenarios of config.py
+      - controllers(tuple): Controller types
+      - sim_time(int):      Number of simulation steps (None: the value of each scenario)
+      - n_workers(int):     Number of worker processes (defaults to the number of CPUs)
+    Returns:
+      - results(list): The results of each case
+    """
+    cases = get_benchmark_cases(scenarios=scenarios, horizons=(config.T_horizon,), controllers=controllers,
+                                gammas=(None,))
+    results = run_benchmark(filename, cases, sim_time, n_workers)
+
+    print("Scenario  Controller  Step p50 [ms]  p99 [ms]  max [ms]  Failures  Cost      Min clearance [m]")
+    for r in results:
+        clearance = "-" if r['min_clearance'] is None else "{:.4f}".format(r['min_clearance'])
+        print("{:<9} {:<11} {:<14.3f} {:<9.3f} {:<9.3f} {:<9} {:<9.1f} {}".format(
+            r['scenario'], r['controller'], 1000*r['solve_time_p50'], 1000*r['solve_time_p99'],
+            1000*r['solve_time_max'], r['failures'], r['closed_loop_cost'], clearance))
+    return results
+
+
+def get_fleet_positions(n_robots, spacing=0.5, offset=0.2):
+    """Places the robots on a circle with their goals on the opposite side, so the fleet crosses in the middle.
+
+    Inputs:
+      - n_robots(int):  Number of robots
+      - spacing(float): Smallest distance between neighboring robots on the circle [m]
+      - offset(float):  Angle by which the goals are rotated from the opposite points, to break the symmetry [rad]
+    Returns:
+      - x0(np.ndarray):    The initial poses [n_robots x 3]
+      - goals(np.ndarray): The goal poses [n_robots x 3]
+    """
+    radius = max(1.0, n_robots*spacing/(2*np.pi))
+    angles = 2*np.pi*np.arange(n_robots)/n_robots
+    goal_angles = angles + np.pi + offset
+    headings = np.arctan2(np.sin(goal_angles) - np.sin(angles), np.cos(goal_angles) - np.cos(angles))
+    x0 = np.stack([radius*np.cos(angles), radius*np.sin(angles), headings], axis=1)
+    goals = np.stack([radius*np.cos(goal_angles), radius*np.sin(goal_angles), headings], axis=1)
+    return x0, goals
+
+
+def run_fleet_benchmark(filename='results/benchmark_fleet.json', fleet_sizes=(2, 4, 8, 16, 32), sim_time=50,
+                        n_workers=None, n_neighbors=4, **settings):
+    """Measures the wall time per step of the multi-robot coordinator against the fleet size.
+
+    Inputs:
+      - filename(str):      The JSON file for the results
+      - fleet_sizes(tuple): Numbers of robots
+      - sim_time(int):      Number of simulation steps
+      - n_workers(int):     Number of worker processes (defaults to the number of CPUs)
+      - n_neighbors(int):   Number of nearest other robots that each robot avoids (None: all)
+      - settings:           Settings of the controllers, e.g. T_horizon=10
+    Returns:
+      - results(list): The results of each fleet size
+    """
+    import do_mpc
+    settings = dict({'static_obstacles_on': False, 'moving_obstacles_on': False}, **settings)  # Only the robots
+    results = []
+    for n_robots in fleet_sizes:
+        x0, goals = get_fleet_positions(n_robots)
+        with FleetCoordinator(x0, goals, n_workers, n_neighbors, **settings) as fleet:
+            states = fleet.run_simulation(sim_time)
+            telemetry = fleet.get_telemetry()
+        step_times = np.array(fleet.step_times)
+        solve_times = np.concatenate([t['t_wall'] for t in telemetry])
+        separation = np.min(get_robot_distances(states), axis=(1, 2)) - 2*np.max(fleet.radii)
+        results.append({'n_robots': n_robots,
+                        'n_workers': fleet.n_workers,
+                        'n_neighbors': fleet.n_neighbors,
+                        'sim_time': sim_time,
+                        'build_time': fleet.build_time,
+                        'step_time_p50': float(np.percentile(step_times, 50)),
+                        'step_time_p95': float(np.percentile(step_times, 95)),
+                        'step_time_max': float(np.max(step_times)),
+                        'step_time_per_robot': float(np.percentile(step_times, 50))/n_robots,
+                        'solve_time_p50': float(np.percentile(solve_times, 50)),
+                        'fallbacks': int(sum(np.sum(t['fallback']) for t in telemetry)),
+                        'unsafe_fallbacks': int(sum(np.sum(t['unsafe_fallback']) for t in telemetry)),
+                        'min_separation': float(np.min(separation)),
+                        'collisions': int(np.sum(separation < 0))})
+
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'casadi': CasadiMeta.version(),
+            'do_mpc': do_mpc.__version__,
+            'cpus': os.cpu_count()}
+    with open(filename, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+    print("Robots  Workers  Build [s]  Step p50 [ms]  p95 [ms]  Per robot [ms]  Fallbacks  Min separation [m]")
+    for r in results:
+        print("{:<7} {:<8} {:<10.2f} {:<14.1f} {:<9.1f} {:<15.2f} {:<10} {:.4f}".format(
+            r['n_robots'], r['n_workers'], r['build_time'], 1000*r['step_time_p50'], 1000*r['step_time_p95'],
+            1000*r['step_time_per_robot'], r['fallbacks'], r['min_separation']))
+    return results
+
+
+def compare_input_parameterizations(filename='results/benchmark_inputs.json', parameterizations=None,
+                                    scenarios=(1, 2, 3, 4, 5, 6), horizons=(config.T_horizon,), sim_time=None,
+                                    n_workers=None, plot_filename='images/input_parameterization_tradeoff.png'):
+    """Compares the solve time and the closed-loop cost of the MPC-CBF with reduced input parameterizations.
+
+    The move blocking patterns and piecewise linear (spline) inputs have fewer decision variables than
+    one input per stage, but the CBF constraints are still imposed over the whole horizon. The cost of
+    each parameterization is compared against the full parameterization of the same scenario and horizon.
+
+    Inputs:
+      - filename(str):           The JSON file for the results
+      - parameterizations(list): The settings of each parameterization, with its name as 'input'
+                                 (defaults to input_parameterizations)
+      - scenarios(tuple):        Scenarios of config.py
+      - horizons(tuple):         Prediction horizons
+      - sim_time(int):           Number of simulation steps (None: the value of each scenario)
+      - n_workers(int):          Number of worker processes (defaults to the number of CPUs)
+      - plot_filename(str):      The output file of the trade-off plot (None: no plot)
+    Returns:
+      - results(list): The results of each case
+    """
+    if parameterizations is None:
+        parameterizations = input_parameterizations
+    cases = [dict(case, **parameterization)
+             for case in get_benchmark_cases(scenarios=scenarios, horizons=horizons, controllers=("MPC-CBF",),
+                                             gammas=(None,))
+             for parameterization in parameterizations]
+    results = run_benchmark(filename, cases, sim_time, n_workers)
+
+    full = {(r['scenario'], r['T_horizon']): r for r in results if r['input'] == "full"}
+    print("Scenario  N    Input                    Variables  Solver p50 [ms]  p95 [ms]  Iterations  Cost      "
+          "Cost change  Failures")
+    for r in results:
+        reference = full.get((r['scenario'], r['T_horizon']))
+        change = "-" if reference is None else "{:+.1f}%".format(
+            100*(r['closed_loop_cost']/reference['closed_loop_cost'] - 1))
+        print("{:<9} {:<4} {:<24} {:<10} {:<16.3f} {:<9.3f} {:<11.2f} {:<9.1f} {:<12} {}".format(
+            r['scenario'], r['T_horizon'], r['input'], r['n_variables'], 1000*r['solver_time_p50'],
+            1000*r['solve_time_p95'], r['iter_mean'], r['closed_loop_cost'], change, r['failures']))
+    if plot_filename is not None:
+        from plotter import plot_input_parameterization_tradeoff  # The plotting libraries are only imported for plots
+        import matplotlib.pyplot as plt
+        plt.close(plot_input_parameterization_tradeoff(results, plot_filename))
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -1,5 +1,8 @@
 """Configurations for the MPC controller."""
 
+from dataclasses import dataclass, fields
+from typing import Any
+
 import numpy as np
 
 sim_time = 200                             # Total simulation time steps
@@ -14,8 +17,28 @@ x0 = np.array([0, 0, 0])                   # Initial state
 v_limit = 0.26                             # Linear velocity limit
 omega_limit = 1.8                          # Angular velocity limit
 
+# Solver
+compile_nlp = False                        # Whether to generate and compile C code for the NLP (needs gcc)
+nlp_cache_dir = 'nlp_cache/'               # Directory for the compiled NLPs
+warm_start = "last"                        # Initial guess at each step. Options: "last" (previous solution as is), "shift" (fewer iterations, but a different closed loop)
+                                           # The LTV-MPC always uses "shift" (its linearization point)
+warm_start_terminal = "rollout"            # Guess for the last stage when shifting. Options: "rollout", "repeat"
+solver = "nlp"                             # Options: "nlp" (IPOPT until convergence), "rti" (one SQP iteration per step)
+rti_qpsol = "qpoases"                      # QP solver of the RTI. Options: "qpoases", "qrqp", "osqp"
+rti_regularization = 1e-3                  # Regularization added to the Gauss-Newton Hessian of the RTI
+solver_options = None                      # IPOPT options that override the defaults, e.g. {'ipopt.linear_solver': 'ma27'}
+solver_profile = None                      # JSON file with IPOPT options found by tuning.py (None: default options)
+input_blocking = None                      # Stages of each block that shares one input, e.g. [1, 1, 2, 4, 4, 8] (None: no blocking)
+input_spline_knots = None                  # Knots of a piecewise linear input over the horizon (None: one input per stage)
+step_budget = None                         # Solver time budget of each step [s] (None: the sampling time Ts)
+solver_time_cap = False                    # Whether IPOPT stops at the time budget (results then depend on the machine)
+fallback = None                            # Input when the solver fails or runs over the budget. Options: "shift" (next input of
+                                           # the last feasible plan, or braking if it violates the CBF condition), "brake", None
+store_full_solution = True                 # Whether the mpc data keeps the full solution of each step (for the prediction plots)
+
 # Type of control
-controller = "MPC-CBF"                     # Options: "MPC-CBF", "MPC-DC"
+controller = "MPC-CBF"                     # Options: "MPC-CBF", "MPC-DC", "LTV-MPC" (CBF constraints linearized, QP),
+                                           # "CBF-QP" (safety filter of a nominal controller, no horizon)
 control_type = "setpoint"                  # Options: "setpoint", "traj_tracking"
 trajectory = "infinity"                    # Type of trajectory. Options: circular, infinity
 
@@ -28,10 +51,20 @@ R_sp = np.array([2, 0.5])                  # Controls cost matrix
 Q_tr = np.diag([200, 200, 0.005])          # State cost matrix
 R_tr = np.array([0.1, 0.001])              # Controls cost matrix
 
+# For the CBF-QP safety filter:
+k_v = 3.0                                  # Gain of the nominal linear velocity
+k_omega = 4.0                              # Gain of the nominal angular velocity
+goal_tol = 0.01                            # Distance to the goal below which the robot only turns to the goal orientation
+filter_weights = [1, 1e-3]                 # Weights of the deviations from the nominal linear and angular velocity
+filter_lookahead = 0.1                     # Distance of the point ahead of the robot that the barrier is defined for
+
 # Obstacles
 static_obstacles_on = True                 # Whether to have obstacles or not
 moving_obstacles_on = False                # Whether to have moving obstacles or not
 r = 0.1                                    # Robot radius (for obstacle avoidance)
+n_obs_slots = None                         # Number of obstacle slots in the solver (None: one per obstacle)
+n_nearest_obs = None                       # Static obstacles nearest to the predicted path to consider at each step (None: all)
+n_agent_slots = 0                          # Obstacle slots for the predicted paths of other robots (see fleet.py)
 
 # Define moving obstacles as list of tuples (ax,bx,ay,by,radius)
 # where each obstacle follows a linear trajectory x=ax*t+bx, y=ay*t+by
@@ -48,54 +81,188 @@ moving_obs = [(0.2, 0, 0, 0.6, 0.1),
 
 scenario = 1                               # Options: 1-6 or None
 
+# Settings that the scenarios change (restored before applying a scenario)
+_defaults = {'sim_time': sim_time, 'gamma': gamma, 'x0': x0, 'control_type': control_type,
+             'trajectory': trajectory, 'Q_tr': Q_tr, 'R_tr': R_tr, 'obs': [],
+             'static_obstacles_on': static_obstacles_on, 'moving_obstacles_on': moving_obstacles_on}
+
+# Settings that are derived from the type of control and the trajectory
+_derived = ['Q', 'R', 'A', 'w', 'x0']
+
+
+@dataclass(frozen=True)
+class Config:
+    """Frozen settings of one controller.
+
+    The controllers and the plotter read their settings from a Config object instead of the
+    module-level settings, so several controllers with different settings can live in the same
+    process. Create it with get_config().
+    """
+    scenario: Any
+    sim_time: int
+    Ts: float
+    T_horizon: int
+    gamma: float
+    safety_dist: float
+    x0: np.ndarray
+    v_limit: float
+    omega_limit: float
+    compile_nlp: bool
+    nlp_cache_dir: str
+    warm_start: str
+    warm_start_terminal: str
+    solver: str
+    rti_qpsol: str
+    rti_regularization: float
+    solver_options: Any
+    solver_profile: Any
+    input_blocking: Any
+    input_spline_knots: Any
+    step_budget: Any
+    solver_time_cap: bool
+    fallback: Any
+    store_full_solution: bool
+    controller: str
+    control_type: str
+    trajectory: str
+    goal: tuple
+    Q_sp: np.ndarray
+    R_sp: np.ndarray
+    Q_tr: np.ndarray
+    R_tr: np.ndarray
+    k_v: float
+    k_omega: float
+    goal_tol: float
+    filter_weights: tuple
+    filter_lookahead: float
+    static_obstacles_on: bool
+    moving_obstacles_on: bool
+    r: float
+    n_obs_slots: Any
+    n_nearest_obs: Any
+    n_agent_slots: int
+    moving_obs: tuple
+    obs: tuple
+    Q: np.ndarray
+    R: np.ndarray
+    A: Any
+    w: Any
+
+
+def get_config(**settings):
+    """Builds a frozen configuration without changing the module-level settings.
+
+    With a scenario, the configuration starts from the default settings and the scenario preset,
+    otherwise from the current module-level settings. The given settings are applied on top, and
+    the settings derived from the type of control (Q, R, A, w, x0) are updated, unless given.
+
+    Inputs:
+      - settings: Settings to change, e.g. scenario=4, gamma=0.2
+    Returns:
+      - cfg(Config): The configuration
+    """
+    values = {f.name: globals().get(f.name) for f in fields(Config)}
+    if 'scenario' in settings:
+        values.update(get_scenario_settings(settings['scenario']))
+    values.update(settings)
+    if 'scenario' in settings or any(key in settings for key in ['control_type', 'trajectory', 'Q_sp', 'R_sp',
+                                                                  'Q_tr', 'R_tr']):
+        derived = get_derived_settings(values)
+        values.update({key: value for key, value in derived.items() if key not in settings})
+    return Config(**{key: _freeze(value) for key, value in values.items()})
+
+
+def _freeze(value):
+    """Returns an immutable copy of a setting (tuples instead of lists and read-only arrays)."""
+    if isinstance(value, np.ndarray):
+        value = value.copy()
+        value.flags.writeable = False
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def get_scenario_settings(new_scenario):
+    """Returns the settings of a scenario (1-6 or None) on top of the default settings.
+
+    Inputs:
+      - new_scenario(int): The scenario
+    Returns:
+      - settings(dict): The settings that the scenario changes and the derived settings
+    """
+    settings = dict(_defaults)
+    settings['scenario'] = new_scenario
+
+    # ------------------------------------------------------------------------------
+    if new_scenario == 1:
+        settings['control_type'] = "setpoint"
+        settings['obs'] = [(1.0, 0.5, 0.1)]           # Define obstacles as list of tuples (x,y,radius)
+    elif new_scenario == 2:
+        settings['control_type'] = "setpoint"
+        settings['obs'] = [(0.5, 0.3, 0.1),
+                           (1.5, 0.7, 0.1)]           # Define obstacles as list of tuples (x,y,radius)
+    elif new_scenario == 3:
+        settings['control_type'] = "setpoint"
+        settings['obs'] = [(0.25, 0.2, 0.025),
+                           (0.75, 0.15, 0.1),
+                           (0.6, 0.6, 0.1),
+                           (1.7, 0.9, 0.15),
+                           (1.2, 0.6, 0.08)]          # Define obstacles as list of tuples (x,y,radius)
+    elif new_scenario == 4:
+        settings['control_type'] = "traj_tracking"
+        settings['trajectory'] = "circular"
+        settings['gamma'] = 0.1
+        settings['R_tr'] = np.array([0.1, 0.01])     # Controls cost matrix
+        settings['Q_tr'] = np.diag([800, 800, 2])    # State cost matrix
+        settings['obs'] = [(-0.2, 0.8, 0.1),
+                           (0.1, -0.8, 0.1)]          # Define obstacles as list of tuples (x,y,radius)
+    elif new_scenario == 5:
+        settings['control_type'] = "traj_tracking"
+        settings['trajectory'] = "infinity"
+        settings['static_obstacles_on'] = False
+    elif new_scenario == 6:
+        settings['control_type'] = "setpoint"
+        settings['static_obstacles_on'] = False
+        settings['moving_obstacles_on'] = True
+        settings['sim_time'] = 300
+        settings['gamma'] = 0.06
+
+    # ------------------------------------------------------------------------------
+    settings.update(get_derived_settings(dict(globals(), **settings)))
+    return settings
+
+
+def get_derived_settings(values):
+    """Returns the cost matrices, trajectory parameters and initial state for the type of control.
+
+    Inputs:
+      - values(dict): The settings
+    Returns:
+      - derived(dict): The values of Q, R, A, w and x0
+    """
+    derived = {'Q': None, 'R': None, 'A': None, 'w': None, 'x0': values['x0']}
+    if values['control_type'] == "setpoint":
+        derived['Q'] = values['Q_sp']
+        derived['R'] = values['R_sp']
+    elif values['control_type'] == "traj_tracking":
+        derived['Q'] = values['Q_tr']
+        derived['R'] = values['R_tr']
+        if values['trajectory'] == "circular":
+            derived['A'] = 0.8                        # Amplitude
+            derived['w'] = 0.3                        # Angular frequency
+        elif values['trajectory'] == "infinity":
+            derived['A'] = 1.0                        # Amplitude
+            derived['w'] = 0.3                        # Angular frequency
+            derived['x0'] = np.array([1, 0, np.pi/2])  # Initial state
+    else:
+        raise ValueError("Please choose among the available options for the control type!")
+    return derived
+
+
+def set_scenario(new_scenario):
+    """Applies the settings of a scenario (1-6 or None) on top of the default settings."""
+    globals().update(get_scenario_settings(new_scenario))
+
 
-# ------------------------------------------------------------------------------
-if scenario == 1:
-    control_type = "setpoint"
-    obs = [(1.0, 0.5, 0.1)]               # Define obstacles as list of tuples (x,y,radius)
-elif scenario == 2:
-    control_type = "setpoint"
-    obs = [(0.5, 0.3, 0.1),
-           (1.5, 0.7, 0.1)]               # Define obstacles as list of tuples (x,y,radius)
-elif scenario == 3:
-    control_type = "setpoint"
-    obs = [(0.25, 0.2, 0.025),
-           (0.75, 0.15, 0.1),
-           (0.6, 0.6, 0.1),
-           (1.7, 0.9, 0.15),
-           (1.2, 0.6, 0.08)]               # Define obstacles as list of tuples (x,y,radius)
-elif scenario == 4:
-    control_type = "traj_tracking"
-    trajectory = "circular"
-    gamma = 0.1
-    R_tr = np.array([0.1, 0.01])        # Controls cost matrix
-    Q_tr = np.diag([800, 800, 2])    # State cost matrix
-    obs = [(-0.2, 0.8, 0.1),
-           (0.1, -0.8, 0.1)]               # Define obstacles as list of tuples (x,y,radius)
-elif scenario == 5:
-    control_type = "traj_tracking"
-    trajectory = "infinity"
-    static_obstacles_on = False
-elif scenario == 6:
-    control_type = "setpoint"
-    static_obstacles_on = False
-    moving_obstacles_on = True
-    sim_time = 300
-    gamma = 0.06
-
-# ------------------------------------------------------------------------------
-if control_type == "setpoint":
-    Q = Q_sp
-    R = R_sp
-elif control_type == "traj_tracking":
-    Q = Q_tr
-    R = R_tr
-    if trajectory == "circular":
-        A = 0.8                            # Amplitude
-        w = 0.3                            # Angular frequency
-    elif trajectory == "infinity":
-        A = 1.0                            # Amplitude
-        w = 0.3                            # Angular frequency
-        x0 = np.array([1, 0, np.pi/2])     # Initial state
-else:
-    raise ValueError("Please choose among the available options for the control type!")
+set_scenario(scenario)
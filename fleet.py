@@ -0,0 +1,216 @@
+"""Multi-robot mode: one controller per robot, coordinated through their predicted paths.
+
+At each step, every robot avoids the latest predicted paths of the other robots (the ones of the
+previous step) as moving obstacles in its CBF constraints, so the robots solve their problems
+independently of each other. The controllers live on a pool of worker processes, each of which owns
+a fixed shard of the robots, and the fleet is simulated with one batched plant.
+"""
+
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from batch_simulator import BatchSimulator
+import config
+from util import get_controller
+
+
+class FleetCoordinator:
+    """Closed-loop simulation of a fleet of robots, each with its own controller.
+
+    The worker processes keep their controllers for the whole simulation, so at each step only the
+    states and the predicted paths of the fleet are sent to them and the inputs and the new
+    predicted paths are sent back. Each robot avoids its n_neighbors nearest other robots, which
+    keeps the size of each problem independent of the fleet size. The results do not depend on the
+    number of workers.
+    """
+    def __init__(self, x0, goals, n_workers=None, n_neighbors=None, **settings):
+        """
+        Inputs:
+          - x0(np.ndarray):    The initial pose of each robot [n_robots x 3]
+          - goals(np.ndarray): The goal pose of each robot [n_robots x 3]
+          - n_workers(int):    Number of worker processes (defaults to the number of CPUs, 0: solve in this process)
+          - n_neighbors(int):  Number of nearest other robots that each robot avoids (None: all)
+          - settings:          Settings of the controllers, e.g. T_horizon=10, static_obstacles_on=False
+        """
+        self.x0 = np.array(x0, dtype=float).reshape(-1, 3)
+        self.goals = np.array(goals, dtype=float).reshape(-1, 3)
+        self.n_robots = len(self.x0)
+        self.n_neighbors = self.n_robots - 1 if n_neighbors is None else min(n_neighbors, self.n_robots - 1)
+        self.cfgs = [config.get_config(x0=pose, goal=tuple(goal), n_agent_slots=self.n_neighbors, **settings)
+                     for pose, goal in zip(self.x0, self.goals)]
+        if self.cfgs[0].control_type != "setpoint":
+            raise ValueError("The fleet only supports set point control!")
+        self.Ts = self.cfgs[0].Ts
+        self.sim_time = self.cfgs[0].sim_time
+        self.radii = np.array([cfg.r for cfg in self.cfgs])  # Radius of each robot
+        self.plant = BatchSimulator(self.n_robots, Ts=self.Ts)
+
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        self.n_workers = min(n_workers, self.n_robots)
+        self.shards = np.array_split(np.arange(self.n_robots), max(self.n_workers, 1))  # Robots of each worker
+        self.controllers = None  # The controllers, if they are in this process
+        self.workers = []
+        self.connections = []
+        t_start = time.perf_counter()
+        if self.n_workers == 0:
+            self.controllers = [get_controller(cfg) for cfg in self.cfgs]
+            paths = [c.get_predicted_path() for c in self.controllers]
+        else:
+            for shard in self.shards:
+                connection, worker_connection = multiprocessing.Pipe()
+                worker = multiprocessing.Process(target=run_fleet_worker, daemon=True,
+                                                 args=(worker_connection, shard, [self.cfgs[i] for i in shard]))
+                worker.start()
+                worker_connection.close()
+                self.workers.append(worker)
+                self.connections.append(connection)
+            paths = [path for connection in self.connections for path in self.receive(connection)]
+        self.build_time = time.perf_counter() - t_start  # Time to build all controllers [s]
+
+        self.paths = np.stack(paths)  # Latest predicted positions of each robot [n_robots x (N+1) x 2]
+        self.paths_t0 = 0             # Time of the first predicted positions [s]
+        self.t = 0                    # Current time [s]
+        self.step_times = []          # Wall time of each fleet step [s]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def receive(connection):
+        """Receives the answer of a worker, raising the worker's exception if it failed."""
+        answer = connection.recv()
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def request(self, name, args=None):
+        """Sends a request to all workers and returns the answers for all robots, in order."""
+        for connection in self.connections:
+            connection.send((name, args))
+        return [answer for connection in self.connections for answer in self.receive(connection)]
+
+    def make_step(self, x):
+        """Computes the inputs of all robots for their current states.
+
+        Inputs:
+          - x(np.ndarray): The current states [n_robots x 3]
+        Returns:
+          - u(np.ndarray): The inputs [n_robots x 2]
+        """
+        t_start = time.perf_counter()
+        args = (self.t, np.asarray(x, dtype=float), self.paths, self.paths_t0, self.radii, self.n_neighbors)
+        if self.controllers is not None:
+            results = [step_robot(c, i, *args) for i, c in enumerate(self.controllers)]
+        else:
+            results = self.request('step', args)
+        u = np.stack([u for u, _ in results])
+        self.paths = np.stack([path for _, path in results])
+        self.paths_t0 = self.t
+        self.t += self.Ts
+        self.step_times.append(time.perf_counter() - t_start)
+        return u
+
+    def run_simulation(self, sim_time=None):
+        """Runs the closed loop of the fleet (once per coordinator, the controllers are not reset).
+
+        Inputs:
+          - sim_time(int): Number of simulation steps (defaults to the sim_time setting)
+        Returns:
+          - states(np.ndarray): The state history of all robots [n_robots x (sim_time+1) x 3]
+        """
+        self.plant.reset(self.x0)
+        x = self.plant.x
+        for k in range(self.sim_time if sim_time is None else sim_time):
+            x = self.plant.make_step(self.make_step(x))
+        return self.plant.states
+
+    def get_telemetry(self):
+        """Returns the telemetry of each robot's controller (see MPC.get_telemetry)."""
+        if self.controllers is not None:
+            return [c.get_telemetry() for c in self.controllers]
+        return self.request('telemetry')
+
+    def close(self, timeout=5):
+        """Stops the worker processes and raises the first error a worker sent that was not received yet.
+
+        Inputs:
+          - timeout(float): Time to wait for each worker to stop before terminating it [s]
+        """
+        error = None
+        for connection in self.connections:
+            try:
+                # Pending answers, e.g. of the other workers when a request failed
+                while connection.poll():
+                    answer = connection.recv()
+                    if isinstance(answer, Exception) and error is None:
+                        error = answer
+                connection.send(('close', None))
+            except (BrokenPipeError, EOFError, OSError):
+                pass  # The worker already stopped
+            connection.close()
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.connections = []
+        self.workers = []
+        if error is not None:
+            raise error
+
+
+def step_robot(controller, i, t, x, paths, paths_t0, radii, n_neighbors):
+    """Computes the input of robot i, avoiding the predicted paths of its nearest other robots.
+
+    Inputs:
+      - controller(MPC):   The controller of the robot
+      - i(int):            The number of the robot
+      - t(float):          The current time [s]
+      - x(np.ndarray):     The current states of all robots [n_robots x 3]
+      - paths(np.ndarray): The latest predicted positions of all robots [n_robots x (N+1) x 2]
+      - paths_t0(float):   The time of the first predicted positions [s]
+      - radii(np.ndarray): The radius of each robot [n_robots]
+      - n_neighbors(int):  Number of nearest other robots to avoid
+    Returns:
+      - u(np.ndarray):    The input of the robot [2]
+      - path(np.ndarray): The new predicted positions of the robot [(N+1) x 2]
+    """
+    others = np.delete(np.arange(len(x)), i)
+    if len(others) > n_neighbors:
+        distances = np.hypot(x[others, 0] - x[i, 0], x[others, 1] - x[i, 1])
+        others = others[np.argsort(distances, kind='stable')[:n_neighbors]]
+    controller.set_agent_paths(paths[others], paths_t0, radii[others])
+    u = controller.make_step(x[i].reshape(-1, 1))
+    return np.ravel(u), controller.get_predicted_path()
+
+
+def run_fleet_worker(connection, robots, cfgs):
+    """Builds the controllers of a shard of the fleet and answers the coordinator's requests (runs in a worker process).
+
+    Inputs:
+      - connection(multiprocessing.connection.Connection): The connection to the coordinator
+      - robots(np.ndarray):                                The numbers of the robots of the shard
+      - cfgs(list):                                        The settings of each robot's controller
+    """
+    try:
+        controllers = [get_controller(cfg) for cfg in cfgs]
+        connection.send([c.get_predicted_path() for c in controllers])
+        while True:
+            name, args = connection.recv()
+            if name == 'step':
+                connection.send([step_robot(c, i, *args) for i, c in zip(robots, controllers)])
+            elif name == 'telemetry':
+                connection.send([c.get_telemetry() for c in controllers])
+            elif name == 'close':
+                break
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
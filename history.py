@@ -0,0 +1,81 @@
+import numpy as np
+
+
+class History:
+    """Closed-loop history with preallocated arrays, optionally bounded and decimated.
+
+    Each field (e.g. 'x', 'u', 'cost') is stored in a preallocated array of the given dtype. With
+    a capacity, the arrays are ring buffers that keep only the last `capacity` stored steps, so
+    that the memory stays constant for long or endless runs. Without a capacity, the arrays grow
+    by doubling. With a decimation d, only every d-th step is stored.
+    """
+    def __init__(self, fields, capacity=None, decimation=1, dtype=np.float32):
+        """
+        Inputs:
+          - fields(dict):      The shape of one step of each field, e.g. {'x': (3,), 'cost': ()}
+          - capacity(int):     Number of stored steps to keep (None: keep all)
+          - decimation(int):   Store every decimation-th step
+          - dtype(np.dtype):   Data type of the stored values
+        """
+        if capacity is not None and capacity < 1:
+            raise ValueError("The capacity of the history must be positive.")
+        self.fields = {name: tuple(shape) for name, shape in fields.items()}
+        self.capacity = capacity
+        self.decimation = decimation
+        self.dtype = dtype
+        size = 16 if capacity is None else capacity
+        self.arrays = {name: np.zeros((size,) + shape, dtype=dtype) for name, shape in self.fields.items()}
+        self.steps = np.zeros(size, dtype=np.int64)  # Step index of each stored entry
+        self.n_stored = 0                             # Number of entries stored since the start
+
+    def __len__(self):
+        """The number of entries in the history."""
+        if self.capacity is None:
+            return self.n_stored
+        return min(self.n_stored, self.capacity)
+
+    def append(self, step, **values):
+        """Stores the values of a step, if it is not skipped by the decimation.
+
+        Inputs:
+          - step(int): The step index
+          - values:    The value of each field
+        """
+        if step % self.decimation != 0:
+            return
+        if self.capacity is None and self.n_stored == len(self.steps):
+            self.grow()
+        i = self.n_stored if self.capacity is None else self.n_stored % self.capacity
+        for name, value in values.items():
+            self.arrays[name][i] = value
+        self.steps[i] = step
+        self.n_stored += 1
+
+    def grow(self):
+        """Doubles the size of the arrays of an unbounded history."""
+        size = 2*len(self.steps)
+        for name, array in self.arrays.items():
+            grown = np.zeros((size,) + array.shape[1:], dtype=self.dtype)
+            grown[:len(array)] = array
+            self.arrays[name] = grown
+        steps = np.zeros(size, dtype=np.int64)
+        steps[:len(self.steps)] = self.steps
+        self.steps = steps
+
+    def get_order(self):
+        """Returns the indices of the entries in chronological order."""
+        if self.capacity is None or self.n_stored <= self.capacity:
+            return np.arange(len(self))
+        return (np.arange(self.capacity) + self.n_stored) % self.capacity
+
+    def __getitem__(self, name):
+        """Returns the stored values of a field ('step' for the step indices) in chronological order [n x shape]."""
+        order = self.get_order()
+        if name == 'step':
+            return self.steps[order]
+        return self.arrays[name][order]
+
+    @property
+    def nbytes(self):
+        """The memory of the stored arrays [bytes]."""
+        return sum(array.nbytes for array in self.arrays.values()) + self.steps.nbytes
@@ -0,0 +1,255 @@
+import time
+
+import numpy as np
+from casadi import *
+from cvxopt import matrix, solvers, sparse, spmatrix
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.sparse.linalg import splu
+
+
+class LTVSolver:
+    """Convex QP solver for the linear time-varying (LTV) MPC.
+
+    The constraints of the MPC problem (unicycle dynamics and CBF conditions) are linearized
+    around the initial guess, i.e. the previous predicted trajectory shifted by one step (the
+    MPC always uses the shifted warm start for the LTV-MPC):
+
+    min 1/2*Δw^T*H*Δw + ∇f^T*Δw   over Δw
+    s.t.
+        lbg <= g(w_0) + J(w_0)*Δw <= ubg
+        lbx <= w_0 + Δw <= ubx
+
+    where w_0 is the initial guess. The cost is quadratic for set point control, while the heading
+    error of trajectory tracking makes its Hessian H indefinite, in which case H is convexified by
+    clipping its eigenvalues. The resulting sparse QP is solved with cvxopt and the solution
+    w_0 + Δw is returned.
+
+    By default the QP is condensed before solving it: the equality constraints (initial state and
+    dynamics) are eliminated by expressing the state variables through the inputs,
+    Δw = Δw_p + Z*v, which leaves a small dense QP in v with as many variables as inputs over the
+    horizon. The index sets of the constraints are computed once, and the state block of the
+    equality constraints is factorized as a sparse matrix, so each step only factorizes the
+    sparse dynamics and solves the small QP.
+
+    The solver is called like a CasADi nlpsol, so that it can replace the NLP solver of do-mpc.
+    """
+    def __init__(self, nlp, x_indices=None, condensed=True, min_eig=1e-6):
+        """
+        Inputs:
+          - nlp(dict):             The NLP of the MPC with the keys 'x', 'p', 'f', 'g'
+          - x_indices(np.ndarray): The indices of the state variables in w (needed for the condensed QP)
+          - condensed(bool):       Whether to eliminate the equality constraints before solving the QP
+          - min_eig(float):        Smallest eigenvalue of the Hessian, if it has to be convexified
+        """
+        w, p, f, g = nlp['x'], nlp['p'], nlp['f'], nlp['g']
+        H, grad_f = hessian(f, w)
+        J = jacobian(g, w)
+        self.qp_fun = Function('qp', [w, p], [H, grad_f, g, J])  # QP matrices at a linearization point
+        self.g_fun = Function('g', [w, p], [g])                  # Constraints of the solution
+        self.H_triplet = [np.array(i, dtype=int) for i in H.sparsity().get_triplet()]  # Sparsity patterns as (rows, cols)
+        self.J_triplet = [np.array(i, dtype=int) for i in J.sparsity().get_triplet()]
+        self.n_w = w.shape[0]
+        self.n_g = g.shape[0]
+        if condensed and x_indices is None:
+            raise ValueError("The condensed QP needs the indices of the state variables!")
+        self.x_indices = None if x_indices is None else np.ravel(x_indices).astype(int)
+        self.condensed = condensed
+        self.min_eig = min_eig
+        self.structure = None  # Index sets of the constraints for the last bounds (see get_structure)
+        self._stats = {}
+
+    def __call__(self, x0, lbx, ubx, lbg, ubg, p, lam_x0=None, lam_g0=None):
+        """Solves the QP linearized around the initial guess.
+
+        Inputs:
+          - x0(DM):         Initial guess (linearization point)
+          - lbx, ubx(DM):   Bounds of the optimization variables
+          - lbg, ubg(DM):   Bounds of the constraints
+          - p(DM):          Parameters
+          - lam_x0(DM):     Unused (interface of nlpsol)
+          - lam_g0(DM):     Unused (interface of nlpsol)
+        Returns:
+          - result(dict): Solution 'x', constraints 'g' and multipliers 'lam_x', 'lam_g'
+        """
+        t_start = time.perf_counter()
+        w0 = np.array(DM(x0)).ravel()
+        lbx, ubx = np.array(DM(lbx)).ravel(), np.array(DM(ubx)).ravel()
+        lbg, ubg = np.array(DM(lbg)).ravel(), np.array(DM(ubg)).ravel()
+        s = self.get_structure(lbx, ubx, lbg, ubg)
+        H, grad_f, g0, J = self.qp_fun(w0, p)
+        H_values = np.nan_to_num(np.array(H.nonzeros()).ravel())
+        J_values = np.array(J.nonzeros()).ravel()
+        g0 = np.array(g0).ravel()
+        q = np.nan_to_num(np.array(grad_f).ravel())  # The heading error is not differentiable on the reference
+
+        # Equality constraints A*Δw = b and inequality constraints G*Δw <= h (finite upper and lower bounds)
+        A_values = J_values[s['A_nz']]
+        b = lbg[s['i_eq']] - g0[s['i_eq']]
+        G_values = np.concatenate([s['G_sign']*J_values[s['G_nz']], s['G_box']])
+        h = np.concatenate([ubg[s['i_ub']] - g0[s['i_ub']], g0[s['i_lb']] - lbg[s['i_lb']],
+                            ubx[s['i_xub']] - w0[s['i_xub']], w0[s['i_xlb']] - lbx[s['i_xlb']]])
+
+        try:
+            if self.condensed:
+                solution = self.solve_condensed(s, H_values, q, G_values, h, A_values, b)
+            else:
+                solution = self.solve_sparse(s, H_values, q, G_values, h, A_values, b)
+        except (ValueError, ArithmeticError) as e:
+            # cvxopt stops on numerical errors, e.g. a singular KKT system: keep the initial guess
+            solution = {'x': np.zeros(self.n_w), 'y': np.zeros(len(b)), 'z': np.zeros(len(h)),
+                        'status': "error: {}".format(e), 'iterations': 0}
+
+        # Multipliers in the CasADi convention (positive for active upper bounds)
+        dw, z = solution['x'], solution['z']
+        n_ub, n_g_rows, n_xub = len(s['i_ub']), s['n_g_rows'], len(s['i_xub'])
+        lam_g = np.zeros(self.n_g)
+        lam_g[s['i_eq']] = solution['y']
+        lam_g[s['i_ub']] += z[:n_ub]
+        lam_g[s['i_lb']] -= z[n_ub:n_g_rows]
+        lam_x = np.zeros(self.n_w)
+        lam_x[s['i_xub']] += z[n_g_rows:n_g_rows+n_xub]
+        lam_x[s['i_xlb']] -= z[n_g_rows+n_xub:]
+
+        w = w0 + dw
+        self._stats = {'success': solution['status'] == 'optimal',
+                       'return_status': solution['status'],
+                       'iter_count': solution['iterations'],
+                       't_wall_total': time.perf_counter() - t_start}
+        return {'x': DM(w), 'g': self.g_fun(w, p), 'lam_x': DM(lam_x), 'lam_g': DM(lam_g)}
+
+    def get_structure(self, lbx, ubx, lbg, ubg):
+        """Computes the index sets and the sparsity of the QP constraints, which only change with the bounds.
+
+        The result is kept until the equality constraints or the finite bounds change.
+
+        Inputs:
+          - lbx, ubx(np.ndarray): Bounds of the optimization variables
+          - lbg, ubg(np.ndarray): Bounds of the constraints
+        Returns:
+          - structure(dict): The rows of each kind of constraint, and the rows, columns and nonzeros
+                             of the Jacobian (or the values of the bounds) of A and G
+        """
+        eq = lbg == ubg
+        masks = np.concatenate([eq, np.isfinite(lbg), np.isfinite(ubg), np.isfinite(lbx), np.isfinite(ubx)])
+        if self.structure is not None and np.array_equal(self.structure['masks'], masks):
+            return self.structure
+
+        i_eq = np.flatnonzero(eq)
+        i_ub = np.flatnonzero(~eq & np.isfinite(ubg))
+        i_lb = np.flatnonzero(~eq & np.isfinite(lbg))
+        i_xub = np.flatnonzero(np.isfinite(ubx))
+        i_xlb = np.flatnonzero(np.isfinite(lbx))
+        A_rows, A_cols, A_nz = self.get_rows(i_eq)
+        G_rows, G_cols, G_nz, G_sign = [], [], [], []
+        offset = 0
+        for sign, idx in [(1, i_ub), (-1, i_lb)]:
+            rows, cols, nz = self.get_rows(idx)
+            G_rows.append(offset + rows)
+            G_cols.append(cols)
+            G_nz.append(nz)
+            G_sign.append(sign*np.ones(len(nz)))
+            offset += len(idx)
+        n_g_rows = offset
+        G_box = []
+        for sign, idx in [(1, i_xub), (-1, i_xlb)]:
+            G_rows.append(offset + np.arange(len(idx)))
+            G_cols.append(idx)
+            G_box.append(sign*np.ones(len(idx)))
+            offset += len(idx)
+
+        structure = {'masks': masks, 'i_eq': i_eq, 'i_ub': i_ub, 'i_lb': i_lb, 'i_xub': i_xub, 'i_xlb': i_xlb,
+                     'A_rows': A_rows, 'A_cols': A_cols, 'A_nz': A_nz,
+                     'G_rows': np.concatenate(G_rows), 'G_cols': np.concatenate(G_cols),
+                     'G_nz': np.concatenate(G_nz), 'G_sign': np.concatenate(G_sign), 'G_box': np.concatenate(G_box),
+                     'n_g_rows': n_g_rows, 'n_G': offset}
+        if self.condensed:
+            if len(i_eq) != len(self.x_indices):
+                raise ValueError("The condensed QP needs one equality constraint (initial state or dynamics) per state variable!")
+            structure['u_indices'] = np.setdiff1d(np.arange(self.n_w), self.x_indices)
+        self.structure = structure
+        return structure
+
+    def solve_condensed(self, s, H_values, q, G_values, h, A_values, b):
+        """Solves the QP after eliminating its equality constraints.
+
+        With A = [A_x A_u] split into the state and the other (input) variables, the solutions of
+        A*Δw = b are Δw = Δw_p + Z*v with Δw_p = [A_x^-1*b; 0] and Z = [-A_x^-1*A_u; I], where A_x
+        (initial state and dynamics) is square, sparse and invertible. The QP is solved as a dense
+        QP in v, whose Hessian Z^T*P*Z is convexified if it is not positive definite.
+
+        Inputs:
+          - s(dict):              The structure of the QP (see get_structure)
+          - H_values(np.ndarray): The nonzeros of the Hessian P of the cost
+          - q(np.ndarray):        The gradient of the cost
+          - G_values(np.ndarray): The nonzeros of the inequality constraint matrix G
+          - h(np.ndarray):        The upper bounds of G*Δw
+          - A_values(np.ndarray): The nonzeros of the equality constraint matrix A
+          - b(np.ndarray):        The right-hand side of A*Δw = b
+        Returns:
+          - solution(dict): The step 'x', the multipliers 'y' (equality) and 'z' (inequality), the
+                            cvxopt 'status' and the number of 'iterations'
+        """
+        x_indices, u_indices = self.x_indices, s['u_indices']
+        A = csc_matrix((A_values, (s['A_rows'], s['A_cols'])), shape=(len(b), self.n_w))
+        P = csr_matrix((H_values, tuple(self.H_triplet)), shape=(self.n_w, self.n_w))
+        G = csr_matrix((G_values, (s['G_rows'], s['G_cols'])), shape=(s['n_G'], self.n_w))
+        A_x = splu(A[:, x_indices].tocsc())
+        Z = np.zeros((self.n_w, len(u_indices)))
+        Z[x_indices] = -A_x.solve(A[:, u_indices].toarray())
+        Z[u_indices] = np.eye(len(u_indices))
+        x_p = np.zeros(self.n_w)
+        x_p[x_indices] = A_x.solve(b)
+
+        solution = solvers.qp(matrix(self.get_convex(Z.T@(P@Z))), matrix(Z.T@(P@x_p + q)), matrix(G@Z),
+                              matrix(h - G@x_p), options={'show_progress': False})
+
+        # Recover the full step and the multipliers of the equality constraints from P*x + q + G^T*z + A^T*y = 0
+        x = x_p + Z@np.array(solution['x']).ravel()
+        z = np.array(solution['z']).ravel()
+        y = A_x.solve(-(P@x + q + G.T@z)[x_indices], trans='T')
+        return {'x': x, 'y': y, 'z': z, 'status': solution['status'], 'iterations': solution['iterations']}
+
+    def solve_sparse(self, s, H_values, q, G_values, h, A_values, b):
+        """Solves the full sparse QP with cvxopt (see solve_condensed for the inputs and outputs)."""
+        P = csr_matrix((H_values, tuple(self.H_triplet)), shape=(self.n_w, self.n_w))
+        A = spmatrix(A_values.tolist(), s['A_rows'].tolist(), s['A_cols'].tolist(), (len(b), self.n_w))
+        G = spmatrix(G_values.tolist(), s['G_rows'].tolist(), s['G_cols'].tolist(), (s['n_G'], self.n_w))
+        solution = solvers.qp(sparse(matrix(self.get_convex(P.toarray()))), matrix(q), G, matrix(h), A, matrix(b),
+                              options={'show_progress': False})
+        return {'x': np.array(solution['x']).ravel(), 'y': np.array(solution['y']).ravel(),
+                'z': np.array(solution['z']).ravel(), 'status': solution['status'],
+                'iterations': solution['iterations']}
+
+    def get_convex(self, H):
+        """Returns the Hessian, convexified by clipping its eigenvalues if it is not positive definite.
+
+        Inputs:
+          - H(np.ndarray): The (dense) Hessian
+        Returns:
+          - H(np.ndarray): The (convexified) Hessian
+        """
+        try:
+            np.linalg.cholesky(H)
+            return H
+        except np.linalg.LinAlgError:
+            eig_values, eig_vectors = np.linalg.eigh(H)
+            return (eig_vectors*np.maximum(eig_values, self.min_eig))@eig_vectors.T
+
+    def get_rows(self, idx):
+        """Extracts the rows idx of the constraint Jacobian as triplets.
+
+        Inputs:
+          - idx(np.ndarray): The row indices
+        Returns:
+          - rows, cols(np.ndarray): The rows (numbered by their position in idx) and columns of the nonzeros
+          - nz(np.ndarray):         The positions of the nonzeros in the nonzeros of the Jacobian
+        """
+        J_rows, J_cols = self.J_triplet
+        position = -np.ones(self.n_g, dtype=int)
+        position[idx] = np.arange(len(idx))
+        nz = np.flatnonzero(position[J_rows] >= 0)
+        return position[J_rows][nz], J_cols[nz], nz
+
+    def stats(self):
+        """Statistics of the last solver call."""
+        return self._stats
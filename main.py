@@ -6,7 +6,7 @@ Date: Fall 2022
 
 import numpy as np
 
-from mpc_cbf import MPC
+import config
 from plotter import Plotter
 import util
 
@@ -15,15 +15,19 @@ def main():
     np.random.seed(99)
 
     # Define controller & run simulation
-    controller = MPC()
+    cfg = config.get_config()
+    controller = util.get_controller(cfg)
     controller.run_simulation()  # Closed-loop control simulation
+    util.print_telemetry_summary(controller)
 
     # Plots
-    plotter = Plotter(controller)
+    plotter = Plotter(controller, cfg)
     plotter.plot_results()
-    plotter.plot_predictions()
+    if cfg.controller != "CBF-QP":  # The safety filter has no predictions
+        plotter.plot_predictions()
     plotter.plot_path()
-    plotter.create_trajectories_animation()
+    if cfg.controller != "CBF-QP":
+        plotter.create_trajectories_animation()
     plotter.create_path_animation()
     plotter.plot_cbf()
 
@@ -0,0 +1,131 @@
+import numpy as np
+from casadi import *
+
+
+def get_blocking_matrix(N, blocks):
+    """Creates the matrix that maps the inputs of the blocks to the inputs of the stages (move blocking).
+
+    All stages of a block share the same input. The blocks cover the stages in order: blocks past the
+    horizon are cut and the last block is extended to the end of the horizon.
+
+    Inputs:
+      - N(int):       The prediction horizon
+      - blocks(list): The number of stages of each block, e.g. [1, 1, 2, 4, 4, 8]
+    Returns:
+      - M(np.ndarray): The weight of each block input in each stage input [N x n_blocks]
+    """
+    starts = np.cumsum([0] + list(blocks))
+    starts = starts[starts < N]
+    block = np.searchsorted(starts, np.arange(N), side='right') - 1
+    M = np.zeros((N, len(starts)))
+    M[np.arange(N), block] = 1
+    return M
+
+
+def get_spline_matrix(N, n_knots):
+    """Creates the matrix that maps the knot values of a piecewise linear input to the inputs of the stages.
+
+    The knots are spread evenly over the stages (the first and last knot at the first and last stage).
+    Each stage input is a convex combination of two knot values, so the input bounds hold for all
+    stages if they hold for the knots.
+
+    Inputs:
+      - N(int):       The prediction horizon
+      - n_knots(int): The number of knots (at least 2)
+    Returns:
+      - M(np.ndarray): The weight of each knot value in each stage input [N x n_knots]
+    """
+    knots = np.unique(np.round(np.linspace(0, N - 1, n_knots)).astype(int))
+    M = np.zeros((N, len(knots)))
+    for j in range(len(knots) - 1):
+        stages = np.arange(knots[j], knots[j+1] + 1)
+        weight = (stages - knots[j])/(knots[j+1] - knots[j])
+        M[stages, j] = 1 - weight
+        M[stages, j+1] = weight
+    return M
+
+
+class BlockedSolver:
+    """NLP solver with a reduced input parameterization for the MPC.
+
+    The inputs of the N stages are parameterized by fewer values z_u (block inputs or spline knots),
+    u = M*z_u, while the predicted states of all stages are kept, so the constraints (e.g. the CBF
+    conditions) are still imposed over the whole horizon. The NLP is solved over the reduced decision
+    variables z, with the full decision variables w = P*z, where P maps the reduced inputs to the
+    inputs of each stage and keeps all other variables.
+
+    The solver is called like a CasADi nlpsol with the full variables, so that it can replace the NLP
+    solver of do-mpc. The initial guess is projected onto the reduced variables (least squares).
+    """
+    def __init__(self, nlp, u_indices, M, opts=None):
+        """
+        Inputs:
+          - nlp(dict):             The NLP of the MPC with the keys 'x', 'p', 'f', 'g'
+          - u_indices(np.ndarray): The indices of the inputs of each stage in the decision variables [N x n_u]
+          - M(np.ndarray):         The weight of each reduced input in each stage input [N x n_reduced]
+          - opts(dict):            Options of the IPOPT solver
+        """
+        w, p, f, g = nlp['x'], nlp['p'], nlp['f'], nlp['g']
+        n_w = w.shape[0]
+        N, n_u = u_indices.shape
+        n_reduced = M.shape[1]
+        others = np.setdiff1d(np.arange(n_w), u_indices.ravel())
+
+        # Map P from the reduced variables [other variables, reduced inputs] to the full variables
+        rows, cols, values = list(others), list(range(len(others))), [1.0]*len(others)
+        for k in range(N):
+            for j in np.flatnonzero(M[k]):
+                for i in range(n_u):
+                    rows.append(u_indices[k, i])
+                    cols.append(len(others) + j*n_u + i)
+                    values.append(M[k, j])
+        self.n_z = len(others) + n_reduced*n_u  # Number of reduced decision variables
+        P = np.zeros((n_w, self.n_z))
+        P[rows, cols] = values
+        self.P = P
+        self.P_pinv = np.linalg.pinv(P)
+        self.P_sparse = DM.triplet(rows, cols, values, n_w, self.n_z)
+
+        z = type(w).sym('z', self.n_z)
+        nlp_fun = Function('nlp', [w, p], [f, g])
+        f_z, g_z = nlp_fun(mtimes(self.P_sparse, z), p)
+        self.S = nlpsol('S', 'ipopt', {'x': z, 'p': p, 'f': f_z, 'g': g_z}, {} if opts is None else opts)
+
+    def get_reduced_bounds(self, lbx, ubx):
+        """Finds the bounds of the reduced variables, which imply the bounds of all full variables they set."""
+        lbx, ubx = np.array(DM(lbx)).ravel(), np.array(DM(ubx)).ravel()
+        used = self.P != 0
+        lbz = np.max(np.where(used, lbx[:, np.newaxis], -np.inf), axis=0)
+        ubz = np.min(np.where(used, ubx[:, np.newaxis], np.inf), axis=0)
+        return lbz, ubz
+
+    def __call__(self, x0, lbx, ubx, lbg, ubg, p, lam_x0=None, lam_g0=None):
+        """Solves the NLP over the reduced variables.
+
+        Inputs:
+          - x0(DM):         Initial guess of the full variables
+          - lbx, ubx(DM):   Bounds of the full variables
+          - lbg, ubg(DM):   Bounds of the constraints
+          - p(DM):          Parameters
+          - lam_x0(DM):     Initial guess of the multipliers of the full variable bounds (optional)
+          - lam_g0(DM):     Initial guess of the multipliers of the constraints (optional)
+        Returns:
+          - result(dict): Solution 'x', constraints 'g' and multipliers 'lam_x', 'lam_g' of the full NLP
+        """
+        lbz, ubz = self.get_reduced_bounds(lbx, ubx)
+        z0 = np.clip(self.P_pinv@np.array(DM(x0)).ravel(), lbz, ubz)
+        kwargs = {'x0': z0, 'lbx': lbz, 'ubx': ubz, 'lbg': lbg, 'ubg': ubg, 'p': p}
+        if lam_x0 is not None:
+            kwargs['lam_x0'] = self.P.T@np.array(DM(lam_x0)).ravel()
+        if lam_g0 is not None:
+            kwargs['lam_g0'] = lam_g0
+        r = self.S(**kwargs)
+        return {'x': DM(self.P@np.array(r['x']).ravel()),
+                'f': r['f'],
+                'g': r['g'],
+                'lam_x': DM(self.P_pinv.T@np.array(r['lam_x']).ravel()),
+                'lam_g': r['lam_g']}
+
+    def stats(self):
+        """Returns the statistics of the last solve."""
+        return self.S.stats()
@@ -1,7 +1,17 @@
-import do_mpc
+from collections import deque
+import hashlib
+import inspect
+import json
+import os
+import subprocess
+import time
+
+import numpy as np
 from casadi import *
 
 import config
+from history import History
+from move_blocking import BlockedSolver, get_blocking_matrix, get_spline_matrix
 
 
 class MPC:
@@ -17,34 +27,88 @@ class MPC:
 
     where x'_k = x_{des_k} - x_k
     """
-    def __init__(self):
-        self.sim_time = config.sim_time          # Total simulation time steps
-        self.Ts = config.Ts                      # Sampling time
-        self.T_horizon = config.T_horizon        # Prediction horizon
-        self.x0 = config.x0                      # Initial pose
-        self.v_limit = config.v_limit            # Linear velocity limit
-        self.omega_limit = config.omega_limit    # Angular velocity limit
-        self.R = config.R                        # Controls cost matrix
-        self.Q = config.Q                        # State cost matrix
-        self.static_obstacles_on = config.static_obstacles_on  # Whether to have static obstacles
-        self.moving_obstacles_on = config.moving_obstacles_on  # Whether to have moving obstacles
-        if self.static_obstacles_on:
-            self.obs = config.obs                # Static Obstacles
-        if self.moving_obstacles_on:             # Moving obstacles
-            self.moving_obs = config.moving_obs
-        self.r = config.r                        # Robot radius
-        self.control_type = config.control_type  # "setpoint" or "traj_tracking"
+    # Methods that define the NLP expressions (their source is part of the problem hash)
+    formulation_methods = ['define_model', 'get_sys_matrix_B', 'get_cost_expression', 'define_mpc',
+                           'add_obstacle_constraints', 'add_cbf_constraints', 'get_cbf_constraints', 'h']
+
+    def __init__(self, cfg=None):
+        """
+        Inputs:
+          - cfg(config.Config): The settings (defaults to the current settings of the config module)
+        """
+        if cfg is None:
+            cfg = config.get_config()
+        self.cfg = cfg                           # Settings
+        self.sim_time = cfg.sim_time             # Total simulation time steps
+        self.Ts = cfg.Ts                         # Sampling time
+        self.T_horizon = cfg.T_horizon           # Prediction horizon
+        self.x0 = cfg.x0                         # Initial pose
+        self.v_limit = cfg.v_limit               # Linear velocity limit
+        self.omega_limit = cfg.omega_limit       # Angular velocity limit
+        self.R = cfg.R                           # Controls cost matrix
+        self.Q = cfg.Q                           # State cost matrix
+        self.static_obstacles_on = cfg.static_obstacles_on  # Whether to have static obstacles
+        self.moving_obstacles_on = cfg.moving_obstacles_on  # Whether to have moving obstacles
+        self.obs = cfg.obs if self.static_obstacles_on else []  # Static Obstacles
+        self.moving_obs = cfg.moving_obs if self.moving_obstacles_on else []  # Moving obstacles
+        self.n_nearest_obs = cfg.n_nearest_obs   # Number of nearest static obstacles to consider
+        self.obs_tree = self.get_obstacle_tree(self.obs)  # Spatial index of the static obstacles
+        self.n_agent_slots = cfg.n_agent_slots   # Number of obstacle slots for other robots
+        self.agent_paths = np.zeros((0, 1, 2))   # Predicted positions of the other robots
+        self.agent_radii = np.zeros(0)           # Radii of the other robots
+        self.agent_t0 = 0                        # Time of the first predicted position of the other robots
+        self.n_obs_slots = cfg.n_obs_slots       # Number of obstacle slots
+        if self.n_obs_slots is None:
+            self.n_obs_slots = self.get_n_active_static_obs(self.obs) + len(self.moving_obs) + self.n_agent_slots
+        self.check_obstacle_slots(self.obs, self.moving_obs)
+        self.r = cfg.r                           # Robot radius
+        self.control_type = cfg.control_type     # "setpoint" or "traj_tracking"
         if self.control_type == "setpoint":      # Go-to-goal
-            self.goal = config.goal              # Robot's goal pose
-        self.gamma = config.gamma                # CBF parameter
-        self.safety_dist = config.safety_dist    # Safety distance
-        self.controller = config.controller      # Type of control
+            self.goal = cfg.goal                 # Robot's goal pose
+        self.gamma = cfg.gamma                   # CBF parameter
+        self.safety_dist = cfg.safety_dist       # Safety distance
+        self.controller = cfg.controller         # Type of control
+        self.compile_nlp = cfg.compile_nlp       # Whether to use the compiled NLP
+        self.warm_start = cfg.warm_start         # Initial guess strategy between steps
+        if self.controller == "LTV-MPC":
+            self.warm_start = "shift"            # The LTV-MPC is linearized around the shifted prediction
+        self.warm_start_terminal = cfg.warm_start_terminal  # Last stage guess when shifting
+        self.solver = cfg.solver                 # "nlp" or "rti" (real-time iteration)
+        self.rti_qpsol = cfg.rti_qpsol           # QP solver of the real-time iteration
+        self.rti_regularization = cfg.rti_regularization  # Hessian regularization of the real-time iteration
+        self.solver_options = {}                 # IPOPT options that override the defaults
+        if cfg.solver_profile is not None:
+            self.solver_options.update(self.load_solver_profile(cfg.solver_profile))
+        if cfg.solver_options is not None:
+            self.solver_options.update(cfg.solver_options)
+        self.input_blocking = cfg.input_blocking  # Stages of each block that shares one input
+        self.input_spline_knots = cfg.input_spline_knots  # Knots of a piecewise linear input
+        self.step_budget = cfg.step_budget if cfg.step_budget is not None else self.Ts  # Solver time budget [s]
+        self.solver_time_cap = cfg.solver_time_cap  # Whether IPOPT stops at the time budget
+        self.fallback = cfg.fallback             # Input when the solver fails or runs over the budget
+        self.store_full_solution = cfg.store_full_solution  # Whether to store the solution of each step
+        self.telemetry = self.get_empty_telemetry()  # Solver statistics at each step
+        self.history = None                      # Closed-loop history of the last simulation (see simulate)
 
+        self.import_dependencies()  # Not part of the build time, the import is paid once per process
+        t_start = time.perf_counter()
+        self.build()
+        self.build_time = time.perf_counter() - t_start  # Time to build the problem [s]
+        self.n_resets = 0                                # Number of episodes that reused the problem
+        self.set_init_state()
+
+    @staticmethod
+    def import_dependencies():
+        """Imports do_mpc, which is only needed to build the problem (pre-built controllers start without it, see prebuilt.py)."""
+        import do_mpc
+
+    def build(self):
+        """Builds the model, the mpc controller, the simulator and the estimator."""
+        import do_mpc
         self.model = self.define_model()
         self.mpc = self.define_mpc()
         self.simulator = self.define_simulator()
         self.estimator = do_mpc.estimator.StateFeedback(self.model)
-        self.set_init_state()
 
     def define_model(self):
         """Configures the dynamical model of the system (and part of the objective function).
@@ -54,6 +118,7 @@ class MPC:
           - model(do_mpc.model.Model): The system model
         """
 
+        import do_mpc
         model_type = 'discrete'
         model = do_mpc.model.Model(model_type)
 
@@ -71,6 +136,7 @@ class MPC:
         # Set right-hand-side of ODE for all introduced states (_x).
         x_next = _x + B@_u*self.Ts
         model.set_rhs('x', x_next, process_noise=False)  # Set to True if adding noise
+        self.dynamics = Function('dynamics', [_x, _u], [x_next])
 
         # Optional: Define an expression, which represents the stage and terminal
         # cost of the control problem. This term will be later used as the cost in
@@ -79,11 +145,11 @@ class MPC:
         model, cost_expr = self.get_cost_expression(model)
         model.set_expression(expr_name='cost', expr=cost_expr)
 
-        # Moving obstacle (define time-varying parameter for its position)
-        if self.moving_obstacles_on is True:
-            for i in range(len(self.moving_obs)):
-                model.set_variable('_tvp', 'x_moving_obs'+str(i))
-                model.set_variable('_tvp', 'y_moving_obs'+str(i))
+        # Obstacles (define time-varying parameters [x, y, radius, active] and the position [x, y] at the
+        # next stage for each obstacle slot)
+        for i in range(self.n_obs_slots):
+            model.set_variable('_tvp', 'obs_slot'+str(i), shape=(4, 1))
+            model.set_variable('_tvp', 'obs_next'+str(i), shape=(2, 1))
 
         # Setup model
         model.setup()
@@ -118,8 +184,11 @@ class MPC:
         """
 
         if self.control_type == "setpoint":  # Go-to-goal
+            # Set goal as time-varying parameter, so it can change without rebuilding the solver
+            model.set_variable('_tvp', 'goal', shape=(3, 1))
+
             # Define state error
-            X = model.x['x'] - self.goal
+            X = model.x['x'] - model.tvp['goal']
         else:                                # Trajectory tracking
             # Set time-varying parameters for the objective function
             model.set_variable('_tvp', 'x_set_point')
@@ -142,6 +211,7 @@ class MPC:
           - mpc(do_mpc.model.MPC): The mpc controller
         """
 
+        import do_mpc
         mpc = do_mpc.controller.MPC(self.model)
 
         # Set parameters
@@ -149,9 +219,20 @@ class MPC:
                      'n_horizon': self.T_horizon,
                      't_step': self.Ts,
                      'state_discretization': 'discrete',
-                     'store_full_solution': True,
+                     'store_full_solution': self.store_full_solution,
                      # 'nlpsol_opts': {'ipopt.linear_solver': 'MA27'}
+                     'nlpsol_opts': {}
                      }
+        if self.solver_time_cap:
+            # Stop IPOPT at the time budget, the fallback input (if any) is applied instead of the late solution
+            setup_mpc['nlpsol_opts']['ipopt.max_cpu_time'] = self.step_budget
+        if self.warm_start == "shift":
+            # Start IPOPT from the shifted primal-dual solution instead of its default initialization
+            setup_mpc['nlpsol_opts'].update({'ipopt.warm_start_init_point': 'yes',
+                                             'ipopt.warm_start_bound_push': 1e-6,
+                                             'ipopt.warm_start_mult_bound_push': 1e-6,
+                                             'ipopt.mu_init': 1e-4})
+        setup_mpc['nlpsol_opts'].update(self.solver_options)
         mpc.set_param(**setup_mpc)
 
         # Configure objective function
@@ -165,20 +246,168 @@ class MPC:
         mpc.bounds['lower', '_u', 'u'] = -max_u
         mpc.bounds['upper', '_u', 'u'] = max_u
 
-        # If trajectory tracking or moving obstacles: Define time-varying parameters
-        if self.control_type == "traj_tracking" or self.moving_obstacles_on is True:
-            mpc = self.set_tvp_for_mpc(mpc)
+        # Define time-varying parameters (goal or trajectory and moving obstacles)
+        mpc = self.set_tvp_for_mpc(mpc)
 
         # Add safety constraints
-        if self.static_obstacles_on or self.moving_obstacles_on:
+        if self.n_obs_slots > 0:
             if self.controller == "MPC-DC":
                 # MPC-DC: Add obstacle avoidance constraints
                 mpc = self.add_obstacle_constraints(mpc)
             else:
-                # MPC-CBF: Add CBF constraints
+                # MPC-CBF and LTV-MPC: Add CBF constraints
                 mpc = self.add_cbf_constraints(mpc)
 
         mpc.setup()
+
+        # Function to evaluate the objective of the solution (for telemetry)
+        self.objective_fun = Function('objective', [mpc.nlp['x'], mpc.nlp['p']], [mpc.nlp['f']])
+
+        if self.controller == "LTV-MPC":
+            # Replace the NLP solver with the QP linearized around the previous prediction
+            from ltv_mpc import LTVSolver
+            mpc.S = LTVSolver(mpc.nlp, self.get_shift_indices(mpc)[0])
+        elif self.input_blocking is not None or self.input_spline_knots is not None:
+            # Replace the NLP solver with the one over fewer input values than stages
+            mpc.S = self.get_blocked_solver(mpc)
+        elif self.compile_nlp:
+            # Replace the symbolic NLP with compiled C code
+            mpc = self.load_compiled_nlp(mpc)
+
+        # Number of decision variables of the solver
+        self.n_opt_vars = mpc.S.n_z if isinstance(mpc.S, BlockedSolver) else mpc.nlp['x'].shape[0]
+
+        # Solvers for the first step (full NLP) and the next steps (single SQP iteration)
+        self.nlp_solver = mpc.S
+        self.rti_solver = None
+        if self.solver == "rti" and self.controller != "LTV-MPC":  # The LTV-MPC solves a single QP already
+            self.rti_solver = self.get_rti_solver(mpc)
+
+        # Indices of the states and inputs of each stage (warm start, predicted path, plan) and of the obstacle flags
+        self.shift_indices = self.get_shift_indices(mpc)
+        self.active_indices = self.get_active_indices(mpc)
+        return mpc
+
+    @staticmethod
+    def load_solver_profile(filename):
+        """Loads the IPOPT options of a solver profile saved by tuning.py.
+
+        Inputs:
+          - filename(str): The JSON file of the profile
+        Returns:
+          - options(dict): The IPOPT options
+        """
+        with open(filename) as f:
+            return json.load(f)['options']
+
+    def get_rti_solver(self, mpc):
+        """Creates the solver for the real-time iteration (RTI).
+
+        The RTI performs a single SQP iteration per step, starting from the shifted solution of the
+        previous step, with a full step and no line search. The Hessian of the Lagrangian is replaced
+        by the (regularized) Hessian of the objective, i.e. the Gauss-Newton approximation, which is
+        positive definite and does not need the constraint curvature.
+
+        Inputs:
+          - mpc(do_mpc.controller.MPC): The mpc controller (after setup)
+        Returns:
+          - rti_solver(casadi.Function): The SQP solver
+        """
+        x, p, f, g = mpc.nlp['x'], mpc.nlp['p'], mpc.nlp['f'], mpc.nlp['g']
+        symvar = type(x)                 # SX or MX
+        lam_f = symvar.sym('lam_f')
+        lam_g = symvar.sym('lam_g', g.shape[0])
+        H, _ = hessian(f, x)
+        H = lam_f*H + self.rti_regularization*symvar.eye(x.shape[0])
+        hess_lag = Function('nlp_hess_l', [x, p, lam_f, lam_g], [H])
+
+        opts = {'max_iter': 1,
+                'max_iter_ls': 0,
+                'hess_lag': hess_lag,
+                'qpsol': self.rti_qpsol,
+                'error_on_fail': False,
+                'record_time': True,
+                'print_header': False,
+                'print_iteration': False,
+                'print_status': False,
+                'print_time': False}
+        if self.rti_qpsol == "qpoases":
+            opts['qpsol_options'] = {'sparse': True, 'printLevel': 'none', 'error_on_fail': False}
+        elif self.rti_qpsol == "qrqp":
+            opts['qpsol_options'] = {'print_iter': False, 'print_header': False, 'error_on_fail': False}
+        else:
+            opts['qpsol_options'] = {'error_on_fail': False}
+        return nlpsol('S', 'sqpmethod', mpc.nlp, opts)
+
+    def get_blocked_solver(self, mpc):
+        """Creates the solver with the reduced input parameterization (move blocking or piecewise linear input).
+
+        Inputs:
+          - mpc(do_mpc.controller.MPC): The mpc controller (after setup)
+        Returns:
+          - blocked_solver(BlockedSolver): The solver
+        """
+        if self.input_blocking is not None and self.input_spline_knots is not None:
+            raise ValueError("Choose either input blocking or a spline input, not both!")
+        if self.compile_nlp or self.solver == "rti":
+            raise ValueError("The reduced input parameterization only supports the uncompiled NLP solver!")
+        if self.input_blocking is not None:
+            M = get_blocking_matrix(self.T_horizon, self.input_blocking)
+        else:
+            M = get_spline_matrix(self.T_horizon, self.input_spline_knots)
+        u_indices = np.array([mpc.opt_x.f['_u', k, 0] for k in range(self.T_horizon)])
+        return BlockedSolver(mpc.nlp, u_indices, M, mpc.settings.nlpsol_opts)
+
+    def get_problem_hash(self):
+        """Computes a hash of all settings and of the code that change the NLP expressions.
+
+        The source of the formulation methods is part of the hash, so that a compiled NLP of an
+        older formulation is not reused after the code changes.
+
+        Returns:
+          - problem_hash(str): The hash identifying the NLP
+        """
+        import do_mpc
+        settings = [self.T_horizon, self.Ts, self.controller, self.control_type, self.gamma,
+                    self.safety_dist, self.r, np.asarray(self.Q).tolist(), np.asarray(self.R).tolist(),
+                    CasadiMeta.version(), do_mpc.__version__]
+        if self.control_type == "traj_tracking":
+            settings += [self.cfg.trajectory, self.cfg.A, self.cfg.w]
+        settings.append(self.n_obs_slots)
+        settings += [inspect.getsource(getattr(type(self), name)) for name in self.formulation_methods]
+        return hashlib.sha1(repr(settings).encode()).hexdigest()[:16]
+
+    def load_compiled_nlp(self, mpc):
+        """Loads the compiled NLP from the cache and compiles it first, if not found.
+
+        The shared library is named by the problem hash, so runs with the same problem reuse it
+        without compiling again. The library is compiled under a temporary name and then moved,
+        so that parallel workers never load a partially written file.
+
+        Inputs:
+          - mpc(do_mpc.controller.MPC): The mpc controller (after setup)
+        Returns:
+          - mpc(do_mpc.controller.MPC): The mpc controller using the compiled NLP
+        """
+        problem_hash = self.get_problem_hash()
+        libname = os.path.join(self.cfg.nlp_cache_dir, 'nlp_' + problem_hash + '.so')
+        if not os.path.isfile(libname):
+            os.makedirs(self.cfg.nlp_cache_dir, exist_ok=True)
+            name = 'nlp_{}_{}'.format(problem_hash, os.getpid())
+            cname = os.path.join(self.cfg.nlp_cache_dir, name + '.c')
+            tmp_libname = os.path.join(self.cfg.nlp_cache_dir, name + '.so')
+
+            # Generate C code (in the working directory, as CasADi requires a plain file name)
+            mpc.S.generate_dependencies(name + '.c')
+            os.replace(name + '.c', cname)
+
+            # Compile C code
+            subprocess.run(['gcc', '-fPIC', '-shared', '-O1', cname, '-o', tmp_libname], check=True)
+            os.replace(tmp_libname, libname)
+            os.remove(cname)
+
+        # Overwrite the solver with the one using the compiled NLP
+        mpc.S = nlpsol('S', 'ipopt', libname, mpc.settings.nlpsol_opts)
         return mpc
 
     def add_obstacle_constraints(self, mpc):
@@ -189,21 +418,12 @@ class MPC:
         Returns:
           - mpc(do_mpc.controller.MPC): The mpc controller with obstacle constraints added
         """
-        if self.static_obstacles_on:
-            i = 0
-            for x_obs, y_obs, r_obs in self.obs:
-                obs_avoid = - (self.model.x['x'][0] - x_obs)**2 \
-                            - (self.model.x['x'][1] - y_obs)**2 \
-                            + (self.r + r_obs + self.safety_dist)**2
-                mpc.set_nl_cons('obstacle_constraint'+str(i), obs_avoid, ub=0)
-                i += 1
-
-        if self.moving_obstacles_on:
-            for i in range(len(self.moving_obs)):
-                obs_avoid = - (self.model.x['x'][0] - self.model.tvp['x_moving_obs'+str(i)])**2 \
-                            - (self.model.x['x'][1] - self.model.tvp['y_moving_obs'+str(i)])**2 \
-                            + (self.r + self.moving_obs[i][4] + self.safety_dist)**2
-                mpc.set_nl_cons('moving_obstacle_constraint'+str(i), obs_avoid, ub=0)
+        for i in range(self.n_obs_slots):
+            x_obs, y_obs, r_obs, active = vertsplit(self.model.tvp['obs_slot'+str(i)])
+            obs_avoid = - (self.model.x['x'][0] - x_obs)**2 \
+                        - (self.model.x['x'][1] - y_obs)**2 \
+                        + (self.r + r_obs + self.safety_dist)**2
+            mpc.set_nl_cons('obstacle_constraint'+str(i), active*obs_avoid, ub=0)
 
         return mpc
 
@@ -232,20 +452,15 @@ class MPC:
         B = self.get_sys_matrix_B(self.model.x['x'])
         x_k1 = self.model.x['x'] + B@self.model.u['u']*self.Ts
 
-        # Compute CBF constraints
+        # Compute CBF constraints (inactive slots give the trivial constraint 0 <= 0)
+        # h(x_{t+k+1}) is evaluated at the obstacle position of the next stage
         cbf_constraints = []
-        if self.static_obstacles_on:
-            for obs in self.obs:
-                h_k1 = self.h(x_k1, obs)
-                h_k = self.h(self.model.x['x'], obs)
-                cbf_constraints.append(-h_k1 + (1-self.gamma)*h_k)
-
-        if self.moving_obstacles_on:
-            for i in range(len(self.moving_obs)):
-                obs = (self.model.tvp['x_moving_obs'+str(i)], self.model.tvp['y_moving_obs'+str(i)], self.moving_obs[i][4])
-                h_k1 = self.h(x_k1, obs)
-                h_k = self.h(self.model.x['x'], obs)
-                cbf_constraints.append(-h_k1 + (1-self.gamma)*h_k)
+        for i in range(self.n_obs_slots):
+            x_obs, y_obs, r_obs, active = vertsplit(self.model.tvp['obs_slot'+str(i)])
+            x_obs_next, y_obs_next = vertsplit(self.model.tvp['obs_next'+str(i)])
+            h_k1 = self.h(x_k1, (x_obs_next, y_obs_next, r_obs))
+            h_k = self.h(self.model.x['x'], (x_obs, y_obs, r_obs))
+            cbf_constraints.append(active*(-h_k1 + (1-self.gamma)*h_k))
 
         return cbf_constraints
 
@@ -262,8 +477,157 @@ class MPC:
         h = (x[0] - x_obs)**2 + (x[1] - y_obs)**2 - (self.r + r_obs + self.safety_dist)**2
         return h
 
+    def check_obstacle_slots(self, obs, moving_obs, n_agents=None):
+        """Checks that all obstacles (and the other robots) fit in the obstacle slots of the solver."""
+        n_agents = len(self.agent_paths) if n_agents is None else n_agents
+        n_obs = self.get_n_active_static_obs(obs) + len(moving_obs) + n_agents
+        if n_obs > self.n_obs_slots:
+            raise ValueError("There are {} obstacles but only {} obstacle slots!".format(n_obs, self.n_obs_slots))
+
+    def set_obstacles(self, obs=None, moving_obs=None):
+        """Changes the obstacles without rebuilding the solver.
+
+        The obstacles are written to the obstacle slots at the next step, so their number
+        can not exceed the number of slots the solver was built with.
+
+        Inputs:
+          - obs(list):        The static obstacles as list of tuples (x,y,radius) (optional)
+          - moving_obs(list): The moving obstacles as list of tuples (ax,bx,ay,by,radius) (optional)
+        """
+        obs = self.obs if obs is None else obs
+        moving_obs = self.moving_obs if moving_obs is None else moving_obs
+        self.check_obstacle_slots(obs, moving_obs)
+
+        self.obs = obs
+        self.obs_tree = self.get_obstacle_tree(obs)
+        self.moving_obs = moving_obs
+        self.static_obstacles_on = len(obs) > 0
+        self.moving_obstacles_on = len(moving_obs) > 0
+
+    def set_agent_paths(self, paths, t0, radii):
+        """Sets the predicted paths of other robots, which are avoided like moving obstacles.
+
+        Each stage of the horizon gets the predicted position of each robot at the stage time. Past
+        the end of a predicted path, the robot is assumed to stay at its last predicted position.
+
+        Inputs:
+          - paths(np.ndarray): The predicted x-y positions of each robot [n_agents x n_stages x 2]
+          - t0(float):         The time of the first predicted positions [s]
+          - radii(np.ndarray): The radius of each robot [n_agents]
+        """
+        paths = np.asarray(paths, dtype=float)
+        self.check_obstacle_slots(self.obs, self.moving_obs, len(paths))
+        self.agent_paths = paths
+        self.agent_t0 = t0
+        self.agent_radii = np.asarray(radii, dtype=float)
+
+    def get_obstacle_slots(self, times):
+        """Computes the values of the obstacle slots at the given times.
+
+        The static obstacles fill the first slots, followed by the moving obstacles and the other
+        robots. The remaining slots are inactive.
+
+        Inputs:
+          - times(np.ndarray): The times [s] [n_times]
+        Returns:
+          - obstacle_slots(np.ndarray): The [x, y, radius, active] values of each slot [n_times x n_obs_slots x 4]
+        """
+        times = np.atleast_1d(np.asarray(times, dtype=float)).ravel()
+        obs = self.obs
+        if self.n_nearest_obs is not None and len(obs) > self.n_nearest_obs:
+            obs = [obs[i] for i in self.get_nearest_obstacles(self.get_predicted_path())]
+
+        obstacle_slots = np.zeros((len(times), self.n_obs_slots, 4))
+        if len(obs) > 0:
+            obstacle_slots[:, :len(obs), :3] = np.array(obs)
+            obstacle_slots[:, :len(obs), 3] = 1
+        if len(self.moving_obs) > 0:
+            ax, bx, ay, by, r_obs = np.array(self.moving_obs).T
+            moving = slice(len(obs), len(obs) + len(self.moving_obs))
+            obstacle_slots[:, moving, 0] = np.outer(times, ax) + bx
+            obstacle_slots[:, moving, 1] = np.outer(times, ay) + by
+            obstacle_slots[:, moving, 2] = r_obs
+            obstacle_slots[:, moving, 3] = 1
+        if len(self.agent_paths) > 0:
+            k = np.clip(np.round((times - self.agent_t0)/self.Ts).astype(int), 0, self.agent_paths.shape[1] - 1)
+            agents = slice(len(obs) + len(self.moving_obs), len(obs) + len(self.moving_obs) + len(self.agent_paths))
+            obstacle_slots[:, agents, :2] = self.agent_paths[:, k].transpose(1, 0, 2)
+            obstacle_slots[:, agents, 2] = self.agent_radii
+            obstacle_slots[:, agents, 3] = 1
+        return obstacle_slots
+
+    def get_moving_obstacle_slot(self, i):
+        """Returns the obstacle slot of the i-th moving obstacle."""
+        return self.get_n_active_static_obs(self.obs) + i
+
+    def get_n_active_static_obs(self, obs):
+        """Returns the number of static obstacles that are written to the obstacle slots at each step."""
+        if self.n_nearest_obs is None:
+            return len(obs)
+        return min(len(obs), self.n_nearest_obs)
+
+    def get_obstacle_tree(self, obs):
+        """Builds a KD-tree over the centers of the static obstacles (None if the nearest ones are not selected)."""
+        if self.n_nearest_obs is None or len(obs) <= self.n_nearest_obs:
+            return None
+        from scipy.spatial import cKDTree
+        return cKDTree(np.array(obs)[:, :2])
+
+    def get_predicted_path(self):
+        """Returns the positions predicted by the last solution (the initial guess before the first step).
+
+        Returns:
+          - path(np.ndarray): The predicted x-y positions [(N+1) x 2]
+        """
+        if getattr(self, 'mpc', None) is None:  # The mpc is not set up yet
+            return np.array([self.x0[:2]])
+        x_indices, _ = self.shift_indices
+        return np.array(self.mpc.opt_x_num.master).ravel()[x_indices[:, :2]]
+
+    def get_nearest_obstacles(self, path):
+        """Finds the static obstacles with the smallest clearance to a path.
+
+        The KD-tree gives the nearest obstacle centers to each point of the path, which are
+        then ranked by their clearance to the path (distance minus obstacle radius).
+
+        Inputs:
+          - path(np.ndarray): The x-y positions of the path [n x 2]
+        Returns:
+          - indices(list): The indices of the n_nearest_obs nearest obstacles in self.obs
+        """
+        _, candidates = self.obs_tree.query(path, k=self.n_nearest_obs)
+        candidates = np.unique(candidates)
+        obs = np.array(self.obs)[candidates]
+        distances = np.linalg.norm(path[:, None, :] - obs[None, :, :2], axis=2).min(axis=0)
+        clearance = distances - obs[:, 2]
+        return list(candidates[np.argsort(clearance)[:self.n_nearest_obs]])
+
+    def get_reference(self, times):
+        """Computes the reference trajectory for trajectory tracking.
+
+        Inputs:
+          - times(np.ndarray): The times [s] [n_times]
+        Returns:
+          - reference(np.ndarray): The x-y positions of the reference [n_times x 2]
+        """
+        wt = self.cfg.w*np.asarray(times, dtype=float)
+        if self.cfg.trajectory == "circular":
+            x_traj = self.cfg.A*np.cos(wt)
+            y_traj = self.cfg.A*np.sin(wt)
+        elif self.cfg.trajectory == "infinity":
+            x_traj = self.cfg.A*np.cos(wt)/(np.sin(wt)**2 + 1)
+            y_traj = self.cfg.A*np.sin(wt)*np.cos(wt)/(np.sin(wt)**2 + 1)
+        else:
+            raise ValueError("Select one of the available options for trajectory.")
+        return np.stack([x_traj, y_traj], axis=1)
+
     def set_tvp_for_mpc(self, mpc):
-        """Sets the trajectory for trajectory tracking and/or the moving obstacles' trajectory.
+        """Sets the goal or the trajectory for trajectory tracking and the obstacles' trajectory.
+
+        Each stage k of the horizon gets the values at its own time t_now + k*Ts, and the obstacle
+        positions at t_now + (k+1)*Ts for the CBF condition on the next state. The reference
+        trajectory is computed in advance for the whole simulation (plus one horizon), so at each
+        step the values are only looked up and written to the parameter vector at once.
 
         Inputs:
           - mpc(do_mpc.controller.MPC): The mpc controller
@@ -271,29 +635,35 @@ class MPC:
           - mpc(do_mpc.controller.MPC): The mpc model with time-varying parameters added
         """
         tvp_struct_mpc = mpc.get_tvp_template()
+        n_stages = self.T_horizon + 1
+        tvp_keys = [key for key in self.model.tvp.keys() if self.model.tvp[key].numel() > 0]
+        if self.control_type == "traj_tracking":
+            reference = self.get_reference(np.arange(self.sim_time + n_stages)*self.Ts)
 
         def tvp_fun_mpc(t_now):
-            if self.control_type == "traj_tracking":
+            t_now = np.asarray(t_now, dtype=float).item()
+            times = t_now + np.arange(n_stages)*self.Ts
+            tvp = {}
+            if self.control_type == "setpoint":
+                tvp['goal'] = np.tile(np.ravel(self.goal), (n_stages, 1))
+            else:
                 # Trajectory to follow
-                if config.trajectory == "circular":
-                    x_traj = config.A*cos(config.w*t_now)
-                    y_traj = config.A*sin(config.w*t_now)
-                elif config.trajectory == "infinity":
-                    x_traj = config.A*cos(config.w*t_now)/(sin(config.w*t_now)**2 + 1)
-                    y_traj = config.A*sin(config.w*t_now)*cos(config.w*t_now)/(sin(config.w*t_now)**2 + 1)
+                k_now = int(round(t_now/self.Ts))
+                if k_now + n_stages <= len(reference):
+                    reference_k = reference[k_now:k_now + n_stages]
                 else:
-                    print("Select one of the available options for trajectory.")
-                    exit()
+                    reference_k = self.get_reference(times)
+                tvp['x_set_point'] = reference_k[:, :1]
+                tvp['y_set_point'] = reference_k[:, 1:]
 
-                tvp_struct_mpc['_tvp', :, 'x_set_point'] = x_traj
-                tvp_struct_mpc['_tvp', :, 'y_set_point'] = y_traj
-
-            if self.moving_obstacles_on is True:
-                # Moving obstacles trajectory
-                for i in range(len(self.moving_obs)):
-                    tvp_struct_mpc['_tvp', :, 'x_moving_obs'+str(i)] = self.moving_obs[i][0]*t_now + self.moving_obs[i][1]
-                    tvp_struct_mpc['_tvp', :, 'y_moving_obs'+str(i)] = self.moving_obs[i][2]*t_now + self.moving_obs[i][3]
+            # Obstacles (static and moving obstacles' trajectory, with the positions one step ahead)
+            obstacle_slots = self.get_obstacle_slots(np.append(times, times[-1] + self.Ts))
+            for i in range(self.n_obs_slots):
+                tvp['obs_slot'+str(i)] = obstacle_slots[:-1, i]
+                tvp['obs_next'+str(i)] = obstacle_slots[1:, i, :2]
 
+            # The parameter vector is ordered by stage and then by variable
+            tvp_struct_mpc.master = DM(np.hstack([tvp[key] for key in tvp_keys]).ravel())
             return tvp_struct_mpc
 
         mpc.set_tvp_fun(tvp_fun_mpc)
@@ -305,33 +675,366 @@ class MPC:
         Returns:
           - simulator(do_mpc.simulator.Simulator): The simulator
         """
+        import do_mpc
         simulator = do_mpc.simulator.Simulator(self.model)
         simulator.set_param(t_step=self.Ts)
 
-        # If trajectory tracking or moving obstacles: Add time-varying parameters
-        if self.control_type == "traj_tracking" or self.moving_obstacles_on is True:
-            tvp_template = simulator.get_tvp_template()
+        # Add time-varying parameters
+        tvp_template = simulator.get_tvp_template()
 
-            def tvp_fun(t_now):
-                return tvp_template
-            simulator.set_tvp_fun(tvp_fun)
+        def tvp_fun(t_now):
+            if self.control_type == "setpoint":
+                tvp_template['goal'] = self.goal
+            return tvp_template
+        simulator.set_tvp_fun(tvp_fun)
 
         simulator.setup()
 
         return simulator
 
+    @property
+    def data(self):
+        """The closed-loop data (recorded by the mpc controller)."""
+        return self.mpc.data
+
     def set_init_state(self):
         """Sets the initial state in all components."""
         self.mpc.x0 = self.x0
         self.simulator.x0 = self.x0
         self.estimator.x0 = self.x0
         self.mpc.set_initial_guess()
+        self.plan = None                       # Inputs of the last feasible solution [N x 2]
+        self.plan_age = 0                      # Steps since the last feasible solution
+
+    def reset(self, x0=None, goal=None):
+        """Prepares the controller for a new episode without rebuilding the optimization problem.
+
+        The stored histories are cleared and the initial state and initial guess are set again,
+        while the model, the solver and the simulator are reused.
+
+        Inputs:
+          - x0(np.ndarray): The new initial pose (optional)
+          - goal(list):     The new goal pose, for set point control (optional)
+        """
+        if x0 is not None:
+            self.x0 = np.array(x0)
+        if goal is not None:
+            if self.control_type != "setpoint":
+                raise ValueError("A goal can only be set for set point control!")
+            self.goal = goal
+
+        self.mpc.reset_history()
+        self.simulator.reset_history()
+        self.estimator.reset_history()
+        self.mpc.u0 = np.zeros((2, 1))         # No previous input for the input penalty
+        self.mpc.flags['initial_run'] = False  # Do not warm start the multipliers from the last episode
+        self.telemetry = self.get_empty_telemetry()
+        self.set_init_state()
+        self.n_resets += 1
+
+    @property
+    def saved_build_time(self):
+        """Estimated build time [s] saved by reusing the problem instead of rebuilding it."""
+        return self.n_resets*self.build_time
+
+    def get_shift_indices(self, mpc):
+        """Computes the indices of the decision variables of the states and inputs of each stage.
+
+        Inputs:
+          - mpc(do_mpc.controller.MPC): The mpc controller (after setup)
+        Returns:
+          - x_indices(np.ndarray): The indices of the states of the stages 0..N [(N+1) x n_x]
+          - u_indices(np.ndarray): The indices of the inputs of the stages 0..N-1 [N x n_u]
+        """
+        N = self.T_horizon
+        x_indices = np.array([mpc.opt_x.f['_x', k, 0, -1] for k in range(N+1)])
+        u_indices = np.array([mpc.opt_x.f['_u', k, 0] for k in range(N)])
+        return x_indices, u_indices
+
+    def get_active_indices(self, mpc):
+        """Computes the indices of the active flags of the obstacle slots in the parameter vector.
+
+        Inputs:
+          - mpc(do_mpc.controller.MPC): The mpc controller (after setup)
+        Returns:
+          - active_indices(np.ndarray): The index of the flag of each stage and slot [N x n_slots]
+        """
+        return np.array([[mpc.opt_p.f['_tvp', k, 'obs_slot'+str(i)][3] for i in range(self.n_obs_slots)]
+                         for k in range(self.T_horizon)], dtype=int).reshape(self.T_horizon, self.n_obs_slots)
+
+    def shift_initial_guess(self):
+        """Shifts the last solution one step forward and uses it as initial guess for the next step.
+
+        Both the predicted states and inputs and the Lagrange multipliers are shifted by one stage.
+        The last stage is either repeated or, for the states, rolled out with the last input.
+        """
+        N = self.T_horizon
+        n_x = self.model.n_x
+        x_indices, u_indices = self.shift_indices
+        w = np.array(self.mpc.opt_x_num.master).ravel()
+        lam_x = np.array(self.mpc.lam_x_num).ravel()
+        x_N = w[x_indices[-1]]
+        for guess in [w, lam_x]:
+            guess[x_indices[:-1]] = guess[x_indices[1:]]
+            guess[u_indices[:-1]] = guess[u_indices[1:]]
+        if self.warm_start_terminal == "rollout":
+            w[x_indices[-1]] = np.ravel(self.dynamics(x_N, w[u_indices[-1]]))
+        self.mpc.opt_x_num.master = DM(w)
+        self.mpc.lam_x_num = DM(lam_x)
+
+        # Constraints are ordered as [initial state, (dynamics, nonlinear constraints) for each stage]
+        lam_g = np.array(self.mpc.lam_g_num).ravel()
+        n_stage = (len(lam_g) - n_x)//N
+        lam_g[n_x:-n_stage] = lam_g[n_x+n_stage:]
+        self.mpc.lam_g_num = DM(lam_g)
+
+    def make_step(self, x0):
+        """Computes the control input for the current state.
+
+        Inputs:
+          - x0(np.ndarray): The current state [3x1]
+        Returns:
+          - u0(np.ndarray): The control input [2x1]
+        """
+        t_start = time.perf_counter()
+        if self.warm_start == "shift" and self.mpc.flags['initial_run']:
+            self.shift_initial_guess()
+        if self.rti_solver is not None:
+            # Solve the full NLP at the first step of an episode, then iterate once per step
+            self.mpc.S = self.rti_solver if self.mpc.flags['initial_run'] else self.nlp_solver
+        t_now = np.ravel(self.mpc.t0)[0]
+        t_solve_start = time.perf_counter()
+        u0 = self.mpc.make_step(x0)
+        t_solve = time.perf_counter() - t_solve_start
+
+        # Fall back to a safe input if the solver failed or ran over the time budget
+        success = self.get_solver_success()
+        deadline_miss = self.mpc.solver_stats.get('t_proc_total', t_solve) > self.step_budget  # Solver CPU time
+        self.plan_age += 1
+        use_fallback = self.fallback is not None and (not success or deadline_miss)
+        unsafe_fallback = False
+        if use_fallback:
+            u0, safe = self.get_fallback_input(x0, t_now)
+            unsafe_fallback = not safe
+            self.mpc.u0 = u0              # The input penalty of the next step refers to the applied input
+            self.mpc.data._u[-1] = u0.ravel()
+        else:
+            self.plan = np.array(self.mpc.opt_x_num.master).ravel()[self.shift_indices[1]]
+            self.plan_age = 0
+        self.update_telemetry(t_start, t_solve, success, deadline_miss, use_fallback, unsafe_fallback)
+        return u0
+
+    def get_solver_success(self):
+        """Returns whether the last solver call succeeded."""
+        stats = self.mpc.solver_stats
+        if self.mpc.S is self.rti_solver:
+            # A real-time iteration stops after one iteration on purpose
+            return stats['return_status'] in ("Maximum_Iterations_Exceeded", "Solve_Succeeded")
+        return stats['success']
+
+    def get_fallback_input(self, x0, t):
+        """Computes the input to apply instead of a failed or late solution.
+
+        The candidates are the next input of the last feasible plan (for the "shift" fallback) and
+        braking (zero velocities). The first candidate that satisfies the CBF condition
+        h(x_{k+1}) >= (1-γ)*h(x_k) for all active obstacles (h(x_{k+1}) >= 0 for the MPC-DC) is used,
+        otherwise the candidate that violates it the least.
+
+        Inputs:
+          - x0(np.ndarray): The current state [3x1]
+          - t(float):       The current time [s]
+        Returns:
+          - u0(np.ndarray): The fallback input [2x1]
+          - safe(bool):     Whether the fallback input satisfies the CBF condition
+        """
+        candidates = []
+        if self.fallback == "shift" and self.plan is not None and self.plan_age < len(self.plan):
+            candidates.append(self.plan[self.plan_age])
+        candidates.append(np.zeros(self.model.n_u))
+        if self.n_obs_slots == 0:
+            return candidates[0].reshape(-1, 1), True
+
+        x = np.ravel(x0)
+        slots = self.get_obstacle_slots([t, t + self.Ts])
+        active = slots[0, :, 3] > 0
+        decay = 0 if self.controller == "MPC-DC" else 1 - self.gamma
+        h_k = self.h(x, slots[0, :, :3].T)
+        margins = []
+        for u in candidates:
+            h_k1 = self.h(np.array(self.dynamics(x, u)).ravel(), slots[1, :, :3].T)
+            margin = np.min((h_k1 - decay*h_k)[active], initial=np.inf)
+            if margin >= 0:
+                return u.reshape(-1, 1), True
+            margins.append(margin)
+        return candidates[int(np.argmax(margins))].reshape(-1, 1), False
+
+    @staticmethod
+    def get_empty_telemetry(maxlen=None):
+        """Returns the (empty) telemetry record with a list for each statistic.
+
+        Inputs:
+          - maxlen(int): Number of steps to keep, as a ring buffer (None: keep all)
+        """
+        def record():
+            return [] if maxlen is None else deque(maxlen=maxlen)
+        return {'t_wall': record(),         # Wall time of the control step [s]
+                't_solver': record(),       # Wall time spent in the NLP solver [s]
+                'iter_count': record(),     # Solver iterations
+                'return_status': record(),  # Solver return status
+                'success': record(),        # Whether the solver succeeded
+                'min_slack': record(),      # Smallest slack of the obstacle (CBF or distance) constraints
+                'objective': record(),      # Objective value of the solution
+                'deadline_miss': record(),  # Whether the solver took longer than the time budget
+                'fallback': record(),       # Whether the fallback input was applied
+                'unsafe_fallback': record()}  # Whether the fallback input violated the CBF condition
+
+    def update_telemetry(self, t_start, t_solve, success, deadline_miss, fallback, unsafe_fallback):
+        """Records the statistics of the last control step.
+
+        The wall time of the step runs from t_start until the statistics are computed, so that it
+        includes the warm start, the fallback and the telemetry itself.
+
+        Inputs:
+          - t_start(float):       Start of the control step (time.perf_counter) [s]
+          - t_solve(float):       Wall time of the solver call [s]
+          - success(bool):        Whether the solver succeeded
+          - deadline_miss(bool):  Whether the solver took longer than the time budget
+          - fallback(bool):       Whether the fallback input was applied
+          - unsafe_fallback(bool): Whether no fallback candidate satisfied the CBF condition
+        """
+        stats = self.mpc.solver_stats
+        min_slack = self.get_min_constraint_slack()
+        objective = float(self.objective_fun(self.mpc.opt_x_num, self.mpc.opt_p_num))
+        self.telemetry['t_wall'].append(time.perf_counter() - t_start)
+        self.telemetry['t_solver'].append(stats.get('t_wall_total', t_solve))
+        self.telemetry['iter_count'].append(stats['iter_count'])
+        self.telemetry['return_status'].append(stats['return_status'])
+        self.telemetry['success'].append(success)
+        self.telemetry['min_slack'].append(min_slack)
+        self.telemetry['objective'].append(objective)
+        self.telemetry['deadline_miss'].append(deadline_miss)
+        self.telemetry['fallback'].append(fallback)
+        self.telemetry['unsafe_fallback'].append(unsafe_fallback)
+
+    def get_min_constraint_slack(self):
+        """Computes the smallest slack of the obstacle constraints of the last solution over the horizon.
+
+        Only the slots of active obstacles are considered. A negative slack means that a constraint is violated.
+
+        Returns:
+          - min_slack(float): The smallest slack (nan if there are no active obstacles)
+        """
+        N = self.T_horizon
+        n_x = self.model.n_x
+        if self.n_obs_slots == 0:
+            return np.nan
+
+        # Constraints are ordered as [initial state, (dynamics, nonlinear constraints) for each stage]
+        g = np.array(self.mpc.opt_g_num).ravel()
+        obstacle_cons = g[n_x:].reshape(N, -1)[:, n_x:n_x+self.n_obs_slots]
+        active = np.array(self.mpc.opt_p_num.master).ravel()[self.active_indices] > 0
+        if not active.any():
+            return np.nan
+        return float(np.min(-obstacle_cons[active]))  # Constraints are of the form g <= 0
+
+    def get_telemetry(self):
+        """Returns the telemetry of the current episode as arrays."""
+        return {key: np.array(value) for key, value in self.telemetry.items()}
+
+    def get_telemetry_summary(self):
+        """Summarizes the solver latency and failures of the current episode.
+
+        Returns:
+          - summary(dict): Latency percentiles and maximum [s], number of failed solves, number of
+                           steps where the solver took longer than the time budget, number of
+                           steps where the fallback input was applied and number of those where
+                           it violated the CBF condition
+        """
+        t_wall = np.array(self.telemetry['t_wall'])
+        return {'steps': len(t_wall),
+                'p50': np.percentile(t_wall, 50),
+                'p95': np.percentile(t_wall, 95),
+                'p99': np.percentile(t_wall, 99),
+                'max': np.max(t_wall),
+                'failures': int(np.sum(np.logical_not(self.telemetry['success']))),
+                'deadline_misses': int(np.sum(self.telemetry['deadline_miss'])),
+                'fallbacks': int(np.sum(self.telemetry['fallback'])),
+                'unsafe_fallbacks': int(np.sum(self.telemetry['unsafe_fallback']))}
+
+    @property
+    def iter_counts(self):
+        """Solver iterations at each step."""
+        return self.telemetry['iter_count']
+
+    def run_simulation(self, plant=None):
+        """Runs a closed-loop control simulation.
+
+        Inputs:
+          - plant(BatchSimulator): Plant with a single environment to use instead of the do-mpc
+                                   simulator and estimator (optional)
+        """
+        for _ in self.simulate(plant=plant):
+            pass
+
+    def simulate(self, n_steps=None, plant=None, history_length=None, decimation=1, dtype=np.float32,
+                 predictions=False, record_data=True):
+        """Runs a closed-loop control simulation as a generator that yields each step as it is computed.
+
+        The states, inputs and costs (and optionally the predicted paths) are also stored in
+        self.history (see history.History). With a history length, the history and the telemetry
+        are ring buffers of the last steps, and without recording the data, the do-mpc data is
+        cleared after each step, so that long or endless runs use constant memory. The plots and
+        the saved results need the recorded data.
+
+        Inputs:
+          - n_steps(int):          Number of steps (defaults to sim_time, np.inf for an endless run)
+          - plant(BatchSimulator): Plant with a single environment to use instead of the do-mpc
+                                   simulator and estimator (optional)
+          - history_length(int):   Number of stored steps to keep in the history and the telemetry (None: all)
+          - decimation(int):       Store every decimation-th step in the history
+          - dtype(np.dtype):       Data type of the history
+          - predictions(bool):     Whether to also yield and store the predicted path of each step
+          - record_data(bool):     Whether to keep the do-mpc data of the controller, simulator and estimator
+        Yields:
+          - step(dict): The step number 'k', the time 't' [s], the state 'x' [3] and the input 'u' [2]
+                        applied at that time, the state cost 'cost' and the predicted path
+                        'prediction' [(N+1) x 2] (only with predictions)
+        """
+        if n_steps is None:
+            n_steps = self.sim_time
+        fields = {'x': (self.model.n_x,), 'u': (self.model.n_u,), 'cost': ()}
+        if predictions:
+            fields['prediction'] = self.get_predicted_path().shape
+        self.history = History(fields, history_length, decimation, dtype)
+        self.telemetry = self.get_empty_telemetry(history_length)
 
-    def run_simulation(self):
-        """Runs a closed-loop control simulation."""
         x0 = self.x0
-        for k in range(self.sim_time):
-            u0 = self.mpc.make_step(x0)
-            y_next = self.simulator.make_step(u0)
-            # y_next = self.simulator.make_step(u0, w0=10**(-4)*np.random.randn(3, 1))  # Optional Additive process noise
-            x0 = self.estimator.make_step(y_next)
+        if plant is not None:
+            plant.reset(self.x0)
+        k = 0
+        while k < n_steps:
+            x_k = np.ravel(x0)
+            u0 = self.make_step(x0)
+            if plant is None:
+                y_next = self.simulator.make_step(u0)
+                # y_next = self.simulator.make_step(u0, w0=10**(-4)*np.random.randn(3, 1))  # Optional Additive process noise
+                x0 = self.estimator.make_step(y_next)
+            else:
+                x0 = plant.make_step(u0.T)[0].reshape(-1, 1)
+
+            data = self.data
+            step = {'k': k, 't': k*self.Ts, 'x': x_k, 'u': np.ravel(u0),
+                    'cost': float(data['_aux', 'cost'][-1, 0]) if len(data['_time']) > 0 else np.nan}
+            if predictions:
+                step['prediction'] = self.get_predicted_path()
+            if not record_data:
+                self.clear_data()
+            self.history.append(k, **{key: step[key] for key in fields})
+            yield step
+            k += 1
+
+    def clear_data(self):
+        """Clears the do-mpc data of the controller, simulator and estimator, keeping their current time."""
+        for component in [self.mpc, self.simulator, self.estimator]:
+            if component is not None:
+                component.data.init_storage()
@@ -0,0 +1,298 @@
+from concurrent.futures import ProcessPoolExecutor
+import io
+import os
+import struct
+import subprocess
+
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Arrow, Circle, Polygon
+import numpy as np
+from PIL import Image
+import seaborn as sns
+
+from analytics import get_obstacle_positions
+
+
+class PathAnimation:
+    """Headless animation of the robot path in the x-y plane.
+
+    The figure is drawn on an Agg canvas (no window and no plt.show()). The static parts (axes,
+    goal or reference, static obstacles) are rendered once into a background, and each frame
+    restores the background and redraws only the robot, its trace and the moving obstacles,
+    whose artists are created once and updated in place (blitting).
+
+    The frames are streamed to the output as they are rendered. GIFs are written directly, with
+    one palette for all frames and only the rectangle that changed since the previous frame
+    encoded in each frame; other formats (e.g. mp4) are piped to ffmpeg. The frames can be
+    rendered and encoded in contiguous chunks by several worker processes, each with its own
+    figure, and are written in order by the calling process.
+    """
+    def __init__(self, X, r, goal=None, reference=None, obs=(), moving_obs_path=None, fps=10, dpi=100):
+        """
+        Inputs:
+          - X(np.ndarray):               The robot states at each frame [n_frames x 3]
+          - r(float):                    The robot radius
+          - goal(list):                  The goal pose, for set point control (optional)
+          - reference(np.ndarray):       The reference trajectory, for trajectory tracking [n x 2] (optional)
+          - obs(list):                   Static obstacles as list of tuples (x,y,radius)
+          - moving_obs_path(np.ndarray): The [x, y, radius] of each moving obstacle at each frame
+                                         [n_frames x n_moving_obs x 3] (optional)
+          - fps(float):                  Frames per second of the output
+          - dpi(int):                    Resolution of the frames
+        """
+        self.X = np.asarray(X, dtype=float)
+        self.r = r
+        self.goal = goal
+        self.reference = reference
+        self.obs = obs
+        self.moving_obs_path = np.zeros((len(self.X), 0, 3)) if moving_obs_path is None else moving_obs_path
+        self.fps = fps
+        self.dpi = dpi
+        self.artists = None  # Figure, canvas, background and animated artists (created by setup)
+
+    @classmethod
+    def from_controller(cls, controller, **kwargs):
+        """Creates the animation of the last simulation of a controller (kwargs as for __init__)."""
+        data = controller.data
+        X = data['_x']
+        if controller.control_type == "setpoint":
+            kwargs.update(goal=controller.goal)
+        else:
+            kwargs.update(reference=np.hstack([data['_tvp', 'x_set_point'], data['_tvp', 'y_set_point']]))
+        moving_obs_path = get_obstacle_positions(data['_time'].ravel(), moving_obs=controller.moving_obs)
+        kwargs.setdefault('fps', 1/controller.Ts)
+        return cls(X, controller.r, obs=controller.obs, moving_obs_path=moving_obs_path, **kwargs)
+
+    def __getstate__(self):
+        """Leaves out the figure when the animation is sent to a worker process."""
+        state = self.__dict__.copy()
+        state['artists'] = None
+        return state
+
+    @property
+    def n_frames(self):
+        """The number of frames."""
+        return len(self.X)
+
+    def setup(self):
+        """Draws the static parts of the figure and creates the animated artists."""
+        sns.set_theme()
+        fig = Figure(figsize=(9, 5), dpi=self.dpi)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        ax.set_xlabel('x [m]')
+        ax.set_ylabel('y [m]')
+        ax.set_title("Robot path")
+        ax.axis('equal')
+        offset = 0.5
+        ax.set_xlim([min(self.X[:, 0])-offset, max(self.X[:, 0])+offset])
+        ax.set_ylim([min(self.X[:, 1])-offset, max(self.X[:, 1])+offset])
+
+        # Goal or reference trajectory
+        if self.goal is not None:
+            ax.plot(self.goal[0], self.goal[1], 'g*', label="Goal")
+        if self.reference is not None:
+            ax.plot(self.reference[:, 0], self.reference[:, 1], 'k--', label="Reference trajectory")
+
+        # Static obstacles
+        for x_obs, y_obs, r_obs in self.obs:
+            ax.add_patch(Circle((x_obs, y_obs), r_obs, color='k'))
+        ax.legend(loc="upper left")
+        fig.tight_layout()
+
+        # Animated artists: moving obstacles, robot's trace, heading indicator and base
+        moving_obs = [ax.add_patch(Circle((0, 0), r_obs, color='k', zorder=2, animated=True))
+                      for r_obs in self.moving_obs_path[0, :, 2]]
+        trace = ax.plot([], [], 'b', alpha=0.7, lw=1.5, animated=True)[0]
+        arrow = Arrow(x=0, y=0, dx=1/6, dy=0, width=0.1)  # Heading indicator for a robot at the origin facing along x
+        heading_shape = arrow.get_patch_transform().transform(arrow.get_path().vertices)
+        heading = ax.add_patch(Polygon(heading_shape, color='k', linewidth=0.6, animated=True))
+        base = ax.add_patch(Circle((0, 0), self.r, zorder=2, animated=True))
+
+        canvas.draw()
+        self.artists = {'fig': fig, 'canvas': canvas, 'ax': ax, 'background': canvas.copy_from_bbox(fig.bbox),
+                        'moving_obs': moving_obs, 'trace': trace, 'heading': heading,
+                        'heading_shape': heading_shape, 'base': base}
+
+    def render_frame(self, i):
+        """Renders frame i.
+
+        Inputs:
+          - i(int): The frame index
+        Returns:
+          - frame(np.ndarray): The RGB image [height x width x 3]
+        """
+        if self.artists is None:
+            self.setup()
+        a = self.artists
+        x, y, theta = self.X[i]
+
+        a['canvas'].restore_region(a['background'])
+        for patch, (x_obs, y_obs, _) in zip(a['moving_obs'], self.moving_obs_path[i]):
+            patch.set_center((x_obs, y_obs))
+        a['trace'].set_data(self.X[:i, 0], self.X[:i, 1])
+        rotation = np.array([[np.cos(theta), np.sin(theta)], [-np.sin(theta), np.cos(theta)]])
+        a['heading'].set_xy(a['heading_shape']@rotation + [x, y])
+        a['base'].set_center((x, y))
+        for artist in a['moving_obs'] + [a['trace'], a['heading'], a['base']]:
+            a['ax'].draw_artist(artist)
+        a['canvas'].blit(a['fig'].bbox)
+        return np.asarray(a['canvas'].buffer_rgba())[..., :3].copy()
+
+    def get_palette(self):
+        """Creates the GIF palette from the first and last frames, so that all frames share it.
+
+        Returns:
+          - palette(PIL.Image): A palette image with 256 colors
+        """
+        frames = np.vstack([self.render_frame(0), self.render_frame(self.n_frames - 1)])
+        palette = Image.fromarray(frames).quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+        colors = palette.getpalette()[:768]
+        palette.putpalette(colors + [0]*(768 - len(colors)))
+        return palette
+
+    def render_frames(self, frames, palette=None):
+        """Renders the given frames, as GIF image blocks or raw RGB bytes.
+
+        For GIFs, each frame is quantized with the palette and only the rectangle that changed
+        since the previous frame is encoded (see get_gif_block).
+
+        Inputs:
+          - frames(range):      Contiguous frame indices
+          - palette(PIL.Image): The palette image for GIFs (None: raw RGB frames)
+        Returns:
+          - blocks(list): The encoded frames (bytes)
+        """
+        if palette is None:
+            return [self.render_frame(i).tobytes() for i in frames]
+
+        blocks = []
+        previous = None
+        if frames[0] > 0:
+            previous = self.quantize(self.render_frame(frames[0] - 1), palette)
+        for i in frames:
+            image = self.quantize(self.render_frame(i), palette)
+            blocks.append(get_gif_block(image, previous, palette))
+            previous = image
+        return blocks
+
+    @staticmethod
+    def quantize(frame, palette):
+        """Maps an RGB frame to the indices of the palette colors [height x width]."""
+        return np.asarray(Image.fromarray(frame).quantize(palette=palette, dither=Image.Dither.NONE))
+
+    def iter_frames(self, palette=None, n_workers=1):
+        """Yields the encoded frames in order (see render_frames), rendered by n_workers processes.
+
+        Inputs:
+          - palette(PIL.Image): The palette image for GIFs (None: raw RGB frames)
+          - n_workers(int):     Number of worker processes (1: render in this process)
+        Yields:
+          - block(bytes): The next frame
+        """
+        if n_workers == 1:
+            yield from self.render_frames(range(self.n_frames), palette)
+            return
+        chunks = [range(c[0], c[-1] + 1) for c in np.array_split(np.arange(self.n_frames), n_workers) if len(c) > 0]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for blocks in executor.map(self.render_frames, chunks, [palette]*len(chunks)):
+                yield from blocks
+
+    def save(self, filename, n_workers=1):
+        """Renders the animation and encodes it to a file.
+
+        Inputs:
+          - filename(str):  The output file; GIFs are written directly and other formats are encoded with ffmpeg
+          - n_workers(int): Number of worker processes for rendering the frames (None: number of CPUs)
+        """
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        n_workers = max(1, min(n_workers, self.n_frames))
+
+        if filename.lower().endswith('.gif'):
+            self.save_gif(filename, n_workers)
+        else:
+            self.save_with_ffmpeg(filename, n_workers)
+
+    def save_gif(self, filename, n_workers=1):
+        """Writes the frames to a looping GIF with one global palette as they are rendered.
+
+        Inputs:
+          - filename(str):  The output file
+          - n_workers(int): Number of worker processes for rendering the frames
+        """
+        palette = self.get_palette()
+        height, width, _ = self.render_frame(0).shape
+        delay = int(round(100/self.fps))  # [1/100 s]
+        with open(filename, 'wb') as f:
+            # Header, logical screen with a global color table of 256 colors and looping forever
+            f.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0xF7, 0, 0) + bytes(palette.getpalette()[:768]))
+            f.write(b'\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00')
+            for block in self.iter_frames(palette, n_workers):
+                # Graphic control extension: keep the previous frame under the changed rectangle
+                f.write(b'\x21\xF9\x04' + struct.pack('<BHBB', 0x04, delay, 0, 0) + block)
+            f.write(b'\x3B')
+
+    def save_with_ffmpeg(self, filename, n_workers=1):
+        """Pipes the raw frames to ffmpeg, which encodes them (e.g. to mp4).
+
+        Inputs:
+          - filename(str):  The output file
+          - n_workers(int): Number of worker processes for rendering the frames
+        """
+        height, width, _ = self.render_frame(0).shape
+        command = [matplotlib.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height), '-r', str(self.fps),
+                   '-i', '-', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', filename]
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError("ffmpeg is needed to encode '{}' (or save the animation as a GIF).".format(filename))
+        for frame in self.iter_frames(n_workers=n_workers):
+            process.stdin.write(frame)
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError("ffmpeg failed to encode '{}'.".format(filename))
+
+
+def get_gif_block(image, previous, palette):
+    """Encodes the rectangle of a frame that differs from the previous frame as a GIF image block.
+
+    The rectangle is LZW-encoded by Pillow as a single-frame GIF, from which the image
+    descriptor and data are taken and placed at the position of the rectangle.
+
+    Inputs:
+      - image(np.ndarray):    The palette indices of the frame [height x width]
+      - previous(np.ndarray): The palette indices of the previous frame (None: encode the whole frame)
+      - palette(PIL.Image):   The palette image
+    Returns:
+      - block(bytes): The image descriptor and image data
+    """
+    if previous is None:
+        top, bottom, left, right = 0, image.shape[0], 0, image.shape[1]
+    else:
+        changed = image != previous
+        rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+        if len(rows) == 0:
+            top, bottom, left, right = 0, 1, 0, 1  # Nothing changed: repeat one pixel
+        else:
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    region = Image.fromarray(np.ascontiguousarray(image[top:bottom, left:right]), 'P')
+    region.putpalette(palette.getpalette()[:768])
+    buffer = io.BytesIO()
+    region.save(buffer, 'GIF', optimize=False)
+    data = buffer.getvalue()
+
+    # Skip the header, the global color table and any extensions up to the image descriptor
+    flags = data[10]
+    n = 13 + (3*2**((flags & 7) + 1) if flags & 0x80 else 0)
+    while data[n] == 0x21:
+        n += 2
+        while data[n] > 0:
+            n += data[n] + 1
+        n += 1
+    block = bytearray(data[n:-1])  # Without the trailer
+    block[1:5] = struct.pack('<HH', left, top)
+    return bytes(block)
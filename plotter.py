@@ -1,23 +1,51 @@
+import os
+
 import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation, ImageMagickWriter
-from matplotlib.patches import Circle
+from matplotlib.animation import FuncAnimation, PillowWriter
+from matplotlib.lines import Line2D
 import do_mpc
 import seaborn as sns
 import numpy as np
 import pandas as pd
 
+from analytics import analyze_controller, get_obstacle_positions
 import config
+from path_animation import PathAnimation
 
 
 class Plotter:
-    def __init__(self, controller):
+    def __init__(self, controller, cfg=None, output_dir='images', show=True):
+        """
+        Inputs:
+          - controller(MPC):      The controller after the simulation
+          - cfg(config.Config):   The settings (defaults to the settings of the controller)
+          - output_dir(str):      Directory of the figures and animations
+          - show(bool):           Whether to show each figure (blocking), or only save and close it
+        """
         self.controller = controller
-        self.mpc = controller.mpc
+        self.cfg = controller.cfg if cfg is None else cfg
+        self.data = controller.data
+        self.output_dir = output_dir
+        self.show = show
+
+    def save_figure(self, fig, filename):
+        """Saves a figure in the output directory and shows or closes it."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        fig.savefig(os.path.join(self.output_dir, filename))
+        if self.show:
+            plt.show()
+        else:
+            plt.close(fig)
+
+    def get_moving_obstacle_path(self, i):
+        """Returns the x and y positions of the i-th moving obstacle at each timestep."""
+        path = get_obstacle_positions(self.data['_time'].ravel(), moving_obs=[self.controller.moving_obs[i]])
+        return path[:, 0, 0], path[:, 0, 1]
 
     def plot_results(self):
         """Plots the state trajectories, the controls and objective value at each timestep."""
         sns.set_theme()
-        fig, ax, graphics = do_mpc.graphics.default_plot(self.mpc.data, figsize=(9, 5))
+        fig, ax, graphics = do_mpc.graphics.default_plot(self.data, figsize=(9, 5))
         graphics.plot_results()
         graphics.reset_axes()
         lines = graphics.result_lines['_x']
@@ -31,23 +59,24 @@ class Plotter:
         fig.suptitle('Trajectories', y=1.0)
 
         # Plot reference trajectory, if trajectory tracking
-        if config.control_type == "traj_tracking":
-            ax[0].plot(self.mpc.data['_time'], self.mpc.data['_tvp', 'x_set_point'], 'k--', lw=1)
-            ax[0].plot(self.mpc.data['_time'], self.mpc.data['_tvp', 'y_set_point'], 'k--', lw=1)
+        if self.cfg.control_type == "traj_tracking":
+            ax[0].plot(self.data['_time'], self.data['_tvp', 'x_set_point'], 'k--', lw=1)
+            ax[0].plot(self.data['_time'], self.data['_tvp', 'y_set_point'], 'k--', lw=1)
 
         # Plot actuator limits
         colors = sns.color_palette()
-        ax[1].hlines(y=config.v_limit, xmin=0, xmax=len(self.mpc.data['_time'])*config.Ts, linewidth=1, color=colors[0], linestyle='--', label='v limit')
-        ax[1].hlines(y=config.omega_limit, xmin=0, xmax=len(self.mpc.data['_time'])*config.Ts, linewidth=1, color=colors[1], linestyle='--', label='$\omega$ limit')
-        ax[1].hlines(y=-config.v_limit, xmin=0, xmax=len(self.mpc.data['_time'])*config.Ts, linewidth=1, color=colors[0], linestyle='--')
-        ax[1].hlines(y=-config.omega_limit, xmin=0, xmax=len(self.mpc.data['_time'])*config.Ts, linewidth=1, color=colors[1], linestyle='--')
+        ax[1].hlines(y=self.cfg.v_limit, xmin=0, xmax=len(self.data['_time'])*self.cfg.Ts, linewidth=1, color=colors[0], linestyle='--', label='v limit')
+        ax[1].hlines(y=self.cfg.omega_limit, xmin=0, xmax=len(self.data['_time'])*self.cfg.Ts, linewidth=1, color=colors[1], linestyle='--', label='$\omega$ limit')
+        ax[1].hlines(y=-self.cfg.v_limit, xmin=0, xmax=len(self.data['_time'])*self.cfg.Ts, linewidth=1, color=colors[0], linestyle='--')
+        ax[1].hlines(y=-self.cfg.omega_limit, xmin=0, xmax=len(self.data['_time'])*self.cfg.Ts, linewidth=1, color=colors[1], linestyle='--')
 
-        plt.savefig('images/trajectories.png')
-        plt.show()
+        self.save_figure(fig, 'trajectories.png')
 
-    def plot_predictions(self, t_ind=int(config.sim_time/2)):
-        """Plots the predictions at timestep t_ind."""
-        mpc_graphics = do_mpc.graphics.Graphics(self.mpc.data)
+    def plot_predictions(self, t_ind=None):
+        """Plots the predictions at timestep t_ind (defaults to the middle of the simulation)."""
+        if t_ind is None:
+            t_ind = int(self.cfg.sim_time/2)
+        mpc_graphics = do_mpc.graphics.Graphics(self.data)
 
         sns.set_theme()
         fig, ax = plt.subplots(2, sharex=True, figsize=(9, 5))
@@ -66,13 +95,12 @@ class Plotter:
         ax[1].set_xlabel('Time [s]')
         ax[0].set_ylabel('State')
         ax[1].set_ylabel('Input')
-        fig.suptitle('Predictions at time t={}s'.format(t_ind*config.Ts))
-        plt.savefig('images/predictions.png')
-        plt.show()
+        fig.suptitle('Predictions at time t={}s'.format(t_ind*self.cfg.Ts))
+        self.save_figure(fig, 'predictions.png')
 
     def create_trajectories_animation(self):
         """Creates an animation with the predictions."""
-        mpc_graphics = do_mpc.graphics.Graphics(self.mpc.data)
+        mpc_graphics = do_mpc.graphics.Graphics(self.data)
         mpc_graphics.reset_axes()
         
         sns.set_theme()
@@ -89,8 +117,10 @@ class Plotter:
         ax[1].set_ylabel('Input')
         fig.suptitle('Trajectories & Predictions')
 
-        anim = FuncAnimation(fig, self.update, frames=config.sim_time, repeat=False, fargs=(mpc_graphics,))
-        anim.save('images/trajectories_animation.gif', writer=ImageMagickWriter(fps=3))
+        anim = FuncAnimation(fig, self.update, frames=len(self.data['_time']), repeat=False, fargs=(mpc_graphics,))
+        os.makedirs(self.output_dir, exist_ok=True)
+        anim.save(os.path.join(self.output_dir, 'trajectories_animation.gif'), writer=PillowWriter(fps=3))
+        plt.close(fig)
 
     def update(self, t_ind, mpc_graphics):
         """Plots the results and predictions at time t_ind for the animation of the predictions."""
@@ -102,7 +132,7 @@ class Plotter:
         """Plots the robot path in the x-y plane."""
         sns.set_theme()
         fig, ax = plt.subplots(figsize=(9, 5))
-        ax.plot(self.mpc.data['_x'][:, 0], self.mpc.data['_x'][:, 1], label="Robot path")
+        ax.plot(self.data['_x'][:, 0], self.data['_x'][:, 1], label="Robot path")
         ax.set_xlabel('x [m]')
         ax.set_ylabel('y [m]')
         plt.title("Robot path")
@@ -110,31 +140,29 @@ class Plotter:
         ax.axis('equal')
 
         # Plot initial position
-        ax.plot(config.x0[0], config.x0[1], 'r.', label="Initial position")
+        ax.plot(self.controller.x0[0], self.controller.x0[1], 'r.', label="Initial position")
 
         # Plot robot in final position
-        ax.add_patch(plt.Circle((self.mpc.data['_x'][-1, 0], self.mpc.data['_x'][-1, 1]), config.r, color='b', zorder=2))
+        ax.add_patch(plt.Circle((self.data['_x'][-1, 0], self.data['_x'][-1, 1]), self.cfg.r, color='b', zorder=2))
 
         # Plot goal or reference trajectory
-        if config.control_type == "setpoint":
-            ax.plot(config.goal[0], config.goal[1], 'g*', label="Goal")
+        if self.cfg.control_type == "setpoint":
+            ax.plot(self.controller.goal[0], self.controller.goal[1], 'g*', label="Goal")
         else:
-            ax.plot(self.mpc.data['_tvp', 'x_set_point'], self.mpc.data['_tvp', 'y_set_point'], 'k--', label="Reference trajectory", zorder=0)
+            ax.plot(self.data['_tvp', 'x_set_point'], self.data['_tvp', 'y_set_point'], 'k--', label="Reference trajectory", zorder=0)
 
         # Plot moving obstacle trajectory
-        if config.moving_obstacles_on is True:
-            for i in range(len(config.moving_obs)):
+        if self.cfg.moving_obstacles_on is True:
+            for i in range(len(self.cfg.moving_obs)):
+                x_moving_obs, y_moving_obs = self.get_moving_obstacle_path(i)
                 # Plot final position
-                ax.add_patch(plt.Circle((self.mpc.data['_tvp', 'x_moving_obs'+str(i)][-1],
-                                         self.mpc.data['_tvp', 'y_moving_obs'+str(i)][-1]),
-                                        config.moving_obs[i][4], color='k'))
+                ax.add_patch(plt.Circle((x_moving_obs[-1], y_moving_obs[-1]), self.cfg.moving_obs[i][4], color='k'))
                 # Plot path
-                ax.plot(self.mpc.data['_tvp', 'x_moving_obs'+str(i)], self.mpc.data['_tvp', 'y_moving_obs'+str(i)],
-                        'k:', label="Moving Obstacle path", alpha=0.3)
+                ax.plot(x_moving_obs, y_moving_obs, 'k:', label="Moving Obstacle path", alpha=0.3)
 
         # Plot static obstacles
-        if config.static_obstacles_on:
-            for x_obs, y_obs, r_obs in config.obs:
+        if self.cfg.static_obstacles_on:
+            for x_obs, y_obs, r_obs in self.cfg.obs:
                 ax.add_patch(plt.Circle((x_obs, y_obs), r_obs, color='k'))
 
         # Only show unique legends
@@ -142,134 +170,47 @@ class Plotter:
         by_label = dict(zip(labels, handles))
         plt.legend(by_label.values(), by_label.keys(), loc="upper left")
 
-        plt.savefig('images/path.png')
-        plt.show()
+        self.save_figure(fig, 'path.png')
 
     def plot_cbf(self):
-        """Plots the CBF values."""
+        """Plots the CBF values h(x_k) of the robot (the barrier the MPC and the safety filter enforce)."""
 
         if self.controller.static_obstacles_on or self.controller.moving_obstacles_on:
-            cbfs = []
-            if self.controller.static_obstacles_on:
-                for i in range(len(self.controller.obs)):
-                    h = []
-                    for x in self.mpc.data['_x']:
-                        h.append(self.controller.h(x, self.controller.obs[i]))
-                    cbfs.append(h)
-
-            cbfs_mov = []
-            if self.controller.moving_obstacles_on:
-                for i in range(len(self.controller.moving_obs)):
-                    h = []
-                    for x in self.mpc.data['_x']:
-                        obs = (self.mpc.data['_tvp', 'x_moving_obs'+str(i)][i], self.mpc.data['_tvp', 'y_moving_obs'+str(i)][i], self.controller.moving_obs[i][4])
-                        h.append(self.controller.h(x, obs))
-                    cbfs_mov.append(h)
+            t = self.data['_time'].ravel()
+            h = analyze_controller(self.controller)['h'][0]
+            n_obs = len(self.controller.obs)
+            cbfs = h[:, :n_obs].T
+            cbfs_mov = h[:, n_obs:].T
 
             sns.set_theme()
             fig, ax = plt.subplots(figsize=(9, 5))
             for i in range(len(cbfs)):
-                ax.plot(cbfs[i], label="h_obs"+str(i))
+                ax.plot(t, cbfs[i], label="h_obs"+str(i))
             for i in range(len(cbfs_mov)):
-                ax.plot(cbfs_mov[i], label="h_mov_obs"+str(i))
+                ax.plot(t, cbfs_mov[i], label="h_mov_obs"+str(i))
             plt.axhline(y=0, color='k', linestyle='--')
             ax.set_xlabel('Time [s]')
             ax.set_ylabel('h [m]')
             plt.title("CBF Values")
             plt.tight_layout()
             plt.legend()
-            plt.savefig('images/cbf.png')
-            plt.show()
+            self.save_figure(fig, 'cbf.png')
 
-    def create_path_animation(self):
-        """Creates an animation for the robot path in the x-y plane."""
-        global ax
+    def create_path_animation(self, filename='path_animation.gif', n_workers=1):
+        """Creates an animation for the robot path in the x-y plane (see PathAnimation).
 
-        sns.set_theme()
-        fig, ax = plt.subplots(figsize=(9, 5))
-        ax.set_xlabel('x [m]')
-        ax.set_ylabel('y [m]')
-        plt.title("Robot path")
-        plt.tight_layout()
-        ax.axis('equal')
-        offset = 0.5
-        ax.set_xlim([min(self.mpc.data['_x'][:, 0])-offset, max(self.mpc.data['_x'][:, 0])+offset])
-        ax.set_ylim([min(self.mpc.data['_x'][:, 1])-offset, max(self.mpc.data['_x'][:, 1])+offset])
+        Inputs:
+          - filename(str):  The output file in the output directory (.gif, or e.g. .mp4 if ffmpeg is installed)
+          - n_workers(int): Number of worker processes for rendering the frames (None: number of CPUs)
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        PathAnimation.from_controller(self.controller).save(os.path.join(self.output_dir, filename), n_workers=n_workers)
 
-        # Plot goal or reference trajectory
-        if config.control_type == "setpoint":
-            ax.plot(config.goal[0], config.goal[1], 'g*', label="Goal")
-        else:
-            ax.plot(self.mpc.data['_tvp', 'x_set_point'], self.mpc.data['_tvp', 'y_set_point'], 'k--', label="Reference trajectory")
-
-        # Static obstacles
-        if config.static_obstacles_on:
-            for x_obs, y_obs, r_obs in config.obs:
-                ax.add_patch(plt.Circle((x_obs, y_obs), r_obs, color='k'))
 
-        # Moving obstacle
-        if config.moving_obstacles_on is True:
-            for i in range(len(config.moving_obs)):
-                globals()['moving_obs%s' % str(i)] = Circle((0, 0), 0, color='k')
-                ax.add_patch(globals()['moving_obs%s' % str(i)])
-
-        # Robot's heading indicator
-        globals()['robot_heading'] = plt.Arrow(x=0, y=0, dx=0, dy=0, color='k', width=0.1, linewidth=0.6)
-        ax.add_patch(globals()['robot_heading'])
-
-        # Robot base
-        globals()['robot_base'] = Circle((0, 0), config.r)
-        ax.add_patch(globals()['robot_base'])
-
-        # Robot's trace
-        globals()['trace'] = ax.plot([], [], 'b', alpha=0.7, lw=1.5)[0]
-
-        # Legend
-        plt.legend(loc="upper left")
-
-        # Run the animation
-        ani = FuncAnimation(fig, self.animate_path, frames=len(self.mpc.data['_x'][:, 0]), interval=config.Ts*1000, repeat=False)
-        plt.show()
-        # Save animation as gif
-        ani.save('images/path_animation.gif', writer=ImageMagickWriter(fps=config.sim_time/config.Ts))
-
-    def animate_path(self, i):
-        """Draws each frame of the animation."""
-
-        # Robot's heading
-        ax.patches.remove(globals()['robot_heading'])
-        globals()['robot_heading'] = plt.Arrow(x=self.mpc.data['_x'][i, 0],
-                                               y=self.mpc.data['_x'][i, 1],
-                                               dx=np.cos(self.mpc.data['_x'][i, 2])/6,
-                                               dy=np.sin(self.mpc.data['_x'][i, 2])/6,
-                                               color='k',
-                                               width=0.1,
-                                               linewidth=0.6)
-        ax.add_patch(globals()['robot_heading'])
-
-        # Robot's base
-        ax.patches.remove(globals()['robot_base'])
-        globals()['robot_base'] = Circle((self.mpc.data['_x'][i, 0], self.mpc.data['_x'][i, 1]), config.r, zorder=2)
-        ax.add_patch(globals()['robot_base'])
-
-        # Robot's trace
-        tx = [t for t in self.mpc.data['_x'][:i, 0]]  # Trace x-axis positions
-        ty = [t for t in self.mpc.data['_x'][:i, 1]]  # Trace y-axis positions
-        globals()['trace'].set_data(tx, ty)
-
-        # Moving obstacle
-        if config.moving_obstacles_on is True:
-            for i_obs in range(len(config.moving_obs)):
-                ax.patches.remove(globals()['moving_obs%s' % str(i_obs)])
-                globals()['moving_obs%s' % str(i_obs)] = Circle((self.mpc.data['_tvp', 'x_moving_obs'+str(i_obs)][i],
-                                                                 self.mpc.data['_tvp', 'y_moving_obs'+str(i_obs)][i]),
-                                                                config.moving_obs[i_obs][4], color='k', zorder=2)
-                ax.add_patch(globals()['moving_obs%s' % str(i_obs)])
-        return
-
-
-def plot_path_comparisons(results, gammas):
+def plot_path_comparisons(results, gammas, cfg=None):
     """Plots the robot path for each method and different gamma values."""
+    if cfg is None:
+        cfg = config.get_config()
     sns.set_theme()
     fig, ax = plt.subplots(figsize=(9, 5))
     ax.set_xlabel('x [m]')
@@ -293,12 +234,12 @@ def plot_path_comparisons(results, gammas):
     ax.plot(x0[0], x0[1], 'b.', label="Initial position")
 
     # Plot goal
-    ax.plot(config.goal[0], config.goal[1], 'g*', label="Goal")
+    ax.plot(cfg.goal[0], cfg.goal[1], 'g*', label="Goal")
 
     # Plot static obstacles
-    if config.static_obstacles_on:
-        for x_obs, y_obs, r_obs in config.obs:
-            ax.add_patch(plt.Circle((x_obs, y_obs), r_obs + config.r, color='k'))
+    if cfg.static_obstacles_on:
+        for x_obs, y_obs, r_obs in cfg.obs:
+            ax.add_patch(plt.Circle((x_obs, y_obs), r_obs + cfg.r, color='k'))
 
     # Only show unique legends
     handles, labels = plt.gca().get_legend_handles_labels()
@@ -309,6 +250,44 @@ def plot_path_comparisons(results, gammas):
     plt.show()
 
 
+def plot_input_parameterization_tradeoff(results, filename=None):
+    """Plots the solver time against the closed-loop cost of each input parameterization and scenario.
+
+    Inputs:
+      - results(list): The results of benchmark.compare_input_parameterizations
+      - filename(str): The output file of the figure (None: the figure is not saved)
+    Returns:
+      - fig(matplotlib.figure.Figure): The figure, which is left open (the caller shows or closes it)
+    """
+    full = {(r['scenario'], r['T_horizon']): r for r in results if r['input'] == "full"}
+    inputs = list(dict.fromkeys(r['input'] for r in results))
+    scenarios = sorted({r['scenario'] for r in results})
+    markers = dict(zip(inputs, "os^vDP*Xph"))
+    colors = dict(zip(scenarios, sns.color_palette(n_colors=len(scenarios))))
+
+    sns.set_theme()
+    fig, ax = plt.subplots(figsize=(9, 5))
+    for r in results:
+        reference = full.get((r['scenario'], r['T_horizon']))
+        if reference is not None:
+            ax.plot(1000*r['solver_time_p50'], 100*(r['closed_loop_cost']/reference['closed_loop_cost'] - 1),
+                    markers[r['input']], color=colors[r['scenario']])
+    ax.set_xlabel('Solver time p50 [ms]')
+    ax.set_ylabel('Closed-loop cost change [%]')
+    plt.title("Input parameterizations: solve time vs closed-loop cost")
+    plt.tight_layout()
+
+    # Markers for the parameterizations and colors for the scenarios
+    handles = [Line2D([], [], marker=markers[name], color='gray', linestyle='', label=name) for name in inputs]
+    handles += [Line2D([], [], color=colors[scenario], label="Scenario {}".format(scenario)) for scenario in scenarios]
+    plt.legend(handles=handles, loc="best")
+
+    if filename is not None:
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        fig.savefig(filename)
+    return fig
+
+
 def plot_cost_comparisons(costs_dc, costs_cbf, gamma):
     """Plots the objective function cost for each method for all experiments."""
 
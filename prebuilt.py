@@ -0,0 +1,304 @@
+"""Pre-built controllers: a set-up MPC saved to disk and loaded without building it again.
+
+save_controller writes the NLP solver, the dynamics and the objective and auxiliary functions of a
+set-up MPC with CasADi serialization, together with the layout of its decision variables and
+parameters. PrebuiltController loads them and runs the same closed loop as the MPC, without
+do-mpc and without building the symbolic problem, so that a short-lived process only pays for
+importing CasADi and loading the file before its first step:
+
+    save_controller(MPC(cfg), 'nlp_cache/scenario1.pkl')
+    controller = PrebuiltController('nlp_cache/scenario1.pkl')
+    u0 = controller.make_step(x0)
+"""
+
+from dataclasses import replace
+import pickle
+
+import numpy as np
+from casadi import CasadiMeta, DM, Function
+
+from move_blocking import BlockedSolver
+from mpc_cbf import MPC
+
+
+def save_controller(controller, filename):
+    """Saves a set-up MPC, so that it can be loaded with PrebuiltController.
+
+    The solver options (including a solver profile) are part of the saved solver, and the
+    controller is saved in the state it was built with (before any step).
+
+    Inputs:
+      - controller(MPC): The controller, solving the full NLP with IPOPT ("nlp" solver, without input blocking)
+      - filename(str):   The file of the pre-built controller
+    """
+    if (controller.mpc is None or controller.controller == "LTV-MPC" or controller.rti_solver is not None
+            or isinstance(controller.mpc.S, BlockedSolver)):
+        raise ValueError("Only controllers that solve the full NLP with IPOPT can be saved!")
+    mpc = controller.mpc
+    if not np.all(np.array(mpc.opt_x_scaling.cat) == 1):
+        raise ValueError("Controllers with scaled variables can not be saved!")
+    saved = {'casadi_version': CasadiMeta.version(),
+             'cfg': replace(controller.cfg, solver_options=controller.solver_options, solver_profile=None),
+             'solver': mpc.S.serialize(),
+             'aux_fun': mpc.opt_aux_expression_fun.serialize(),
+             'objective_fun': controller.objective_fun.serialize(),
+             'dynamics': controller.dynamics.serialize(),
+             'n_opt_vars': controller.n_opt_vars,
+             'n_x': controller.model.n_x,
+             'n_u': controller.model.n_u,
+             'tvp': controller.model.tvp,
+             'aux_indices': {name: controller.model.aux.f[name] for name in controller.model.aux.keys()},
+             'opt_x': mpc.opt_x,
+             'opt_p': mpc.opt_p,
+             'opt_aux_num': mpc.opt_aux_num,
+             'tvp_template': mpc.get_tvp_template(),
+             'lbx': mpc._lb_opt_x.cat,  # Bounds as passed to the solver (the properties are indexed)
+             'ubx': mpc._ub_opt_x.cat,
+             'lbg': mpc.nlp_cons_lb,
+             'ubg': mpc.nlp_cons_ub}
+    with open(filename, 'wb') as f:
+        pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class PrebuiltController(MPC):
+    """MPC loaded from a file saved by save_controller.
+
+    The solver, the simulator and the estimator are light replacements of the do-mpc ones, built
+    from the saved functions, so the controller computes the same inputs as the saved MPC and
+    supports its closed loop (make_step, reset, simulate, the obstacle updates and the telemetry).
+    The recorded data only holds the states, inputs, times and auxiliary expressions, so the
+    plots of the predictions and saving the results with do-mpc are not available.
+    """
+    def __init__(self, filename):
+        """
+        Inputs:
+          - filename(str): The file of the pre-built controller
+        """
+        with open(filename, 'rb') as f:
+            self.saved = pickle.load(f)
+        if self.saved['casadi_version'] != CasadiMeta.version():
+            raise ValueError("The controller was saved with CasADi {} but CasADi {} is installed!".format(
+                self.saved['casadi_version'], CasadiMeta.version()))
+        super().__init__(self.saved['cfg'])
+
+    @staticmethod
+    def import_dependencies():
+        """The pre-built controller does not need do_mpc."""
+
+    def build(self):
+        """Loads the model, the mpc controller, the simulator and the estimator from the saved file."""
+        saved = self.saved
+        self.model = SavedModel(saved['n_x'], saved['n_u'], saved['tvp'], saved['aux_indices'])
+        self.dynamics = Function.deserialize(saved['dynamics'])
+        self.objective_fun = Function.deserialize(saved['objective_fun'])
+        self.mpc = self.set_tvp_for_mpc(SavedOptimizer(saved, self.model, self.Ts))
+        self.n_opt_vars = saved['n_opt_vars']
+        self.nlp_solver = self.mpc.S
+        self.rti_solver = None
+        self.shift_indices = self.get_shift_indices(self.mpc)
+        self.active_indices = self.get_active_indices(self.mpc)
+        self.simulator = SavedSimulator(self.model, self.Ts, self.dynamics)
+        self.estimator = SavedSimulator(self.model, self.Ts)
+        self.saved = None  # The loaded objects are kept by the components
+
+
+class SavedModel:
+    """The dimensions and the structures of the model of a pre-built controller."""
+    def __init__(self, n_x, n_u, tvp, aux_indices):
+        """
+        Inputs:
+          - n_x(int):           Number of states
+          - n_u(int):           Number of inputs
+          - tvp(struct):        The structure of the time-varying parameters of a stage
+          - aux_indices(dict):  The indices of each auxiliary expression in the auxiliary vector
+        """
+        self.n_x = n_x
+        self.n_u = n_u
+        self.tvp = tvp
+        self.aux_indices = aux_indices
+        self.n_aux = sum(len(indices) for indices in aux_indices.values())
+
+
+class SavedData:
+    """Closed-loop data of a pre-built controller, indexed like the do-mpc data ('_x', ('_aux', 'cost'), ...)."""
+    def __init__(self, model):
+        """
+        Inputs:
+          - model(SavedModel): The model
+        """
+        self.model = model
+        # Size of each field, as in the do-mpc data
+        self.data_fields = {'_x': model.n_x, '_u': model.n_u, '_time': 1, '_aux': model.n_aux}
+        self.init_storage()
+
+    def init_storage(self):
+        """Removes all data."""
+        self._x, self._u, self._time, self._aux = [], [], [], []
+
+    def update(self, **values):
+        """Appends the values of a step, e.g. update(_x=x0, _u=u0)."""
+        for name, value in values.items():
+            getattr(self, name).append(np.ravel(value))
+
+    def __getitem__(self, key):
+        """Returns the stored values of a field [n_steps x size], or of an auxiliary expression for ('_aux', name)."""
+        name, aux_name = key if isinstance(key, tuple) else (key, None)
+        values = getattr(self, name)
+        values = np.array(values) if len(values) > 0 else np.zeros((0, self.data_fields[name]))
+        if aux_name is not None:
+            return values[:, self.model.aux_indices[aux_name]]
+        return values
+
+
+class SavedOptimizer:
+    """Replacement of the do-mpc MPC that solves the saved NLP with the same parameters and warm start."""
+    def __init__(self, saved, model, Ts):
+        """
+        Inputs:
+          - saved(dict):       The contents of the file of the pre-built controller
+          - model(SavedModel): The model
+          - Ts(float):         The sampling time [s]
+        """
+        self.model = model
+        self.Ts = Ts
+        self.S = Function.deserialize(saved['solver'])
+        self.opt_aux_expression_fun = Function.deserialize(saved['aux_fun'])
+        self.opt_x = saved['opt_x']
+        self.opt_p = saved['opt_p']
+        self.opt_x_num = self.opt_x(0)
+        self.opt_p_num = self.opt_p(0)
+        self.opt_aux_num = saved['opt_aux_num']
+        self.tvp_template = saved['tvp_template']
+        self.lbx, self.ubx = saved['lbx'], saved['ubx']
+        self.lbg, self.ubg = saved['lbg'], saved['ubg']
+        self.lam_x_num = DM.zeros(self.lbx.shape)
+        self.lam_g_num = DM.zeros(self.lbg.shape)
+        self.opt_g_num = DM.zeros(self.lbg.shape)
+        self.solver_stats = {}
+        self.flags = {'initial_run': False}  # Whether the next solve is warm started with the last multipliers
+        self.data = SavedData(model)
+        self.tvp_fun = None
+        self.t0 = 0.0
+        self.x0 = np.zeros(model.n_x)
+        self.u0 = np.zeros(model.n_u)
+
+    @property
+    def t0(self):
+        """The current time [s] [1]."""
+        return self._t0
+
+    @t0.setter
+    def t0(self, value):
+        self._t0 = np.ravel(np.asarray(value, dtype=float)).copy()
+
+    @property
+    def x0(self):
+        """The current state [n_x x 1]."""
+        return self._x0
+
+    @x0.setter
+    def x0(self, value):
+        self._x0 = DM(np.ravel(np.asarray(value, dtype=float)))
+
+    @property
+    def u0(self):
+        """The last input [n_u x 1]."""
+        return self._u0
+
+    @u0.setter
+    def u0(self, value):
+        self._u0 = DM(np.ravel(np.asarray(value, dtype=float)))
+
+    def get_tvp_template(self):
+        """Returns the structure of the time-varying parameters of all stages."""
+        return self.tvp_template
+
+    def set_tvp_fun(self, tvp_fun):
+        """Sets the function that returns the time-varying parameters of all stages for the current time."""
+        self.tvp_fun = tvp_fun
+
+    def set_initial_guess(self):
+        """Sets the current state and input as initial guess for all stages."""
+        self.opt_x_num['_x'] = self._x0
+        self.opt_x_num['_u'] = self._u0
+
+    def reset_history(self):
+        """Removes the data and sets the time back to zero."""
+        self.data.init_storage()
+        self.t0 = 0.0
+
+    def make_step(self, x0):
+        """Solves the NLP for the current state and returns the first input.
+
+        Inputs:
+          - x0(np.ndarray): The current state [n_x x 1]
+        Returns:
+          - u0(np.ndarray): The control input [n_u x 1]
+        """
+        t0 = self._t0
+        tvp0 = self.tvp_fun(t0)
+        self.opt_p_num['_x0'] = DM(x0)
+        self.opt_p_num['_u_prev'] = self._u0
+        self.opt_p_num['_tvp'] = tvp0['_tvp']
+        self.solve()
+
+        u0 = self.opt_x_num['_u', 0, 0]
+        self.data.update(_x=x0, _u=u0, _time=t0, _aux=self.opt_aux_num['_aux', 0, 0])
+        self.t0 = t0 + self.Ts
+        self.x0 = x0
+        self.u0 = u0
+        return np.array(u0)
+
+    def solve(self):
+        """Solves the NLP, warm started from the last solution (and its multipliers after the first solve)."""
+        kwargs = {'x0': self.opt_x_num, 'lbx': self.lbx, 'ubx': self.ubx, 'lbg': self.lbg, 'ubg': self.ubg,
+                  'p': self.opt_p_num}
+        if self.flags['initial_run']:
+            kwargs.update({'lam_x0': self.lam_x_num, 'lam_g0': self.lam_g_num})
+        r = self.S(**kwargs)
+        self.opt_x_num.master = r['x']
+        self.opt_g_num = r['g']
+        self.lam_g_num = r['lam_g']
+        self.lam_x_num = r['lam_x']
+        self.solver_stats = self.S.stats()
+        self.opt_aux_num.master = self.opt_aux_expression_fun(self.opt_x_num, self.opt_p_num)
+        self.flags['initial_run'] = True
+
+
+class SavedSimulator:
+    """Replacement of the do-mpc simulator (with the dynamics) or state feedback estimator (without them)."""
+    def __init__(self, model, Ts, dynamics=None):
+        """
+        Inputs:
+          - model(SavedModel):   The model
+          - Ts(float):           The sampling time [s]
+          - dynamics(Function):  The discrete dynamics x_{k+1} = f(x_k, u_k) (None: state feedback)
+        """
+        self.Ts = Ts
+        self.dynamics = dynamics
+        self.data = SavedData(model)
+        self.x0 = np.zeros((model.n_x, 1))
+        self.t0 = 0.0
+
+    def reset_history(self):
+        """Removes the data and sets the time back to zero."""
+        self.data.init_storage()
+        self.t0 = 0.0
+
+    def make_step(self, value):
+        """Simulates one step with the input (simulator) or returns the measured state (state feedback).
+
+        Inputs:
+          - value(np.ndarray): The input [n_u x 1] (simulator) or the measured state [n_x x 1] (state feedback)
+        Returns:
+          - x_next(np.ndarray): The next state [n_x x 1]
+        """
+        if self.dynamics is None:
+            x_next = np.array(value, dtype=float).reshape(-1, 1)
+            self.data.update(_x=x_next, _time=self.t0)
+        else:
+            x_next = np.array(self.dynamics(self.x0, value))
+            self.data.update(_x=self.x0, _u=value, _time=self.t0)
+        self.x0 = x_next
+        self.t0 += self.Ts
+        return x_next
@@ -0,0 +1,197 @@
+"""Headless reports of saved runs.
+
+Renders the figures and animations of the Plotter for each saved run on a pool of worker
+processes, into one directory per run, and writes an index page that links them all:
+
+    python report.py 001_MPC-CBF_setpoint_gamma0.1 001_MPC-DC_setpoint --scenario 1
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import html
+import json
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+from do_mpc.data import load_results
+
+from analytics import analyze_controller
+import config
+from plotter import Plotter
+from results_store import parse_result_name
+
+# Outputs of each run: name, Plotter method and output file
+report_plots = [('trajectories', 'plot_results', 'trajectories.png'),
+                ('predictions', 'plot_predictions', 'predictions.png'),
+                ('path', 'plot_path', 'path.png'),
+                ('cbf', 'plot_cbf', 'cbf.png'),
+                ('path_animation', 'create_path_animation', 'path_animation.gif'),
+                ('trajectories_animation', 'create_trajectories_animation', 'trajectories_animation.gif')]
+
+# Outputs that need the MPC data with the predictions (not available for the safety filter)
+prediction_plots = ['predictions', 'trajectories_animation']
+
+# Metrics of each run on the index page (see analytics.analyze_runs)
+summary_keys = ['steps', 'total_cost', 'min_clearance', 'violations', 'collisions', 'time_to_goal']
+
+
+class SavedRun:
+    """A saved closed-loop run, with the attributes of the controller that the Plotter and the analytics use."""
+    def __init__(self, name, cfg, results_dir='results/'):
+        """
+        Inputs:
+          - name(str):          The name of the result (the pickle file without extension)
+          - cfg(config.Config): The settings of the run
+          - results_dir(str):   The directory of the results
+        """
+        results = load_results(os.path.join(results_dir, name + '.pkl'))
+        self.name = name
+        self.cfg = cfg
+        self.has_predictions = 'mpc' in results
+        self.data = results['mpc'] if self.has_predictions else results['simulator']
+        self.Ts = cfg.Ts
+        self.x0 = cfg.x0
+        self.r = cfg.r
+        self.safety_dist = cfg.safety_dist
+        self.control_type = cfg.control_type
+        self.goal = cfg.goal
+        self.static_obstacles_on = cfg.static_obstacles_on
+        self.moving_obstacles_on = cfg.moving_obstacles_on
+        self.obs = cfg.obs if cfg.static_obstacles_on else []
+        self.moving_obs = cfg.moving_obs if cfg.moving_obstacles_on else []
+
+
+def get_run_settings(name, **settings):
+    """Returns the settings of a saved run: the ones in its name (see util.get_result_name) and the given ones.
+
+    Inputs:
+      - name(str): The name of the result
+      - settings:  Settings that the name does not include, e.g. scenario=1
+    Returns:
+      - settings(dict): The settings for config.get_config
+    """
+    run_settings = {key: value for key, value in parse_result_name(name).items()
+                    if key in ['controller', 'control_type', 'gamma'] and value is not None}
+    run_settings.update(settings)
+    return run_settings
+
+
+def render_run_output(name, settings, plot, output_dir, results_dir='results/'):
+    """Renders one output of a saved run without showing it (runs in a worker process).
+
+    Inputs:
+      - name(str):        The name of the result
+      - settings(dict):   The settings of the run
+      - plot(str):        The name of the output in report_plots
+      - output_dir(str):  The directory of the run's outputs
+      - results_dir(str): The directory of the results
+    Returns:
+      - filename(str): The output file, relative to output_dir (None if the run has no such output)
+    """
+    plt.switch_backend('Agg')  # Render without a display
+    run = SavedRun(name, config.get_config(**settings), results_dir)
+    _, method, filename = next(p for p in report_plots if p[0] == plot)
+    if plot in prediction_plots and not run.has_predictions:
+        return None
+    if plot == 'cbf' and not run.obs and not run.moving_obs:
+        return None
+    getattr(Plotter(run, output_dir=output_dir, show=False), method)()
+    return filename
+
+
+def get_run_summary(name, settings, results_dir='results/'):
+    """Computes the metrics of a saved run for the index page (None for the ones that do not apply)."""
+    run = SavedRun(name, config.get_config(**settings), results_dir)
+    metrics = analyze_controller(run)
+    metrics['steps'] = [len(run.data['_time'])]
+    return {key: np.asarray(metrics[key][0]).item() if key in metrics else None for key in summary_keys}
+
+
+def generate_report(runs, output_dir='reports', results_dir='results/', plots=None, n_workers=None, **settings):
+    """Renders the outputs of saved runs on a pool of worker processes and writes an index page.
+
+    The outputs of each run go to their own directory output_dir/<run name>/, and
+    output_dir/index.html shows the settings, metrics and outputs of all runs.
+
+    Inputs:
+      - runs(list):        The names of the results, or (name, settings dict) tuples
+      - output_dir(str):   The report directory
+      - results_dir(str):  The directory of the results
+      - plots(list):       The names of the outputs in report_plots (defaults to all)
+      - n_workers(int):    Number of worker processes (defaults to the number of CPUs)
+      - settings:          Settings of all runs that their names do not include, e.g. scenario=1
+    Returns:
+      - index(str): The path of the index page
+    """
+    if plots is None:
+        plots = [p[0] for p in report_plots]
+    runs = [(run, {}) if isinstance(run, str) else run for run in runs]
+    run_settings = [get_run_settings(name, **dict(settings, **s)) for name, s in runs]
+    names = [name for name, _ in runs]
+
+    tasks = [(name, s, plot, os.path.join(output_dir, name), results_dir)
+             for name, s in zip(names, run_settings) for plot in plots]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # Start the slow animations first
+        order = sorted(range(len(tasks)), key=lambda i: 'animation' not in tasks[i][2])
+        futures = {i: executor.submit(render_run_output, *tasks[i]) for i in order}
+        summaries = list(executor.map(get_run_summary, names, run_settings, [results_dir]*len(names)))
+        outputs = [futures[i].result() for i in range(len(tasks))]
+
+    outputs = np.array(outputs, dtype=object).reshape(len(names), len(plots))
+    os.makedirs(output_dir, exist_ok=True)
+    index = os.path.join(output_dir, 'index.html')
+    with open(index, 'w') as f:
+        f.write(get_index_page(names, run_settings, summaries, outputs))
+    return index
+
+
+def get_index_page(names, run_settings, summaries, outputs):
+    """Creates the HTML of the index page.
+
+    Inputs:
+      - names(list):          The names of the runs
+      - run_settings(list):   The settings of each run
+      - summaries(list):      The metrics of each run
+      - outputs(np.ndarray):  The output files of each run [n_runs x n_plots] (None if missing)
+    Returns:
+      - page(str): The HTML page
+    """
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>MPC-CBF report</title>',
+             '<style>body{font-family:sans-serif} table{border-collapse:collapse} td,th{border:1px solid #ccc;'
+             'padding:2px 8px} img{width:450px;margin:4px}</style></head><body>', '<h1>MPC-CBF report</h1>',
+             '<table><tr><th>Run</th><th>Settings</th>' + ''.join('<th>{}</th>'.format(key) for key in summary_keys)
+             + '</tr>']
+    for name, settings, summary in zip(names, run_settings, summaries):
+        values = ''.join('<td>{}</td>'.format(format_value(value)) for value in summary.values())
+        lines.append('<tr><td><a href="#{0}">{0}</a></td><td>{1}</td>{2}</tr>'.format(
+            html.escape(name), html.escape(json.dumps(settings, default=str)), values))
+    lines.append('</table>')
+    for name, files in zip(names, outputs):
+        lines.append('<h2 id="{0}">{0}</h2>'.format(html.escape(name)))
+        lines += ['<a href="{0}/{1}"><img src="{0}/{1}"></a>'.format(html.escape(name), filename)
+                  for filename in files if filename is not None]
+    lines.append('</body></html>')
+    return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    """Formats a metric for the index page."""
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '-' if np.isnan(value) else '{:.4g}'.format(value)
+    return str(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Renders the figures and animations of saved runs.")
+    parser.add_argument('runs', nargs='+', help="Names of the results in the results directory")
+    parser.add_argument('--scenario', type=int, default=None, help="Scenario of the runs (1-6)")
+    parser.add_argument('--output-dir', default='reports', help="Report directory")
+    parser.add_argument('--results-dir', default='results/', help="Results directory")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+    scenario = {} if args.scenario is None else {'scenario': args.scenario}
+    print(generate_report(args.runs, args.output_dir, args.results_dir, n_workers=args.workers, **scenario))
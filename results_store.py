@@ -0,0 +1,210 @@
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+# Columns stored for each run: the closed-loop data and the solver statistics
+data_columns = ['_time', '_x', '_u', '_aux', '_tvp', 'success', 't_wall_total']
+telemetry_columns = ['t_wall', 'iter_count', 'deadline_miss', 'fallback', 'unsafe_fallback']
+
+# Metadata of each run that the runs can be selected by
+index_keys = ['controller', 'control_type', 'gamma', 'scenario', 'seed']
+
+
+class ResultsStore:
+    """Columnar store of closed-loop simulation results.
+
+    Each column (e.g. '_x', '_u', '_aux') is a flat binary file of float64 values in the store
+    directory, to which the runs are appended. The index file has one JSON line per run with its
+    name, its metadata (controller, control type, gamma, scenario, seed) and the offset and shape
+    of each of its columns, so the columns are memory-mapped and only the requested columns of
+    the selected runs are read from the disk.
+
+    The columns of a run are written before its index line, so an interrupted append leaves
+    unreferenced data at the end of the column files, but never a corrupt run. Appending is not
+    safe from several processes at the same time.
+    """
+    def __init__(self, path='results/store'):
+        """
+        Inputs:
+          - path(str): The store directory (created if it does not exist)
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index_file = os.path.join(path, 'index.jsonl')
+        self.runs = self.read_index()  # Index entries of all runs
+        self.maps = {}                 # Memory maps of the column files
+
+    def read_index(self):
+        """Reads the index entries of the stored runs."""
+        if not os.path.isfile(self.index_file):
+            return []
+        with open(self.index_file) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def get_column_file(self, column):
+        """Returns the path of the file of a column."""
+        return os.path.join(self.path, column + '.f64')
+
+    def append(self, name, columns, **metadata):
+        """Appends a run to the store.
+
+        Inputs:
+          - name(str):       Name of the run (e.g. the name of its pickle file)
+          - columns(dict):   The arrays of the run by column name, each with one row per time step
+          - metadata:        The values of index_keys (missing ones are stored as None) and any other metadata
+        Returns:
+          - run(int): The number of the run in the store
+        """
+        entry = {'run': len(self.runs), 'name': name}
+        entry.update({key: None for key in index_keys})
+        entry.update({key: to_json(value) for key, value in metadata.items()})
+        entry['columns'] = {}
+        for column, values in columns.items():
+            values = np.asarray(values, dtype=np.float64)
+            values = values.reshape(len(values), -1)
+            with open(self.get_column_file(column), 'ab') as f:
+                offset = f.tell()//8
+                f.write(values.tobytes())
+            entry['columns'][column] = [offset, values.shape[0], values.shape[1]]
+
+        with open(self.index_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.runs.append(entry)
+        return entry['run']
+
+    def select(self, **metadata):
+        """Returns the numbers of the runs with the given metadata, e.g. select(controller="MPC-DC", seed=[1, 2]).
+
+        Inputs:
+          - metadata: The required value of each key, or a list of allowed values
+        Returns:
+          - runs(list): The numbers of the matching runs, in the order they were stored
+        """
+        conditions = {key: value if isinstance(value, (list, tuple, range)) else [value]
+                      for key, value in metadata.items()}
+        return [entry['run'] for entry in self.runs
+                if all(entry.get(key) in values for key, values in conditions.items())]
+
+    def get_metadata(self, runs=None):
+        """Returns the index entries of the given runs (defaults to all runs)."""
+        if runs is None:
+            return list(self.runs)
+        return [self.runs[run] for run in runs]
+
+    def get_map(self, column):
+        """Returns the memory map of a column file, mapped again if the file has grown."""
+        size = os.path.getsize(self.get_column_file(column))//8
+        if column not in self.maps or len(self.maps[column]) != size:
+            self.maps[column] = np.memmap(self.get_column_file(column), dtype=np.float64, mode='r', shape=(size,))
+        return self.maps[column]
+
+    def load(self, column, runs=None):
+        """Loads one column of the given runs.
+
+        Inputs:
+          - column(str): The column name, e.g. '_x'
+          - runs(list):  The numbers of the runs (defaults to all runs)
+        Returns:
+          - values(list): The (read-only, memory-mapped) array of each run [n_steps x n_values]
+        """
+        if runs is None:
+            runs = range(len(self.runs))
+        values = []
+        column_map = None
+        for run in runs:
+            if column not in self.runs[run]['columns']:
+                raise KeyError("Run {} has no column '{}'.".format(run, column))
+            if column_map is None:
+                column_map = self.get_map(column)
+            offset, n_rows, n_cols = self.runs[run]['columns'][column]
+            values.append(column_map[offset:offset + n_rows*n_cols].reshape(n_rows, n_cols))
+        return values
+
+    def load_stacked(self, column, runs=None):
+        """Loads one column of runs with the same number of steps as a single array [n_runs x n_steps x n_values]."""
+        values = self.load(column, runs)
+        if len({v.shape for v in values}) > 1:
+            raise ValueError("The runs have different shapes for column '{}'.".format(column))
+        return np.stack(values)
+
+
+def to_json(value):
+    """Converts NumPy scalars to plain Python values for the index."""
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def get_run_columns(controller):
+    """Extracts the columns of the last simulation of a controller.
+
+    Inputs:
+      - controller(MPC): The controller after the simulation
+    Returns:
+      - columns(dict): The arrays of the run by column name
+    """
+    columns = get_data_columns(controller.data)
+    telemetry = controller.get_telemetry()
+    for column in telemetry_columns:
+        columns[column] = telemetry[column]
+    return columns
+
+
+def get_data_columns(data):
+    """Extracts the stored columns of a do-mpc data object (the ones that it has)."""
+    columns = {}
+    for column in data_columns:
+        if column in data.data_fields and data.data_fields[column] > 0:
+            columns[column] = data[column]
+    return columns
+
+
+def get_run_metadata(cfg, seed=None):
+    """Returns the metadata of a run with the settings cfg (config.Config)."""
+    return {'controller': cfg.controller, 'control_type': cfg.control_type,
+            'gamma': cfg.gamma if cfg.controller != "MPC-DC" else None, 'scenario': cfg.scenario, 'seed': seed}
+
+
+def parse_result_name(name):
+    """Recovers the metadata of a result from its name, as created by util.get_result_name.
+
+    Inputs:
+      - name(str): The name, e.g. '012_MPC-CBF_setpoint_gamma0.1'
+    Returns:
+      - metadata(dict): The controller, control type, gamma and seed (the episode number), None if unknown
+    """
+    match = re.fullmatch(r'(?:(\d+)_)?(MPC-CBF|MPC-DC|LTV-MPC|CBF-QP)_(setpoint|traj_tracking)(?:_gamma([0-9.eE+-]+))?',
+                         name)
+    if match is None:
+        return {}
+    seed, controller, control_type, gamma = match.groups()
+    return {'controller': controller, 'control_type': control_type,
+            'gamma': float(gamma) if gamma is not None else None,
+            'seed': int(seed) if seed is not None else None}
+
+
+def import_pickles(store, results_dir='results/', scenario=None):
+    """Imports the do-mpc pickles of a results directory into the store (skipping the ones already imported).
+
+    The metadata is parsed from the filenames. The MPC data is imported when it exists, otherwise
+    the simulator data (e.g. for the safety filter).
+
+    Inputs:
+      - store(ResultsStore): The store
+      - results_dir(str):    The directory with the pickle files
+      - scenario(int):       The scenario of the results, which is not part of the filenames (optional)
+    Returns:
+      - runs(list): The numbers of the imported runs
+    """
+    from do_mpc.data import load_results
+    imported = {entry['name'] for entry in store.runs}
+    runs = []
+    for filename in sorted(glob.glob(os.path.join(results_dir, '*.pkl'))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if name in imported:
+            continue
+        results = load_results(filename)
+        data = results['mpc'] if 'mpc' in results else results['simulator']
+        runs.append(store.append(name, get_data_columns(data), scenario=scenario, **parse_result_name(name)))
+    return runs
@@ -0,0 +1,329 @@
+import itertools
+import time
+
+import numpy as np
+from casadi import evalf
+
+import config
+from mpc_cbf import MPC
+
+
+class SafetyFilter(MPC):
+    """CBF-QP safety filter:
+
+    min (u_k - u_nom_k)^T*W*(u_k - u_nom_k)   over u_k
+    s.t.
+        h(p_{k+1}(ū_k), o_{k+1}) + 2*(p_{k+1}(ū_k) - o_{k+1})^T*T_s*B_p(x_k)*(u_k - ū_k) >= (1-γ)*h(p_k, o_k)
+        h(q_k, o_{k+1}) + 2*(q_k - o_{k+1})^T*J_q(x_k)*u_k >= (1-γ)*h(q_k, o_k)
+        u_min <= u_k <= u_max
+
+    for each obstacle, where u_nom_k is the command of a nominal go-to-goal (or reference following)
+    controller, W = diag(filter_weights), p_k the robot position, o_k the obstacle position and
+    p_{k+1}(u_k) = p_k + T_s*B_p(x_k)*u_k the next position with the position rows B_p of B.
+
+    The first constraint is the discrete CBF condition h(x_{k+1}) >= (1-γ)*h(x_k) of the robot,
+    linearized around the nominal input ū_k = u_nom_k. The next position is affine in u_k and h is
+    convex in the position, so the linearization is a lower bound of h(x_{k+1}) and every input
+    that satisfies it satisfies the discrete CBF condition. The applied input is checked against
+    the exact condition all the same.
+
+    The robot position can only be moved by the linear velocity in one step, so the second
+    constraint makes the robot turn away from the obstacles in time: it is the barrier of the
+    point q_k at the lookahead distance l ahead of the robot, linearized around u_k = 0, with
+    J_q(x_k) = T_s*[heading, l*normal]. It is an approximation (q_{k+1} is nonlinear in ω), so it
+    is dropped if the constraints are infeasible together.
+
+    The QP has two variables, so at most two constraints are active at the solution and it is
+    solved in closed form by checking the unconstrained solution, the projections onto each
+    constraint and the intersections of each pair of constraints.
+
+    The model, obstacles, simulator and telemetry are shared with the MPC, but there is no
+    optimization problem over a horizon (the mpc attribute is None).
+    """
+    def __init__(self, cfg=None):
+        """
+        Inputs:
+          - cfg(config.Config): The settings (defaults to the current settings of the config module)
+        """
+        if cfg is None:
+            cfg = config.get_config()
+        self.k_v = cfg.k_v                     # Gain of the nominal linear velocity
+        self.k_omega = cfg.k_omega             # Gain of the nominal angular velocity
+        self.goal_tol = cfg.goal_tol           # Distance to the goal below which the nominal controller only turns
+        self.lookahead = cfg.filter_lookahead  # Distance of the point ahead of the robot for the barrier
+        self.W = np.array(cfg.filter_weights)  # Weights of the deviation from the nominal input
+        self.t0 = 0                            # Current time
+        self.x_now = None                      # Current state
+        super().__init__(cfg)
+
+    def define_mpc(self):
+        """There is no optimization problem over a horizon for the safety filter."""
+        self.n_opt_vars = 2  # The inputs are the variables of the QP
+        return None
+
+    def define_simulator(self):
+        """Configures the simulator, which also records the reference and the obstacles.
+
+        Returns:
+          - simulator(do_mpc.simulator.Simulator): The simulator
+        """
+        import do_mpc
+        simulator = do_mpc.simulator.Simulator(self.model)
+        simulator.set_param(t_step=self.Ts)
+
+        # Add time-varying parameters
+        tvp_template = simulator.get_tvp_template()
+
+        def tvp_fun(t_now):
+            if self.control_type == "setpoint":
+                tvp_template['goal'] = self.goal
+            else:
+                tvp_template['x_set_point'], tvp_template['y_set_point'] = self.get_reference([t_now])[0]
+            obstacle_slots = self.get_obstacle_slots([t_now, t_now + self.Ts])
+            for i in range(self.n_obs_slots):
+                tvp_template['obs_slot'+str(i)] = obstacle_slots[0, i]
+                tvp_template['obs_next'+str(i)] = obstacle_slots[1, i, :2]
+            return tvp_template
+        simulator.set_tvp_fun(tvp_fun)
+
+        simulator.setup()
+
+        return simulator
+
+    @property
+    def data(self):
+        """The closed-loop data (recorded by the simulator)."""
+        return self.simulator.data
+
+    def set_init_state(self):
+        """Sets the initial state in all components."""
+        self.t0 = 0
+        self.x_now = np.ravel(self.x0)
+        self.simulator.x0 = self.x0
+        self.estimator.x0 = self.x0
+
+    def reset(self, x0=None, goal=None):
+        """Prepares the filter for a new episode.
+
+        Inputs:
+          - x0(np.ndarray): The new initial pose (optional)
+          - goal(list):     The new goal pose, for set point control (optional)
+        """
+        if x0 is not None:
+            self.x0 = np.array(x0)
+        if goal is not None:
+            if self.control_type != "setpoint":
+                raise ValueError("A goal can only be set for set point control!")
+            self.goal = goal
+
+        self.simulator.reset_history()
+        self.estimator.reset_history()
+        self.telemetry = self.get_empty_telemetry()
+        self.set_init_state()
+        self.n_resets += 1
+
+    def get_predicted_path(self):
+        """Returns the current position (there are no predictions)."""
+        return np.array([self.x_now[:2]])
+
+    def get_nominal_control(self, x, t):
+        """Computes the nominal control input, which drives the robot to the goal or along the reference.
+
+        Inputs:
+          - x(np.ndarray): The current state [3]
+          - t(float):      The current time [s]
+        Returns:
+          - u_nom(np.ndarray): The nominal control input [2]
+        """
+        if self.control_type == "setpoint":
+            target = np.ravel(self.goal)[:2]
+        else:
+            target = self.get_reference([t + self.Ts])[0]
+        e = target - x[:2]
+        dist = np.hypot(e[0], e[1])
+        alpha = np.arctan2(np.sin(np.arctan2(e[1], e[0]) - x[2]), np.cos(np.arctan2(e[1], e[0]) - x[2]))
+
+        if self.control_type == "setpoint" and dist < self.goal_tol:
+            # Turn to the goal orientation
+            theta_error = self.goal[2] - x[2]
+            u_nom = np.array([0, self.k_omega*np.arctan2(np.sin(theta_error), np.cos(theta_error))])
+        else:
+            u_nom = np.array([self.k_v*dist*np.cos(alpha), self.k_omega*alpha])
+        return np.clip(u_nom, -self.u_limit, self.u_limit)
+
+    @property
+    def u_limit(self):
+        """The actuator limits [2]."""
+        return np.array([self.v_limit, self.omega_limit])
+
+    def get_cbf_constraints(self, x, t, u_lin):
+        """Computes the linearized discrete CBF constraints A*u + b >= 0 for the active obstacles.
+
+        Inputs:
+          - x(np.ndarray):     The current state [3]
+          - t(float):          The current time [s]
+          - u_lin(np.ndarray): The input the CBF condition of the robot is linearized around [2]
+        Returns:
+          - A(np.ndarray): The constraint matrix, the robot rows first and then the lookahead point rows [2*n_obs x 2]
+          - b(np.ndarray): The constraint offsets [2*n_obs]
+        """
+        obstacle_slots = self.get_obstacle_slots([t, t + self.Ts])
+        active = obstacle_slots[0, :, 3] > 0
+        obs_now, obs_next = obstacle_slots[0, active, :3], obstacle_slots[1, active, :3]
+        safe_dist = self.r + obs_now[:, 2] + self.safety_dist
+
+        # Discrete CBF condition of the robot, linearized around u_lin (the next position is affine in u)
+        B_p = self.Ts*np.array(evalf(self.get_sys_matrix_B(x)))[:2]
+        d_lin = x[:2] + B_p@u_lin - obs_next[:, :2]
+        h_now = np.sum((x[:2] - obs_now[:, :2])**2, axis=1) - safe_dist**2
+        A_robot = 2*d_lin@B_p
+        b_robot = np.sum(d_lin**2, axis=1) - safe_dist**2 - A_robot@u_lin - (1-self.gamma)*h_now
+
+        # Barrier of the point at distance l ahead of the robot
+        l = self.lookahead
+        heading = np.array([np.cos(x[2]), np.sin(x[2])])
+        normal = np.array([-np.sin(x[2]), np.cos(x[2])])
+        q = x[:2] + l*heading
+        safe_dist = safe_dist + l
+        h_now = np.sum((q - obs_now[:, :2])**2, axis=1) - safe_dist**2
+        d_next = q - obs_next[:, :2]
+        h_next = np.sum(d_next**2, axis=1) - safe_dist**2
+
+        # Linearization of the point's next position wrt the inputs
+        dq_du = self.Ts*np.stack([heading, l*normal], axis=1)
+        A = 2*d_next@dq_du
+        b = h_next - (1-self.gamma)*h_now
+        return np.vstack([A_robot, A]), np.concatenate([b_robot, b])
+
+    def get_cbf_margins(self, x, u, t):
+        """Computes the margins h(x_{k+1}) - (1-γ)*h(x_k) of the discrete CBF condition of the robot for an input.
+
+        Inputs:
+          - x(np.ndarray): The current state [3]
+          - u(np.ndarray): The input [2]
+          - t(float):      The current time [s]
+        Returns:
+          - margins(np.ndarray): The margin for each active obstacle (negative if the condition is violated)
+        """
+        obstacle_slots = self.get_obstacle_slots([t, t + self.Ts])
+        active = obstacle_slots[0, :, 3] > 0
+        x_next = np.array(self.dynamics(x, u)).ravel()
+        h_now = self.h(x, obstacle_slots[0, active, :3].T)
+        h_next = self.h(x_next, obstacle_slots[1, active, :3].T)
+        return h_next - (1-self.gamma)*h_now
+
+    def solve_qp(self, u_nom, A, b):
+        """Finds the input closest to the nominal input that satisfies the constraints A*u + b >= 0 and the limits.
+
+        Inputs:
+          - u_nom(np.ndarray): The nominal input [2]
+          - A(np.ndarray):     The constraint matrix [n_obs x 2]
+          - b(np.ndarray):     The constraint offsets [n_obs]
+        Returns:
+          - u(np.ndarray):   The filtered input [2]
+          - success(bool):   Whether the constraints are feasible
+          - n_active(int):   The number of active constraints (0 if the nominal input is safe)
+        """
+        # Add the actuator limits as constraints
+        G = np.vstack([A, np.eye(2), -np.eye(2)])
+        c = np.concatenate([b, self.u_limit, self.u_limit])
+        tol = 1e-9
+
+        if np.all(G@u_nom + c >= -tol):
+            return u_nom, True, 0
+
+        # Candidates with one active constraint: projections onto G_i*u + c_i = 0
+        W_inv = 1/self.W
+        norms = np.sum(G**2*W_inv, axis=1)
+        valid = norms > 0
+        candidates = [u_nom - np.outer((G[valid]@u_nom + c[valid])/norms[valid], np.ones(2))*G[valid]*W_inv]
+        n_active = [np.ones(np.sum(valid), dtype=int)]
+
+        # Candidates with two active constraints: intersections of G_i*u + c_i = 0 and G_j*u + c_j = 0
+        pairs = np.array(list(itertools.combinations(range(len(G)), 2)))
+        Gi, Gj = G[pairs[:, 0]], G[pairs[:, 1]]
+        det = Gi[:, 0]*Gj[:, 1] - Gi[:, 1]*Gj[:, 0]
+        regular = np.abs(det) > 1e-12
+        Gi, Gj, det = Gi[regular], Gj[regular], det[regular]
+        ci, cj = c[pairs[regular, 0]], c[pairs[regular, 1]]
+        candidates.append(np.stack([(-ci*Gj[:, 1] + cj*Gi[:, 1])/det, (-cj*Gi[:, 0] + ci*Gj[:, 0])/det], axis=1))
+        n_active.append(2*np.ones(len(det), dtype=int))
+
+        candidates = np.vstack(candidates)
+        n_active = np.concatenate(n_active)
+        min_slack = np.min(candidates@G.T + c, axis=1)
+        feasible = min_slack >= -tol
+        if not np.any(feasible):
+            # Use the input that violates the constraints the least
+            i = np.argmax(min_slack)
+            return candidates[i], False, n_active[i]
+        cost = np.sum(self.W*(candidates - u_nom)**2, axis=1)
+        i = np.argmin(np.where(feasible, cost, np.inf))
+        return candidates[i], True, n_active[i]
+
+    def make_step(self, x0):
+        """Computes the filtered control input for the current state.
+
+        Inputs:
+          - x0(np.ndarray): The current state [3x1]
+        Returns:
+          - u0(np.ndarray): The control input [2x1]
+        """
+        t_start = time.perf_counter()
+        x = self.x_now = np.ravel(x0)
+        u_nom = self.get_nominal_control(x, self.t0)
+        A, b = self.get_cbf_constraints(x, self.t0, u_nom)
+        u, success, n_active = self.solve_qp(u_nom, A, b)
+        if not success:
+            # Keep only the CBF condition of the robot (the first half of the rows)
+            n_obs = len(b)//2
+            u, success, n_active = self.solve_qp(u_nom, A[:n_obs], b[:n_obs])
+
+        # Check the input against the exact CBF condition of the robot
+        margins = self.get_cbf_margins(x, u, self.t0)
+        filter_margin = np.min(margins, initial=np.inf)
+        success = success and filter_margin >= -1e-9
+        t_wall = time.perf_counter() - t_start
+
+        # Brake if the constraints are infeasible or the step ran over the time budget (there is no plan to shift)
+        deadline_miss = t_wall > self.step_budget
+        use_fallback = self.fallback is not None and (not success or deadline_miss)
+        brake_margin = np.inf
+        if use_fallback:
+            brake_margin = np.min(self.get_cbf_margins(x, np.zeros(2), self.t0), initial=np.inf)
+        if use_fallback and brake_margin >= min(0, filter_margin):
+            # Brake unless it violates the CBF condition more than the filtered input
+            u = np.zeros(2)
+            filter_margin = brake_margin
+        else:
+            use_fallback = False
+
+        min_slack = filter_margin if len(margins) > 0 else np.nan
+        self.update_telemetry(t_wall, success, n_active, min_slack, np.sum((u - u_nom)**2), deadline_miss, use_fallback,
+                              use_fallback and brake_margin < 0)
+        self.t0 += self.Ts
+        return u.reshape(-1, 1)
+
+    def update_telemetry(self, t_wall, success, n_active, min_slack, objective, deadline_miss, fallback, unsafe_fallback):
+        """Records the statistics of the last filter step.
+
+        Inputs:
+          - t_wall(float):        Wall time of the filter step [s]
+          - success(bool):        Whether the constraints were feasible
+          - n_active(int):        Number of active constraints (recorded as iterations)
+          - min_slack(float):     Smallest margin of the discrete CBF condition of the robot
+          - objective(float):     Squared deviation from the nominal input
+          - deadline_miss(bool):  Whether the filter step took longer than the time budget
+          - fallback(bool):       Whether the robot braked instead of applying the filtered input
+          - unsafe_fallback(bool): Whether braking violated the CBF constraints
+        """
+        self.telemetry['t_wall'].append(t_wall)
+        self.telemetry['t_solver'].append(t_wall)
+        self.telemetry['iter_count'].append(n_active)
+        self.telemetry['return_status'].append("filtered" if n_active > 0 else "nominal")
+        self.telemetry['success'].append(success)
+        self.telemetry['min_slack'].append(min_slack)
+        self.telemetry['objective'].append(objective)
+        self.telemetry['deadline_miss'].append(deadline_miss)
+        self.telemetry['fallback'].append(fallback)
+        self.telemetry['unsafe_fallback'].append(unsafe_fallback)
@@ -0,0 +1,312 @@
+"""Control service: the controller behind a local socket.
+
+The server takes state messages over a local TCP or Unix socket and answers each one with the next
+control input. The messages are JSON objects, one per line:
+
+    request: {"id": 1, "x": [x, y, theta], "goal": [x, y, theta], "obstacles": [[x, y, r], ...],
+              "moving_obstacles": [[ax, bx, ay, by, r], ...]}  (goal and obstacles are optional)
+    reply:   {"id": 1, "u": [v, omega], "t": 0.1, "success": true, "fallback": false,
+              "latency": 0.012, "queue_time": 0.0, "solve_time": 0.012}
+
+The controller solves one request at a time and only the newest request waiting is solved: when a
+new state arrives before the previous one was solved, the previous one is answered with
+{"id": ..., "stale": true} and its goal and obstacle updates are carried over to the new one. The
+replay client sends the states of a logged trajectory to the server and measures the round-trip
+time of each request:
+
+    python service.py serve --scenario 1 --port 8765
+    python service.py replay results/001_MPC-CBF_setpoint_gamma0.1.pkl --port 8765
+"""
+
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+import numpy as np
+
+import config
+from util import get_controller
+
+# Optional fields of a request that update the controller and are carried over from stale requests
+update_keys = ['goal', 'obstacles', 'moving_obstacles']
+
+
+class ControlService:
+    """Asyncio server that computes the control inputs of a controller for the states it receives.
+
+    The connections are read on the event loop while the controller solves on a worker thread, so
+    that new states are received during a solve and the stale ones are dropped. The service runs
+    for an unbounded number of steps, so the do-mpc data of the controller is cleared after each
+    step and the telemetry and latencies are ring buffers of the last steps (build the controller
+    with store_full_solution=False, see serve).
+    """
+    def __init__(self, controller, history_length=1000):
+        """
+        Inputs:
+          - controller(MPC):      The controller
+          - history_length(int):  Number of steps kept in the telemetry and the latencies
+        """
+        self.controller = controller
+        self.controller.telemetry = controller.get_empty_telemetry(history_length)
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Thread of the controller
+        self.server = None
+        self.solver_task = None
+        self.pending = None        # Newest request not solved yet: (request, writer, receive time)
+        self.new_request = None    # Event set when a request is pending
+        self.latencies = deque(maxlen=history_length)  # Time from receiving to answering the last solved requests [s]
+        self.n_solved = 0          # Number of solved requests
+        self.n_stale = 0           # Number of requests dropped for newer ones
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Starts listening on a TCP port or, if a path is given, on a Unix socket.
+
+        Inputs:
+          - host(str): The host of the TCP socket
+          - port(int): The TCP port (0: any free port)
+          - path(str): The path of the Unix socket (optional)
+        Returns:
+          - address: The (host, port) of the TCP socket or the path of the Unix socket
+        """
+        self.new_request = asyncio.Event()
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_client, path=path)
+            address = path
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host=host, port=port)
+            address = self.server.sockets[0].getsockname()[:2]
+        self.solver_task = asyncio.create_task(self.solve_requests())
+        return address
+
+    async def close(self):
+        """Stops the server and the controller thread."""
+        self.server.close()
+        await self.server.wait_closed()
+        self.solver_task.cancel()
+        try:
+            await self.solver_task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    async def handle_client(self, reader, writer):
+        """Reads the requests of a connection until it is closed."""
+        try:
+            while line := await reader.readline():
+                t_received = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    await self.send(writer, {'id': None, 'error': "Invalid message: {}".format(e)})
+                    continue
+                await self.submit(request, writer, t_received)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def submit(self, request, writer, t_received):
+        """Makes a request the pending one, answering the previous pending request as stale."""
+        if self.pending is not None:
+            stale, stale_writer, _ = self.pending
+            for key in update_keys:
+                if key in stale and key not in request:
+                    request[key] = stale[key]
+            self.n_stale += 1
+            await self.send(stale_writer, {'id': stale.get('id'), 'stale': True})
+        self.pending = (request, writer, t_received)
+        self.new_request.set()
+
+    async def solve_requests(self):
+        """Solves the pending requests one after the other on the controller thread."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.new_request.wait()
+            self.new_request.clear()
+            request, writer, t_received = self.pending
+            self.pending = None
+            t_start = time.perf_counter()
+            try:
+                reply = await loop.run_in_executor(self.executor, self.solve, request)
+            except Exception as e:
+                reply = {'id': request.get('id'), 'error': repr(e)}
+            t_end = time.perf_counter()
+            reply.update({'latency': t_end - t_received,
+                          'queue_time': t_start - t_received,
+                          'solve_time': t_end - t_start})
+            self.latencies.append(reply['latency'])
+            self.n_solved += 1
+            await self.send(writer, reply)
+
+    def solve(self, request):
+        """Applies the updates of a request and computes the control input (runs on the controller thread).
+
+        Inputs:
+          - request(dict): The request with the state 'x' and optionally 'goal', 'obstacles' and 'moving_obstacles'
+        Returns:
+          - reply(dict): The reply with the control input 'u'
+        """
+        controller = self.controller
+        if 'goal' in request:
+            if controller.control_type != "setpoint":
+                raise ValueError("A goal can only be set for set point control!")
+            controller.goal = list(request['goal'])
+        if 'obstacles' in request or 'moving_obstacles' in request:
+            controller.set_obstacles([tuple(o) for o in request['obstacles']] if 'obstacles' in request else None,
+                                     [tuple(o) for o in request['moving_obstacles']]
+                                     if 'moving_obstacles' in request else None)
+        t = float(np.ravel(controller.mpc.t0)[0]) if controller.mpc is not None else None
+        u = controller.make_step(np.array(request['x'], dtype=float).reshape(-1, 1))
+        controller.clear_data()
+        return {'id': request.get('id'),
+                'u': np.ravel(u).tolist(),
+                't': t,
+                'success': bool(controller.telemetry['success'][-1]),
+                'fallback': bool(controller.telemetry['fallback'][-1])}
+
+    @staticmethod
+    async def send(writer, message):
+        """Sends a message, ignoring connections that were closed."""
+        if writer.is_closing():
+            return
+        try:
+            writer.write((json.dumps(message) + '\n').encode())
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def get_latency_summary(self):
+        """Summarizes the latency of the solved requests.
+
+        Returns:
+          - summary(dict): Number of solved and stale requests and the latency percentiles and maximum [s]
+                           of the last solved requests
+        """
+        latencies = np.array(self.latencies)
+        summary = {'requests': self.n_solved, 'stale': self.n_stale}
+        if len(latencies) > 0:
+            summary.update({'p50': float(np.percentile(latencies, 50)),
+                            'p95': float(np.percentile(latencies, 95)),
+                            'max': float(np.max(latencies))})
+        return summary
+
+
+async def serve(controller, host='127.0.0.1', port=8765, path=None):
+    """Runs the control service until it is cancelled (e.g. with Ctrl-C)."""
+    service = ControlService(controller)
+    address = await service.start(host, port, path)
+    print("Serving {} on {}".format(controller.cfg.controller, address))
+    try:
+        await service.server.serve_forever()
+    finally:
+        await service.close()
+        print(service.get_latency_summary())
+
+
+async def replay_trajectory(states, host='127.0.0.1', port=8765, path=None, period=None):
+    """Sends the states of a logged trajectory to the control service and measures the round-trip times.
+
+    Without a period, each state is sent after the reply to the previous one (lockstep). With a
+    period, the states are sent at that rate whatever the replies, like a robot with a fixed control
+    rate, so that the server drops the states it can not keep up with.
+
+    Inputs:
+      - states(np.ndarray): The states to send [n_steps x 3]
+      - host(str):          The host of the TCP socket
+      - port(int):          The TCP port
+      - path(str):          The path of the Unix socket (instead of TCP)
+      - period(float):      Time between the requests [s] (None: lockstep)
+    Returns:
+      - replies(list): The reply to each state, with its round-trip time 'rtt' [s]
+    """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    t_sent = {}
+    replies = []
+
+    async def receive(n):
+        while len(replies) < n:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("The control service closed the connection.")
+            reply = json.loads(line)
+            reply['rtt'] = time.perf_counter() - t_sent[reply['id']]
+            replies.append(reply)
+
+    receiver = None if period is None else asyncio.create_task(receive(len(states)))
+    t_start = time.perf_counter()
+    for i, x in enumerate(np.asarray(states, dtype=float)):
+        if period is not None:
+            await asyncio.sleep(max(0.0, t_start + i*period - time.perf_counter()))
+        t_sent[i] = time.perf_counter()
+        writer.write((json.dumps({'id': i, 'x': x.tolist()}) + '\n').encode())
+        await writer.drain()
+        if period is None:
+            await receive(i + 1)
+    if receiver is not None:
+        await receiver
+    writer.close()
+    await writer.wait_closed()
+    return sorted(replies, key=lambda reply: reply['id'])
+
+
+def get_replay_summary(replies):
+    """Summarizes the round-trip times of a replay.
+
+    Inputs:
+      - replies(list): The replies of replay_trajectory
+    Returns:
+      - summary(dict): Number of solved, stale and failed requests, round-trip time percentiles and
+                       maximum [s] and the mean server latency [s] of the solved requests
+    """
+    solved = [reply for reply in replies if 'u' in reply]
+    rtt = np.array([reply['rtt'] for reply in solved])
+    summary = {'requests': len(replies),
+               'solved': len(solved),
+               'stale': sum(reply.get('stale', False) for reply in replies),
+               'errors': sum('error' in reply for reply in replies)}
+    if len(solved) > 0:
+        summary.update({'rtt_p50': float(np.percentile(rtt, 50)),
+                        'rtt_p95': float(np.percentile(rtt, 95)),
+                        'rtt_max': float(np.max(rtt)),
+                        'server_latency_mean': float(np.mean([reply['latency'] for reply in solved]))})
+    return summary
+
+
+def load_logged_states(filename):
+    """Loads the state trajectory of a saved run (see util.save_mpc_results) [n_steps x 3]."""
+    from do_mpc.data import load_results
+    return np.array(load_results(filename)['simulator']['_x'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the control service or replays a logged trajectory against it.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="Runs the control service")
+    serve_parser.add_argument('--scenario', type=int, default=None, help="Scenario of config.py (1-6)")
+    serve_parser.add_argument('--controller', default=None, help="Controller type, e.g. MPC-DC")
+    replay_parser = subparsers.add_parser('replay', help="Replays the states of a saved run against the service")
+    replay_parser.add_argument('filename', help="Pickle file of a saved run")
+    replay_parser.add_argument('--period', type=float, default=None, help="Time between requests [s] (default: lockstep)")
+    for p in [serve_parser, replay_parser]:
+        p.add_argument('--host', default='127.0.0.1', help="Host of the TCP socket")
+        p.add_argument('--port', type=int, default=8765, help="TCP port")
+        p.add_argument('--socket', default=None, help="Path of a Unix socket to use instead of TCP")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        settings = {key: value for key, value in [('scenario', args.scenario), ('controller', args.controller)]
+                    if value is not None}
+        settings['store_full_solution'] = False  # The predictions are not kept
+        try:
+            asyncio.run(serve(get_controller(config.get_config(**settings)), args.host, args.port, args.socket))
+        except KeyboardInterrupt:
+            pass
+    else:
+        replies = asyncio.run(replay_trajectory(load_logged_states(args.filename), args.host, args.port,
+                                                args.socket, args.period))
+        print(get_replay_summary(replies))
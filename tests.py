@@ -6,4 +6,6 @@ if __name__ == '__main__':
     util.compare_results_by_gamma()                   # Compares the path for each method and gamma value
 
     # util.run_multiple_experiments(N=50)               # Runs N experiments for each method
-    # util.compare_controller_results(N=50, gamma=0.1)  # Compares total costs and min distances for each method
\ No newline at end of file
+    # util.compare_controller_results(N=50, gamma=0.1)  # Compares total costs and min distances for each method
+    # util.compare_warm_start()                         # Compares the solver iterations and step times with and without shifted warm start
+    # util.benchmark_nearest_obstacles()                # Compares the solve time with all and with the nearest obstacles
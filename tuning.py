@@ -0,0 +1,215 @@
+"""Tuning of the IPOPT options of the MPC for a scenario.
+
+Searches the groups of solver options (linear solver, barrier parameter strategy, tolerances,
+Hessian approximation and warm start) one group after the other: each option of a group is
+simulated in closed loop together with the best options so far, and it is kept if it lowers the
+solve latency while the trajectory and the CBF margins stay within tolerance of a reference run with
+the default options. The chosen options are saved as a profile that the MPC loads with the
+solver_profile setting:
+
+    python tuning.py --scenario 1
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import time
+
+import numpy as np
+from casadi import CasadiMeta, SX, nlpsol
+
+from analytics import analyze_controller
+import config
+from util import get_controller
+
+# Groups of IPOPT options searched by tune_solver_options, in order (the defaults are always a candidate)
+option_groups = [('output', [{'ipopt.print_level': 0, 'ipopt.sb': 'yes', 'print_time': False}]),
+                 ('linear solver', [{'ipopt.linear_solver': 'ma27'},
+                                    {'ipopt.linear_solver': 'ma57'},
+                                    {'ipopt.linear_solver': 'spral'}]),
+                 ('mu strategy', [{'ipopt.mu_strategy': 'adaptive'}]),
+                 ('tolerances', [{'ipopt.tol': 1e-6},
+                                 {'ipopt.tol': 1e-6, 'ipopt.acceptable_tol': 1e-4, 'ipopt.acceptable_iter': 5},
+                                 {'ipopt.tol': 1e-4, 'ipopt.acceptable_tol': 1e-3, 'ipopt.acceptable_iter': 5}]),
+                 ('hessian', [{'ipopt.hessian_approximation': 'limited-memory'}]),
+                 ('warm start', [{'ipopt.warm_start_init_point': 'yes', 'ipopt.mu_init': 1e-4},
+                                 {'ipopt.warm_start_init_point': 'yes', 'ipopt.mu_init': 1e-6,
+                                  'ipopt.warm_start_bound_push': 1e-9, 'ipopt.warm_start_mult_bound_push': 1e-9},
+                                 {'ipopt.warm_start_init_point': 'no'}])]
+
+
+def check_solver_options(options):
+    """Checks that IPOPT accepts the options (e.g. that a linear solver is installed) on a small problem.
+
+    Inputs:
+      - options(dict): The IPOPT options
+    Returns:
+      - available(bool): True if IPOPT solves the problem with the options
+    """
+    x = SX.sym('x', 2)
+    solver = nlpsol('S', 'ipopt', {'x': x, 'f': (x[0] - 1)**2 + (x[1] - 2)**2, 'g': x[0] + x[1]},
+                    dict(options, **{'ipopt.print_level': 0, 'ipopt.sb': 'yes', 'print_time': False}))
+    try:
+        solver(x0=[0, 0], lbg=0, ubg=2)
+    except RuntimeError:
+        return False
+    return solver.stats()['success']
+
+
+def run_tuning_case(settings, options):
+    """Runs the closed loop of a scenario with the given IPOPT options (runs in a worker process).
+
+    Inputs:
+      - settings(dict): The settings of the controller, e.g. {'scenario': 1}
+      - options(dict):  The IPOPT options that override the defaults
+    Returns:
+      - result(dict): The options, latency, failures, safety metrics and state trajectory 'x' of the run
+                      (with an 'error' instead if the run failed)
+    """
+    try:
+        controller = get_controller(config.get_config(solver_options=options, **settings))
+        controller.run_simulation()
+    except Exception as e:
+        return {'options': options, 'error': repr(e)}
+    summary = controller.get_telemetry_summary()
+    metrics = analyze_controller(controller)
+    return {'options': options,
+            'p50': float(summary['p50']),
+            'p95': float(summary['p95']),
+            'max': float(summary['max']),
+            'iter_mean': float(np.mean(controller.iter_counts)),
+            'failures': summary['failures'],
+            'fallbacks': summary['fallbacks'],
+            'violations': int(metrics['violations'][0]),
+            'min_clearance': float(metrics['min_clearance'][0]),
+            'min_h': float(metrics['min_h'][0]),
+            'cost': float(np.sum(controller.data['_aux', 'cost'])),
+            'x': np.array(controller.data['_x'])}
+
+
+def compare_to_reference(result, reference, x_tol=0.05, margin_tol=0.01, cost_tol=0.05):
+    """Checks that a run stays within tolerance of the reference run.
+
+    Inputs:
+      - result(dict):      The result of the run (see run_tuning_case)
+      - reference(dict):   The result of the reference run
+      - x_tol(float):      Largest distance between the positions of the two runs at the same step [m]
+      - margin_tol(float): Largest decrease of the smallest clearance and CBF value from the reference
+      - cost_tol(float):   Largest relative increase of the closed-loop cost from the reference
+    Returns:
+      - deviation(float): The largest distance between the positions of the two runs [m]
+      - accepted(bool):   True if the run is within tolerance
+    """
+    if 'error' in result:
+        return None, False
+    X, X_ref = result['x'], reference['x']
+    n = min(len(X), len(X_ref))
+    deviation = float(np.max(np.hypot(X[:n, 0] - X_ref[:n, 0], X[:n, 1] - X_ref[:n, 1]))) if n > 0 else 0.0
+    accepted = (len(X) == len(X_ref) and deviation <= x_tol
+                and result['failures'] <= reference['failures']
+                and result['fallbacks'] <= reference['fallbacks']
+                and result['violations'] <= reference['violations']
+                and result['cost'] <= reference['cost']*(1 + cost_tol))
+    for key in ['min_clearance', 'min_h']:
+        if not np.isnan(reference[key]):
+            accepted = accepted and result[key] >= reference[key] - margin_tol
+    return deviation, accepted
+
+
+def tune_solver_options(scenario, filename=None, groups=None, metric='p95', min_speedup=0.05, x_tol=0.05,
+                        margin_tol=0.01, cost_tol=0.05, sim_time=None, n_workers=1, **settings):
+    """Searches the IPOPT options with the lowest closed-loop solve latency for a scenario and saves them.
+
+    The groups of options are searched in order, keeping the best options of each group for the
+    next ones. An option is kept if it lowers the latency by at least min_speedup and the run is
+    within tolerance of the reference run with the default options (see compare_to_reference).
+    Options that IPOPT does not accept (e.g. linear solvers that are not installed) are skipped.
+    The workers share the CPUs, so for reliable latencies use n_workers=1.
+
+    Inputs:
+      - scenario(int):      Scenario of config.py
+      - filename(str):      The JSON file of the profile (defaults to solver_profiles/scenario<N>.json)
+      - groups(list):       The (name, list of options) groups to search (defaults to option_groups)
+      - metric(str):        The latency to minimize: 'p50', 'p95' or 'max' of the solve time
+      - min_speedup(float): Smallest relative decrease of the latency to keep an option
+      - x_tol(float):       Largest distance from the reference positions [m]
+      - margin_tol(float):  Largest decrease of the smallest clearance and CBF value from the reference
+      - cost_tol(float):    Largest relative increase of the closed-loop cost from the reference
+      - sim_time(int):      Number of simulation steps (None: the value of the scenario)
+      - n_workers(int):     Number of worker processes for the options of a group
+      - settings:           Other settings of the controller, e.g. controller="MPC-DC"
+    Returns:
+      - profile(dict): The chosen options, their latency, the reference latency and all candidates
+    """
+    import do_mpc
+    if groups is None:
+        groups = option_groups
+    if filename is None:
+        filename = os.path.join('solver_profiles', 'scenario{}.json'.format(scenario))
+    settings = dict(settings, scenario=scenario, solver_profile=None)
+    if sim_time is not None:
+        settings['sim_time'] = sim_time
+
+    def get_record(group, result, deviation=None, accepted=None):
+        record = {key: value for key, value in result.items() if key != 'x'}
+        record.update({'group': group, 'deviation': deviation, 'accepted': accepted})
+        return record
+
+    t_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        reference = executor.submit(run_tuning_case, settings, {}).result()
+        if 'error' in reference:
+            raise RuntimeError("The reference run failed: " + reference['error'])
+        best_options, best = {}, reference
+        candidates = [get_record('default', reference, 0.0, True)]
+        for group, options in groups:
+            available = []
+            for option in options:
+                if check_solver_options(option):
+                    available.append(dict(best_options, **option))
+                else:
+                    candidates.append(get_record(group, {'options': dict(best_options, **option),
+                                                         'error': "Option not accepted by IPOPT"}))
+            group_best = None
+            for result in executor.map(run_tuning_case, [settings]*len(available), available):
+                deviation, accepted = compare_to_reference(result, reference, x_tol, margin_tol, cost_tol)
+                candidates.append(get_record(group, result, deviation, accepted))
+                if accepted and result[metric] < best[metric]*(1 - min_speedup):
+                    if group_best is None or result[metric] < group_best[metric]:
+                        group_best = result
+            if group_best is not None:
+                best_options, best = group_best['options'], group_best
+
+    profile = {'scenario': scenario,
+               'options': best_options,
+               'metric': metric,
+               'latency': best[metric],
+               'reference_latency': reference[metric],
+               'settings': settings,
+               'tolerances': {'x_tol': x_tol, 'margin_tol': margin_tol, 'cost_tol': cost_tol},
+               'meta': {'do_mpc': do_mpc.__version__, 'casadi': CasadiMeta.version(),
+                        'numpy': np.__version__, 'n_workers': n_workers,
+                        'tuning_time': time.perf_counter() - t_start},
+               'candidates': candidates}
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(profile, f, indent=2)
+    return profile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Searches the IPOPT options with the lowest solve latency for a scenario.")
+    parser.add_argument('--scenario', type=int, default=1, help="Scenario of config.py (1-6)")
+    parser.add_argument('--output', default=None, help="Profile file (defaults to solver_profiles/scenario<N>.json)")
+    parser.add_argument('--controller', default=None, help="Controller type, e.g. MPC-DC")
+    parser.add_argument('--metric', default='p95', choices=['p50', 'p95', 'max'], help="Latency to minimize")
+    parser.add_argument('--sim-time', type=int, default=None, help="Number of simulation steps")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes")
+    args = parser.parse_args()
+    controller = {} if args.controller is None else {'controller': args.controller}
+    profile = tune_solver_options(args.scenario, args.output, metric=args.metric, sim_time=args.sim_time,
+                                  n_workers=args.workers, **controller)
+    print("Options: {}".format(profile['options']))
+    print("Latency ({}): {:.2f} ms (default options: {:.2f} ms)".format(
+        args.metric, 1e3*profile['latency'], 1e3*profile['reference_latency']))
@@ -1,116 +1,338 @@
-from do_mpc.data import save_results, load_results
+from concurrent.futures import ProcessPoolExecutor
+import os
 
+import numpy as np
+
+from analytics import analyze_runs, stack_runs
 import config
+from batch_simulator import BatchSimulator
 from mpc_cbf import MPC
-from plotter import plot_path_comparisons, plot_cost_comparisons, plot_min_distance_comparison
+from results_store import ResultsStore, get_run_columns, get_run_metadata
+from safety_filter import SafetyFilter
+
+
+def get_controller(cfg=None):
+    """Creates the controller selected in cfg.controller (defaults to the current config settings)."""
+    if cfg is None:
+        cfg = config.get_config()
+    if cfg.controller == "CBF-QP":
+        return SafetyFilter(cfg)
+    return MPC(cfg)
+
+
+def get_result_name(cfg=None):
+    """Returns the results filename for the controller settings (defaults to the current config settings)."""
+    if cfg is None:
+        cfg = config.get_config()
+    if cfg.controller != "MPC-DC":
+        return cfg.controller + '_' + cfg.control_type + '_gamma' + str(cfg.gamma)
+    return cfg.controller + '_' + cfg.control_type
+
 
+def save_mpc_results(controller, result_name=None):
+    """Save results in pickle file.
 
-def save_mpc_results(controller):
-    """Save results in pickle file."""
-    if config.controller == "MPC-CBF":
-        filename = config.controller + '_' + config.control_type + '_gamma' + str(config.gamma)
+    Without a result_name, the name is taken from the controller settings and an index is
+    prepended if the file already exists. An explicit result_name overwrites any existing result.
+    The results need the simulator data, which a simulation with a plant (see MPC.simulate) does not record.
+    """
+    if len(controller.simulator.data['_time']) == 0:
+        raise ValueError("The simulator has no data to save (was the simulation run with a plant or without recording the data?)")
+    from do_mpc.data import save_results
+    objects = [controller.simulator] if controller.mpc is None else [controller.mpc, controller.simulator]
+    if result_name is None:
+        save_results(objects, result_name=get_result_name(controller.cfg))
     else:
-        filename = config.controller + '_' + config.control_type
+        save_results(objects, result_name=result_name, overwrite=True)
 
-    save_results([controller.mpc, controller.simulator], result_name=filename)
+
+def save_to_store(controller, store='results/store', result_name=None, seed=None):
+    """Appends the results of the last simulation to the columnar results store.
+
+    Inputs:
+      - controller(MPC):          The controller after the simulation
+      - store(str/ResultsStore):  The store or its directory
+      - result_name(str):         Name of the run (defaults to the name from the controller settings)
+      - seed(int):                Seed or episode number of the run
+    Returns:
+      - run(int): The number of the run in the store
+    """
+    if isinstance(store, str):
+        store = ResultsStore(store)
+    if result_name is None:
+        result_name = get_result_name(controller.cfg)
+    return store.append(result_name, get_run_columns(controller), **get_run_metadata(controller.cfg, seed))
 
 
 def load_mpc_results(filename):
     """Load results from pickle file."""
+    from do_mpc.data import load_results
     return load_results('./results/' + filename + '.pkl')
 
 
-def compare_controller_results(N, gamma):
-    """Compares the total cost and min distances for each method over N experiments."""
+def compare_controller_results(N, gamma, store=None):
+    """Compares the total cost and min distances for each method over N experiments.
+
+    The results are read from the pickle files, or from the results store if given (only the
+    states, time and cost columns of the runs are read).
+    """
 
     obs = [(1.0, 0.5, 0.1)]  # The obstacles used when creating the experiments
 
+    # Get results
+    if store is not None:
+        runs_cbf = get_store_runs(store, N, controller="MPC-CBF", gamma=gamma)
+        runs_dc = get_store_runs(store, N, controller="MPC-DC")
+    else:
+        runs_cbf = get_pickle_runs(['{:03d}_MPC-CBF_setpoint_gamma{}'.format(i, gamma) for i in range(1, N+1)])
+        runs_dc = get_pickle_runs(['{:03d}_MPC-DC_setpoint'.format(i) for i in range(1, N+1)])
+
     # Get costs & min distances from results
-    costs_cbf = []
-    costs_dc = []
-    min_distances_cbf = []
-    min_distances_dc = []
-    for i in range(1, N+1):
-        # Filename prefix
-        if len(str(i)) == 1:
-            num = '00' + str(i)
-        elif len(str(i)) == 2:
-            num = '0' + str(i)
-        else:
-            num = str(i)
-
-        # Get cbf result
-        filename_cbf = num + "_MPC-CBF_setpoint_gamma" + str(gamma)
-        results_cbf = load_mpc_results(filename_cbf)
-        total_cost_cbf = sum(results_cbf['mpc']['_aux'][:, 1])
-        costs_cbf.append(total_cost_cbf)
-        positions = results_cbf['mpc']['_x']
-        distances = []
-        for p in positions:
-            distances.append(((p[0]-obs[0][0])**2 + (p[1]-obs[0][1])**2)**(1/2) - (config.r + obs[0][2]))
-        min_distances_cbf.append(min(distances))
-
-        # Get dc result
-        filename_dc = num + "_MPC-DC_setpoint"
-        results_dc = load_mpc_results(filename_dc)
-        total_cost_dc = sum(results_dc['mpc']['_aux'][:, 1])
-        costs_dc.append(total_cost_dc)
-        positions = results_dc['mpc']['_x']
-        distances = []
-        for p in positions:
-            distances.append(((p[0]-obs[0][0])**2 + (p[1]-obs[0][1])**2)**(1/2) - (config.r + obs[0][2]))
-        min_distances_dc.append(min(distances))
-
-    # Plot cost comparisons
+    metrics_cbf = analyze_runs(runs_cbf['_x'], runs_cbf['_time'][..., 0], obs, r=config.r, aux=runs_cbf['_aux'])
+    metrics_dc = analyze_runs(runs_dc['_x'], runs_dc['_time'][..., 0], obs, r=config.r, aux=runs_dc['_aux'])
+    costs_cbf, min_distances_cbf = metrics_cbf['total_cost'], metrics_cbf['min_clearance']
+    costs_dc, min_distances_dc = metrics_dc['total_cost'], metrics_dc['min_clearance']
+
+    # Plot cost comparisons (the plotting libraries are only imported for plots)
+    from plotter import plot_cost_comparisons, plot_min_distance_comparison
     plot_cost_comparisons(costs_dc, costs_cbf, gamma)
 
     # Plot min distances comparison
     plot_min_distance_comparison(min_distances_cbf, min_distances_dc, gamma)
 
-    print("Average cost over all experiments: cbf={}, dc={}".format(sum(costs_cbf)/len(costs_cbf), sum(costs_dc)/len(costs_dc)))
-    print("Average min distance over all experiments: cbf={}, dc={}".format(sum(min_distances_cbf)/len(min_distances_cbf),
-                                                                            sum(min_distances_dc)/len(min_distances_dc)))
+    print("Average cost over all experiments: cbf={}, dc={}".format(np.mean(costs_cbf), np.mean(costs_dc)))
+    print("Average min distance over all experiments: cbf={}, dc={}".format(np.mean(min_distances_cbf),
+                                                                            np.mean(min_distances_dc)))
+
+
+def get_pickle_runs(filenames, columns=('_x', '_time', '_aux')):
+    """Loads columns of the MPC data of the given results and stacks them (see analytics.stack_runs).
+
+    Inputs:
+      - filenames(list): The names of the results
+      - columns(tuple):  The columns to load
+    Returns:
+      - runs(dict): The stacked arrays of each column [n_runs x n_steps x n_values]
+    """
+    results = [load_mpc_results(filename)['mpc'] for filename in filenames]
+    return {column: stack_runs([result[column] for result in results]) for column in columns}
+
+
+def get_store_runs(store, N, columns=('_x', '_time', '_aux'), **metadata):
+    """Loads columns of the set point runs with seeds 1 to N from the results store and stacks them.
 
+    Inputs:
+      - store(str/ResultsStore): The store or its directory
+      - N(int):                  Number of experiments (the runs with seeds 1 to N)
+      - columns(tuple):          The columns to load
+      - metadata:                The metadata of the runs, e.g. controller="MPC-DC"
+    Returns:
+      - runs(dict): The stacked arrays of each column [N x n_steps x n_values]
+    """
+    if isinstance(store, str):
+        store = ResultsStore(store)
+    runs = store.select(control_type="setpoint", seed=list(range(1, N+1)), **metadata)
+    run_by_seed = {entry['seed']: entry['run'] for entry in store.get_metadata(runs)}  # The latest run of each seed
+    if len(run_by_seed) < N:
+        raise KeyError("The store has {} of the {} runs with {}.".format(len(run_by_seed), N, metadata))
+    runs = [run_by_seed[i] for i in range(1, N+1)]
+    return {column: stack_runs(store.load(column, runs)) for column in columns}
 
-def run_multiple_experiments(N):
-    """Runs N experiments for each method."""
+
+def run_multiple_experiments(N, n_workers=None, store=None):
+    """Runs N experiments for each method on a pool of worker processes (saved in the results store, if given)."""
 
     # Run experiments
-    cont_type = ["MPC-CBF", "MPC-DC"]
-    for c in cont_type:
-        config.controller = c
-        for i in range(N):
-            run_sim()
+    settings = [{'controller': "MPC-CBF"}, {'controller': "MPC-DC"}]
+    run_experiments_parallel(settings, N=N, n_workers=n_workers, store=store)
+
+
+def run_experiments_parallel(settings, N=1, n_workers=None, store=None):
+    """Runs N experiments for each settings dictionary on a pool of worker processes.
+
+    The episodes of each setting are split in contiguous chunks, one per worker. Each worker
+    builds a configuration from its settings (see config.get_config), builds the controller once and
+    reuses it for all the episodes of its chunk. When N > 1 the results are stored with the
+    episode number as prefix (001, 002, ...), so the filenames do not depend on the order in
+    which the workers finish.
+
+    With a store, the workers send the results back instead of writing pickle files, and they
+    are appended to the columnar results store by this process, with the episode number as seed.
+
+    Inputs:
+      - settings(list):          Dictionaries of config values for each run, e.g. {'controller': "MPC-DC"}
+      - N(int):                  Number of experiments for each setting
+      - n_workers(int):          Number of worker processes (defaults to the number of CPUs)
+      - store(str/ResultsStore): The results store or its directory (optional)
+    Returns:
+      - filenames(list): The names of the stored results
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_chunks = max(1, min(N, n_workers // len(settings)))
+
+    tasks = []
+    for s in settings:
+        for chunk in np.array_split(np.arange(1, N+1), n_chunks):
+            if len(chunk) > 0:
+                tasks.append((s, [int(i) for i in chunk], N > 1, store is not None))
+    if isinstance(store, str):
+        store = ResultsStore(store)
+
+    filenames = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for runs in executor.map(_run_episodes, *zip(*tasks)):
+            for name, columns, metadata in runs:
+                if store is not None:
+                    store.append(name, columns, **metadata)
+                filenames.append(name)
+    return filenames
+
+
+def _run_episodes(settings, episodes, numbered, to_store=False):
+    """Runs the given episodes in a worker process with a single controller instance.
+
+    Returns the name of each episode, with its columns and metadata for the results store if
+    to_store is set (otherwise the results are saved as pickle files and these are None).
+    """
+    cfg = config.get_config(**settings)
+    controller = get_controller(cfg)
+    runs = []
+    for n, i in enumerate(episodes):
+        if n > 0:
+            controller.reset()  # Start a new episode with the same (already set up) solver
+        controller.run_simulation()
+        filename = '{:03d}_'.format(i) + get_result_name(cfg) if numbered else get_result_name(cfg)
+        if to_store:
+            runs.append((filename, get_run_columns(controller), get_run_metadata(cfg, seed=i)))
+        else:
+            save_mpc_results(controller, result_name=filename)
+            runs.append((filename, None, None))
+
+    if controller.n_resets > 0:
+        print("Reused the controller for {} episodes, saved {:.2f}s of build time.".format(
+            controller.n_resets, controller.saved_build_time))
+    return runs
+
+
+def print_telemetry_summary(controller):
+    """Prints the solver latency percentiles and the number of failures of the last simulation."""
+    summary = controller.get_telemetry_summary()
+    print("Solve time over {} steps: p50={:.1f}ms, p95={:.1f}ms, p99={:.1f}ms, max={:.1f}ms".format(
+        summary['steps'], summary['p50']*1000, summary['p95']*1000, summary['p99']*1000, summary['max']*1000))
+    print("Failed solves: {}, steps over the time budget: {}, fallback inputs: {} ({} violating the CBF condition)".format(
+        summary['failures'], summary['deadline_misses'], summary['fallbacks'], summary['unsafe_fallbacks']))
+
+
+def compare_warm_start():
+    """Runs the simulation without and with the shifted warm start and prints the solver iterations and step times."""
+    for strategy in ["last", "shift"]:
+        controller = MPC(config.get_config(warm_start=strategy))
+        controller.run_simulation()
+        t_wall = np.array(controller.telemetry['t_wall'])
+        print("Warm start '{}': {} IPOPT iterations in total, {:.2f} per step (max {}), "
+              "step time mean={:.1f}ms, p95={:.1f}ms".format(
+                  strategy, sum(controller.iter_counts), np.mean(controller.iter_counts), max(controller.iter_counts),
+                  np.mean(t_wall)*1000, np.percentile(t_wall, 95)*1000))
+
+
+def get_random_obstacles(n, seed=0, clearance=0.3, cfg=None):
+    """Creates n random static obstacles, away from the initial position and the goal.
+
+    Inputs:
+      - n(int):             Number of obstacles
+      - seed(int):          Seed of the random generator
+      - clearance(float):   Minimum distance of the obstacle centers from the initial position and goal
+      - cfg(config.Config): The settings with the initial position and goal (defaults to the current settings)
+    Returns:
+      - obs(list): The obstacles as list of tuples (x,y,radius)
+    """
+    if cfg is None:
+        cfg = config.get_config()
+    rng = np.random.default_rng(seed)
+    obs = []
+    while len(obs) < n:
+        x, y = rng.uniform([-1.0, -1.0], [3.0, 2.0])
+        if np.hypot(x - cfg.x0[0], y - cfg.x0[1]) > clearance and np.hypot(x - cfg.goal[0], y - cfg.goal[1]) > clearance:
+            obs.append((x, y, rng.uniform(0.02, 0.05)))
+    return obs
+
+
+def benchmark_nearest_obstacles(n_obstacles=(10, 50, 100, 200), K=5, sim_time=30):
+    """Compares the solve time with all static obstacles against the K nearest to the predicted path.
+
+    Inputs:
+      - n_obstacles(tuple): Total number of obstacles of each obstacle field
+      - K(int):             Number of nearest obstacles for the culled controller
+      - sim_time(int):      Number of simulation steps for each run
+    Returns:
+      - results(list): (number of obstacles, mean solve time all, mean solve time culled) for each field [s]
+    """
+    results = []
+    for n in n_obstacles:
+        obs = get_random_obstacles(n)
+        solve_times = []
+        for n_nearest_obs in [None, K]:
+            controller = MPC(config.get_config(sim_time=sim_time, static_obstacles_on=True, obs=obs,
+                                               n_nearest_obs=n_nearest_obs))
+            controller.run_simulation()
+            solve_times.append(np.mean(controller.mpc.data['t_wall_total']))
+        results.append((n, solve_times[0], solve_times[1]))
+        print("{} obstacles: {:.2f}ms per step with all obstacles, {:.2f}ms with the {} nearest".format(
+            n, solve_times[0]*1000, solve_times[1]*1000, K))
+    return results
+
+
+def run_monte_carlo(n_envs, noise_std=1e-4, seed=0, cfg=None):
+    """Runs n_envs closed-loop simulations with process noise.
+
+    A single controller is built and reset for each simulation, which runs on the plant of its
+    environment of the batch (with the same noise as in a batched run of the environments).
+
+    Inputs:
+      - n_envs(int):        Number of simulations
+      - noise_std(float):   Standard deviation of the additive process noise
+      - seed(int):          Seed of the noise generators
+      - cfg(config.Config): The settings of the controller (defaults to the current config settings)
+    Returns:
+      - states(np.ndarray): The state history of all simulations [n_envs x (sim_time+1) x 3]
+    """
+    if cfg is None:
+        cfg = config.get_config()
+    controller = MPC(cfg)
+    plant = BatchSimulator(n_envs, Ts=cfg.Ts, noise_std=noise_std, seed=seed)
+    states = []
+    for i in range(n_envs):
+        if i > 0:
+            controller.reset()  # Start a new simulation with the same (already set up) solver
+        env = plant.get_env_simulator(i)
+        controller.run_simulation(plant=env)
+        states.append(env.states[0])
+    return np.stack(states)
 
 
 def run_sim():
     """Runs a simulation and saves the results."""
-    controller = MPC()            # Define controller
-    controller.run_simulation()   # Run closed-loop control simulation
-    save_mpc_results(controller)  # Store results
+    controller = get_controller()  # Define controller
+    controller.run_simulation()    # Run closed-loop control simulation
+    save_mpc_results(controller)   # Store results
 
 
-def run_sim_for_different_gammas(gammas):
+def run_sim_for_different_gammas(gammas, n_workers=None):
     """Runs simulation for the MPC-DC and for each gamma for the MPC-CBF."""
 
-    # Run simulation for the MPC-DC
-    config.controller = "MPC-DC"
-    run_sim()
-
-    # Run simulations for each gamma for the MPC-CBF
-    config.controller = "MPC-CBF"
-    for gamma in gammas:
-        config.gamma = gamma
-        run_sim()
+    settings = [{'controller': "MPC-DC"}]                                        # MPC-DC
+    settings += [{'controller': "MPC-CBF", 'gamma': gamma} for gamma in gammas]  # MPC-CBF for each gamma
+    run_experiments_parallel(settings, n_workers=n_workers)
 
 
-def compare_results_by_gamma():
+def compare_results_by_gamma(n_workers=None):
     """Runs simulations and plots path for each method and different gamma values."""
 
     gammas = [0.1, 0.2, 0.3, 1.0]  # Values to test
 
     # Run simulations
-    run_sim_for_different_gammas(gammas)
+    run_sim_for_different_gammas(gammas, n_workers=n_workers)
 
     # Load results
     results = [load_mpc_results("MPC-DC_setpoint")]
@@ -119,4 +341,5 @@ def compare_results_by_gamma():
         results.append(load_mpc_results(filename_cbf))
 
     # Plot path comparison
+    from plotter import plot_path_comparisons
     plot_path_comparisons(results, gammas)